@@ -0,0 +1,524 @@
+from __future__ import annotations
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import Counter
+from unicodedata import east_asian_width
+
+from main import Direction, EditorContext, InsertCommand, create_context
+from journal import EditJournal
+
+
+# run with: python benchmark.py [name ...], e.g. python benchmark.py render_calls
+# drives the editor layers without a window: the canvas is a stand-in that counts the
+# calls a tk.Canvas would send to Tcl, the font a stand-in with fixed metrics
+#
+# timings are the best of a few repeats with fixed inputs, so runs on the same machine
+# can be compared, call counts don't depend on the machine at all
+
+class BenchCanvas:
+    # every method is one Tcl call on a real canvas
+    width = 600
+    height = 400
+
+    def __init__(self):
+        self.calls = Counter() # method name -> calls
+        self.last_id = 0
+
+    def count(self, name: str):
+        self.calls[name] += 1
+
+    def total_calls(self) -> int:
+        return sum(self.calls.values())
+
+    def winfo_height(self):
+        self.count("winfo_height")
+        return self.height
+
+    def winfo_width(self):
+        self.count("winfo_width")
+        return self.width
+
+    def create(self, name: str):
+        self.count(name)
+        self.last_id += 1
+        return self.last_id
+
+    def create_text(self, *args, **kwargs):
+        return self.create("create_text")
+
+    def create_line(self, *args, **kwargs):
+        return self.create("create_line")
+
+    def create_rectangle(self, *args, **kwargs):
+        return self.create("create_rectangle")
+
+    def itemconfigure(self, *args, **kwargs):
+        self.count("itemconfigure")
+
+    def coords(self, *args):
+        self.count("coords")
+
+    def move(self, *args):
+        self.count("move")
+
+    def delete(self, *args):
+        self.count("delete")
+
+    def tag_lower(self, *args):
+        self.count("tag_lower")
+
+
+class BenchFont:
+    # monospaced metrics of the editor font, east asian wide characters take two cells
+    def __init__(self):
+        self.measure_calls = 0 # each one a Tcl call with a tk font
+
+    def measure(self, text: str) -> int:
+        self.measure_calls += 1
+        return sum(20 if east_asian_width(char) in "WF" else 10 for char in text)
+
+    def metrics(self, name: str) -> int:
+        return {"linespace": 20, "ascent": 15, "descent": 5}[name]
+
+
+def make_context(text: str = "") -> EditorContext:
+    ctx = create_context(BenchCanvas(), BenchFont()) # with a LocalClipboard
+    ctx.document.text = text
+    ctx.document.set_storage(ctx.document.parse_text())
+    ctx.document.trailing_line()
+    return ctx
+
+
+def paste(document):
+    # chunked pastes run to the end
+    transfer = document.paste_text()
+    if transfer is not None:
+        transfer.finish()
+
+
+def make_payload(size: int) -> str:
+    line = "the quick brown fox jumps over the lazy dog 0123456789\n"
+    return (line * (size // len(line) + 1))[:size]
+
+
+def timed(func) -> float:
+    start = time.perf_counter()
+    func()
+    return time.perf_counter() - start
+
+
+def best_of(func, repeat: int = 5) -> float:
+    return min(timed(func) for _ in range(repeat))
+
+
+def make_lines(line_count: int) -> str:
+    return "".join(f"    value_{i} = compute(value_{i - 1}, {i % 97})\n" for i in range(line_count))
+
+
+DOCUMENT_SIZES = (10_000, 100_000, 1_000_000) # lines
+
+
+def bench_paste_undo(sizes=(1_000, 10_000, 100_000, 1_000_000)):
+    print(f"{'payload':>10} {'paste ms':>10} {'undo ms':>10}")
+    for size in sizes:
+        payload = make_payload(size)
+
+        ctx = make_context("sample\n" * 100)
+        ctx.clipboard.copy(payload)
+        paste_time = timed(lambda: paste(ctx.document))
+
+        ctx = make_context("sample\n" * 100)
+        ctx.command_manager.execute(InsertCommand(0, payload))
+        undo_time = timed(ctx.command_manager.undo)
+
+        print(f"{size:>10} {paste_time * 1000:>10.2f} {undo_time * 1000:>10.2f}")
+
+
+def journal_session(path: str, compact_every: int) -> EditorContext:
+    ctx = make_context()
+    ctx.journal = EditJournal(ctx)
+    ctx.journal.compact_every = compact_every
+    ctx.command_manager.add_observer(ctx.journal.on_command)
+    ctx.document.open_file(path)
+    ctx.journal.attach(path)
+    return ctx
+
+
+def bench_journal_replay(lengths=(1_000, 10_000, 100_000)):
+    # typing one character per record, replayed with and without compaction
+    print(f"{'records':>10} {'raw replay ms':>14} {'compacted ms':>14}")
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "doc.txt")
+        for length in lengths:
+            results = []
+            for compact_every in (length + 1, EditJournal.compact_every):
+                with open(path, "w") as f:
+                    f.write(make_payload(100_000))
+                for name in os.listdir(directory):
+                    if name.startswith("."):
+                        os.unlink(os.path.join(directory, name))
+                ctx = journal_session(path, compact_every)
+                for i in range(length):
+                    if i % 80 == 0:
+                        ctx.document.move_cursor_to(ctx.document.storage.line_start(i // 80))
+                    ctx.document.insert_str("x")
+                ctx.journal.close()
+                start = time.perf_counter()
+                replayed = journal_session(path, compact_every)
+                results.append(time.perf_counter() - start)
+                replayed.journal.close()
+            print(f"{length:>10} {results[0] * 1000:>14.2f} {results[1] * 1000:>14.2f}")
+
+
+def bench_resize(line_counts=(10_000, 100_000, 500_000)):
+    # window width change with wrapping on: the synchronous part only wraps the visible
+    # lines, the rest is filled in slices like CustomEditor.poll_layout does
+    print(f"{'lines':>10} {'resize ms':>10} {'fill ms':>10} {'slices':>8}")
+    for line_count in line_counts:
+        ctx = make_context(("lorem ipsum dolor sit amet " * 4 + "\n") * line_count)
+        ctx.layout.update_width()
+        while ctx.layout.pending():
+            ctx.layout.fill()
+        ctx.canvas.width = 300
+        start = time.perf_counter()
+        ctx.layout.update_width()
+        ctx.scroll.calculate_visible_lines()
+        resize_time = time.perf_counter() - start
+        slices = 0
+        start = time.perf_counter()
+        while ctx.layout.pending():
+            ctx.layout.fill()
+            slices += 1
+        fill_time = time.perf_counter() - start
+        print(f"{line_count:>10} {resize_time * 1000:>10.2f} {fill_time * 1000:>10.2f} {slices:>8}")
+
+
+PYTHON_SOURCE = '''class Point:
+    """2d point"""
+
+    def __init__(self, x=0, y=0):
+        self.x = x  # horizontal
+        self.y = y
+
+    def scale(self, factor: float):
+        return Point(self.x * factor, self.y * 1.5e3)
+
+
+'''
+
+
+def percentile(times: list, fraction: float) -> float:
+    times = sorted(times)
+    return times[min(len(times) - 1, int(len(times) * fraction))]
+
+
+def bench_keystroke(line_count=100_000, keys=500):
+    # typing into the middle of a highlighted python file, each key is timed from the
+    # edit to the end of the synchronous re-lex, the rest is left to Highlighter.run slices
+    lines = PYTHON_SOURCE.count("\n")
+    ctx = make_context(PYTHON_SOURCE * (line_count // lines))
+    start = time.perf_counter()
+    ctx.highlighter.set_language("bench.py")
+    while not ctx.highlighter.run(0.01):
+        pass
+    print(f"initial lex of {ctx.document.get_line_number()} lines: {(time.perf_counter() - start) * 1000:.0f} ms")
+    print(f"{'typing':>22} {'mean ms':>10} {'p99 ms':>10} {'relex left ms':>14}")
+    middle = ctx.document.get_line_number() // 2
+    for name, text in (("plain characters", "value = 1 "), ("opening a string", '"""')):
+        ctx.document.move_cursor_to(ctx.document.storage.line_start(middle - middle % lines + 4) + 8)
+        times = []
+        # an odd number of quote triples leaves the string open down to the end of the file
+        for i in range(keys - keys % (2 * len(text)) + len(text)):
+            key = text[i % len(text)]
+            times.append(timed(lambda: ctx.document.insert_str(key)))
+        start = time.perf_counter()
+        while not ctx.highlighter.run(0.01):
+            pass
+        left = time.perf_counter() - start
+        print(f"{name:>22} {sum(times) / len(times) * 1000:>10.3f} {percentile(times, 0.99) * 1000:>10.3f} {left * 1000:>14.1f}")
+
+
+def bench_find_replace(match_counts=(10_000, 100_000, 1_000_000)):
+    # find runs inline without an executor, first hit is the time to the first reported batch,
+    # replace all and its undo are one bulk edit each, both include the inline re-scan that
+    # keeps the open search's index current after a million-edit change
+    print(f"{'matches':>10} {'first hit ms':>13} {'find ms':>10} {'replace ms':>11} {'undo ms':>10}")
+    for count in match_counts:
+        ctx = make_context("the needle in the haystack\n" * count)
+        document = ctx.document
+        found = []
+        start = time.perf_counter()
+        search = document.find("needle", on_found=lambda: found.append(time.perf_counter()))
+        find_time = time.perf_counter() - start
+        assert len(search.index) == count
+        first_hit = found[0] - start
+        replace_time = timed(lambda: document.replace_all("pin"))
+        undo_time = timed(ctx.command_manager.undo)
+        print(f"{count:>10} {first_hit * 1000:>13.2f} {find_time * 1000:>10.2f} {replace_time * 1000:>11.2f} {undo_time * 1000:>10.2f}")
+
+
+def bench_multi_cursor(cursor_counts=(100, 1_000, 10_000), keys=20):
+    # typing and backspace at a cursor on every line of a block selection,
+    # each key is one batched edit
+    print(f"{'cursors':>10} {'type ms':>10} {'backspace ms':>13} {'undo ms':>10}")
+    for count in cursor_counts:
+        ctx = make_context("".join(f"value_{i} = compute({i})\n" for i in range(count + 1000)))
+        document = ctx.document
+        storage = document.storage
+        document.select_block(storage.line_start(500), storage.line_start(500 + count - 1) + 5)
+        type_times = [timed(lambda: document.insert_str("x")) for _ in range(keys)]
+        delete_times = [timed(document.delete) for _ in range(keys)]
+        undo_time = timed(ctx.command_manager.undo)
+        print(f"{count:>10} {sum(type_times) / keys * 1000:>10.2f} {sum(delete_times) / keys * 1000:>13.2f} {undo_time * 1000:>10.2f}")
+
+
+def bench_minimap(line_counts=(10_000, 100_000, 1_000_000), keys=200):
+    # counting the summary of a new document in slices like CustomEditor.poll_summary,
+    # then typing and enter in the middle, and the bars of a 1000 pixel high minimap
+    print(f"{'lines':>10} {'fill ms':>10} {'blocks':>8} {'type ms':>10} {'enter ms':>10} {'bars ms':>10}")
+    for line_count in line_counts:
+        ctx = make_context("".join("    " * (i % 3) + "value = compute(x)\n" for i in range(line_count)))
+        summary = ctx.summary
+        start = time.perf_counter()
+        while not summary.fill():
+            pass
+        fill_time = time.perf_counter() - start
+        document = ctx.document
+        document.move_cursor_to(document.storage.line_start(line_count // 2))
+        type_time = timed(lambda: [document.insert_str("x") for _ in range(keys)]) / keys
+        enter_time = timed(lambda: [document.insert_str("\n") for _ in range(keys)]) / keys
+        bars_time = timed(lambda: summary.bars(1000, min(2, 1000 / summary.line_count()), 80))
+        print(f"{line_count:>10} {fill_time * 1000:>10.2f} {len(summary.lines):>8} {type_time * 1000:>10.3f} {enter_time * 1000:>10.3f} {bars_time * 1000:>10.2f}")
+
+
+def bench_edits(line_counts=DOCUMENT_SIZES, keys=1000):
+    # per operation in the middle of the document: typing, backspace, pasting 10 kB and
+    # undoing the paste, edits go through the command manager like keys do
+    print(f"{'lines':>10} {'insert us':>10} {'delete us':>10} {'paste ms':>10} {'undo ms':>10}")
+    payload = make_payload(10_000)
+    for line_count in line_counts:
+        ctx = make_context(make_lines(line_count))
+        document = ctx.document
+        document.move_cursor_to(document.storage.line_start(line_count // 2) + 4)
+        insert_time = timed(lambda: [document.insert_str("x") for _ in range(keys)]) / keys
+        delete_time = timed(lambda: [document.delete() for _ in range(keys)]) / keys
+        ctx.clipboard.copy(payload)
+        paste_times, undo_times = [], []
+        for _ in range(5):
+            paste_times.append(timed(document.paste_text))
+            undo_times.append(timed(ctx.command_manager.undo))
+        print(f"{line_count:>10} {insert_time * 1e6:>10.2f} {delete_time * 1e6:>10.2f} {min(paste_times) * 1000:>10.3f} {min(undo_times) * 1000:>10.3f}")
+
+
+def bench_view(line_counts=DOCUMENT_SIZES, calls=1000):
+    # visible line computation after a scroll and mouse position -> offset, at spread out positions
+    print(f"{'lines':>10} {'visible lines us':>17} {'coords -> offset us':>20}")
+    for line_count in line_counts:
+        ctx = make_context(make_lines(line_count))
+        scroll, document = ctx.scroll, ctx.document
+        height = ctx.layout.total_height()
+        rng = random.Random(0)
+        positions = [rng.randrange(height) for _ in range(calls)]
+        def visible_lines():
+            for y in positions:
+                scroll.scroll_y = y
+                scroll.calculate_visible_lines()
+        def coords_to_offset():
+            for y in positions:
+                document.coords_to_offset(rng.randrange(400), y)
+        visible_time = best_of(visible_lines) / calls
+        coords_time = best_of(coords_to_offset) / calls
+        print(f"{line_count:>10} {visible_time * 1e6:>17.2f} {coords_time * 1e6:>20.2f}")
+
+
+def frame_calls(ctx: EditorContext, action) -> int:
+    # canvas calls of the frame painted after action
+    action()
+    ctx.canvas.calls.clear()
+    ctx.renderer.update()
+    return ctx.canvas.total_calls()
+
+
+def bench_render_calls(line_counts=DOCUMENT_SIZES):
+    # Tcl calls per painted frame, a 400 pixel high view shows 20 lines
+    actions = ("first paint", "key", "enter", "line scroll", "page scroll", "drag")
+    print(f"{'lines':>10}" + "".join(f" {name:>12}" for name in actions))
+    for line_count in line_counts:
+        ctx = make_context(make_lines(line_count))
+        document, scroll, renderer = ctx.document, ctx.scroll, ctx.renderer
+        scroll.smooth = False
+        scroll.move_scroll(ctx.layout.line_top(line_count // 2))
+        document.move_cursor_to(document.storage.line_start(line_count // 2 + 5) + 4)
+        def first_paint():
+            ctx.canvas.calls.clear()
+            renderer.render()
+            return ctx.canvas.total_calls()
+        def drag():
+            document.set_selection(200, 300)
+            return frame_calls(ctx, lambda: document.set_selection(200, 320))
+        counts = [
+            first_paint(),
+            frame_calls(ctx, lambda: document.insert_str("x")),
+            frame_calls(ctx, lambda: document.insert_str("\n")),
+            frame_calls(ctx, lambda: scroll.scroll_by(renderer.line_height)),
+            frame_calls(ctx, lambda: scroll.scroll_by(ctx.canvas.height)),
+            drag(),
+        ]
+        print(f"{line_count:>10}" + "".join(f" {count:>12}" for count in counts))
+
+
+def bench_profiler(line_count=100_000, keys=2000):
+    # a typed key and its frame with the profiler off, with stage timing and with cProfile
+    print(f"{'profiler':>14} {'key + frame us':>15}")
+    for name, options in (("off", None), ("stages", {}), ("cProfile", {"python_profile": True})):
+        ctx = make_context(make_lines(line_count))
+        document, renderer = ctx.document, ctx.renderer
+        document.move_cursor_to(document.storage.line_start(line_count // 2))
+        renderer.render()
+        if options is not None:
+            ctx.profiler.enable(overlay=False, **options)
+        def typing():
+            for _ in range(keys):
+                document.insert_str("x")
+                renderer.update()
+                if ctx.profiler.enabled:
+                    ctx.profiler.end_frame(time.perf_counter(), None)
+        key_time = best_of(typing, 3) / keys
+        ctx.profiler.disable()
+        print(f"{name:>14} {key_time * 1e6:>15.2f}")
+
+
+def bench_enter(line_counts=(1_000, 10_000, 100_000, 1_000_000), keys=500):
+    # Return in the middle of a line, timed from the key to the end of the repainted frame,
+    # then undoing all of them, every Enter is its own undo step
+    print(f"{'lines':>10} {'enter mean us':>14} {'enter p99 us':>13} {'calls/frame':>12} {'undo us':>10}")
+    for line_count in line_counts:
+        ctx = make_context(make_lines(line_count))
+        document, renderer = ctx.document, ctx.renderer
+        document.move_cursor_to(document.storage.line_start(line_count // 2) + 8)
+        renderer.render()
+        times, calls = [], 0
+        for _ in range(keys):
+            ctx.canvas.calls.clear()
+            times.append(timed(lambda: (document.newline(), renderer.update())))
+            calls += ctx.canvas.total_calls()
+        undo_time = timed(lambda: [ctx.command_manager.undo() for _ in range(keys)]) / keys
+        print(f"{line_count:>10} {sum(times) / keys * 1e6:>14.2f} {percentile(times, 0.99) * 1e6:>13.2f} {calls / keys:>12.1f} {undo_time * 1e6:>10.2f}")
+
+
+def bench_buffers(file_count=200, line_count=5_000, switches=200):
+    # opening many files in background buffers, then switching between them: the first
+    # time a buffer is shown its views are built, after that they come from the cache,
+    # unless the memory budget evicted them
+    print(f"{'files':>6} {'open ms/file':>13} {'first show ms':>14} {'cached ms':>10} {'evicted ms':>11} {'calls/switch':>13}")
+    with tempfile.TemporaryDirectory() as directory:
+        paths = []
+        for index in range(file_count):
+            paths.append(os.path.join(directory, f"module_{index}.py"))
+            with open(paths[-1], "w") as f:
+                f.write(f"# module {index}\n" + make_lines(line_count))
+        ctx = make_context(make_lines(100))
+        buffers, renderer = ctx.buffers, ctx.renderer
+        renderer.render()
+        open_time = timed(lambda: [buffers.open(path) for path in paths]) / file_count
+        opened = buffers.buffers[1:]
+        def show(buffer):
+            buffers.activate(buffer)
+            renderer.render()
+        first_time = timed(lambda: [show(buffer) for buffer in opened[:switches]]) / min(switches, file_count)
+        # a few buffers in turn, all of them cached
+        recent = opened[:4]
+        calls = 0
+        start = time.perf_counter()
+        for index in range(switches):
+            ctx.canvas.calls.clear()
+            show(recent[index % len(recent)])
+            calls += ctx.canvas.total_calls()
+        cached_time = (time.perf_counter() - start) / switches
+        buffers.memory_budget = 0
+        evicted_time = timed(lambda: [show(recent[index % len(recent)]) for index in range(switches)]) / switches
+        buffers.close_all()
+        print(f"{file_count:>6} {open_time * 1000:>13.3f} {first_time * 1000:>14.2f} {cached_time * 1000:>10.2f} {evicted_time * 1000:>11.2f} {calls / switches:>13.1f}")
+
+
+def bench_glyphs(line_count=100_000, calls=1000):
+    # cursor frames and mouse hit testing on ascii rows and on rows with tabs and wide
+    # characters, font.measure calls are counted from the first paint on
+    print(f"{'rows':>6} {'cursor frame us':>16} {'hit test us':>12} {'measures':>9}")
+    rows = (
+        ("ascii", "    value = compute(value, 42) # note on the value"),
+        ("wide", "\tvalue = 計算(値, 42)\t# 値についての注釈 😀"),
+    )
+    for name, line in rows:
+        ctx = make_context((line + "\n") * line_count)
+        document, renderer = ctx.document, ctx.renderer
+        ctx.scroll.smooth = False
+        ctx.scroll.move_scroll(ctx.layout.line_top(line_count // 2))
+        document.move_cursor_to(document.storage.line_start(line_count // 2 + 5))
+        renderer.editor_font.measure_calls = 0
+        renderer.render()
+        def cursor_frames():
+            for index in range(calls):
+                document.move_cursor(Direction.RIGHT if index % 80 < 40 else Direction.LEFT)
+                renderer.update()
+        rng = random.Random(4)
+        clicks = [(rng.randrange(ctx.canvas.width), rng.randrange(ctx.canvas.height)) for _ in range(calls)]
+        def hit_tests():
+            for x, y in clicks:
+                document.screen_coords_to_offset(x, y)
+        cursor_time = best_of(cursor_frames, 3) / calls
+        hit_time = best_of(hit_tests, 3) / calls
+        print(f"{name:>6} {cursor_time * 1e6:>16.2f} {hit_time * 1e6:>12.2f} {renderer.editor_font.measure_calls:>9}")
+
+
+def bench_clipboard(sizes=(1_000_000, 10_000_000, 50_000_000)):
+    # select all and copy, then paste into another document a chunk per step: the
+    # longest step is what a frame waits for, cancel takes a half done paste out again
+    print(f"{'chars':>10} {'copy ms':>8} {'join ms':>8} {'paste ms':>9} {'max step ms':>12} {'undo ms':>8} {'cancel ms':>10}")
+    for size in sizes:
+        source = make_context(make_payload(size))
+        document = source.document
+        document.select_range(0, len(document.storage))
+        copy_time = timed(document.copy_text)
+        join_time = timed(lambda: source.clipboard.paste().text()) # what copying the text itself costs
+        target = make_context("sample\n" * 100)
+        target.clipboard = source.clipboard
+        steps = []
+        def paste_steps():
+            transfer = target.document.paste_text()
+            while not transfer.finished:
+                steps.append(timed(transfer.step))
+        paste_time = timed(paste_steps)
+        undo_time = timed(target.command_manager.undo)
+        transfer = target.document.paste_text()
+        transfer.run(paste_time / 2)
+        cancel_time = timed(transfer.cancel)
+        print(f"{size:>10} {copy_time * 1000:>8.3f} {join_time * 1000:>8.1f} {paste_time * 1000:>9.1f} {max(steps) * 1000:>12.2f} {undo_time * 1000:>8.2f} {cancel_time * 1000:>10.2f}")
+
+
+BENCHMARKS = {
+    "edits": bench_edits,
+    "view": bench_view,
+    "render_calls": bench_render_calls,
+    "enter": bench_enter,
+    "paste_undo": bench_paste_undo,
+    "journal_replay": bench_journal_replay,
+    "resize": bench_resize,
+    "keystroke": bench_keystroke,
+    "find_replace": bench_find_replace,
+    "multi_cursor": bench_multi_cursor,
+    "minimap": bench_minimap,
+    "profiler": bench_profiler,
+    "buffers": bench_buffers,
+    "glyphs": bench_glyphs,
+    "clipboard": bench_clipboard,
+}
+
+
+if __name__ == "__main__":
+    for name in sys.argv[1:] or BENCHMARKS:
+        print(f"--- {name} ---")
+        BENCHMARKS[name]()
@@ -0,0 +1,194 @@
+from __future__ import annotations
+import os
+
+from journal import EditJournal
+
+
+# open documents (tabs) of one editor window
+#
+# the renderer, scroll manager, fonts and canvas items are shared, each buffer brings
+# its own text, cursors, undo history and journal, a background buffer keeps only those
+# plus its scroll offset and, until they are evicted, the views it was shown with
+# (layout, highlighter states, minimap summary)
+#
+# switching swaps the buffer's components into the EditorContext, views that were
+# evicted or never built start empty and are filled like for a newly opened file,
+# the renderer then repaints the drawn band from the same canvas items
+
+class Buffer:
+    def __init__(self, document: DocumentModel, command_manager: CommandManager):
+        self.document = document
+        self.command_manager = command_manager
+        self.journal = None # EditJournal, started on the first activation
+        self.scroll_y = 0
+        self.views = None # (layout, highlighter, summary) while cached
+        self.last_used = 0 # activation counter, for eviction
+        self.saved_path = None # a background save finished while the buffer was inactive
+
+    def name(self) -> str:
+        path = self.document.file_path
+        return os.path.basename(path) if path is not None else "untitled"
+
+    def cache_size(self) -> int:
+        # rough memory use of the views in bytes
+        if self.views is None:
+            return 0
+        return sum(view.size() for view in self.views)
+
+
+class BufferManager:
+    memory_budget = 32 * 1024 * 1024 # views of background buffers, roughly bytes
+
+    def __init__(self, ctx: EditorContext, create_document, create_views):
+        # create_document() -> (DocumentModel, CommandManager), create_views() -> (layout, highlighter, summary)
+        self.ctx = ctx
+        self.create_document = create_document
+        self.create_views = create_views
+        self.buffers = []
+        self.active = None
+        self.clock = 0
+        self.journals = False # journal buffers while they are active, set by the window
+
+    def new(self) -> Buffer:
+        # empty untitled buffer at the end, not activated
+        buffer = Buffer(*self.create_document())
+        self.buffers.append(buffer)
+        return buffer
+
+    def find(self, path: str) -> Buffer | None:
+        path = os.path.abspath(path)
+        for buffer in self.buffers:
+            if buffer.document.file_path is not None and os.path.abspath(buffer.document.file_path) == path:
+                return buffer
+        return None
+
+    def open(self, path: str) -> Buffer:
+        # the file is mapped and indexed in the background like any opened file, nothing
+        # else is built until the buffer is activated, an open file gives its buffer back
+        buffer = self.find(path)
+        if buffer is not None:
+            return buffer
+        buffer = self.new()
+        document = buffer.document
+        document.file_path = path
+        document.storage = document.storage_class.from_file(path, document.encoding, executor=self.ctx.executor)
+        document.trailing_line() # no observers yet, nothing is notified
+        return buffer
+
+    def activate(self, buffer: Buffer):
+        ctx = self.ctx
+        if buffer is self.active:
+            return
+        if self.active is not None:
+            self.deactivate(self.active)
+        self.active = buffer
+        self.clock += 1
+        buffer.last_used = self.clock
+        document = buffer.document
+        ctx.document = document
+        ctx.command_manager = buffer.command_manager
+        fresh = buffer.views is None
+        if fresh:
+            buffer.views = self.create_views()
+        ctx.layout, ctx.highlighter, ctx.summary = buffer.views
+        # layout first, anything after it may read line positions
+        document.observers = [
+            ctx.layout.on_document_change,
+            ctx.highlighter.on_document_change,
+            ctx.renderer.on_document_change,
+            ctx.summary.on_document_change,
+        ]
+        ctx.layout.update_width() # the canvas may have been resized meanwhile
+        if fresh:
+            document.announce()
+            ctx.highlighter.set_language(document.file_path)
+        ctx.scroll.stop()
+        ctx.scroll.set_scroll(buffer.scroll_y)
+        document.load_more() # text the background loading indexed meanwhile
+        ctx.journal = self.start_journal(buffer)
+        if buffer.saved_path is not None:
+            path, buffer.saved_path = buffer.saved_path, None
+            self.saved(buffer, path)
+        ctx.profiler.rewrap()
+        self.evict()
+
+    def deactivate(self, buffer: Buffer):
+        # only the compact state stays with the buffer, the search index is dropped
+        document = buffer.document
+        buffer.scroll_y = self.ctx.scroll.scroll_y
+        document.observers = []
+        if document.search is not None:
+            document.search.cancel()
+            document.search = None
+        if buffer.journal is not None:
+            buffer.journal.suspend()
+
+    def start_journal(self, buffer: Buffer):
+        # untitled buffers share one journal file, only one of them is journaled
+        if not self.journals:
+            return None
+        if buffer.journal is not None:
+            buffer.journal.resume()
+            return buffer.journal
+        if buffer.document.file_path is None:
+            untitled = EditJournal.journal_path(None)
+            if any(other.journal is not None and other.journal.path == untitled for other in self.buffers):
+                return None
+        journal = buffer.journal = EditJournal(self.ctx)
+        buffer.command_manager.add_observer(journal.on_command)
+        journal.attach(buffer.document.file_path) # may replay edits into the now active document
+        return journal
+
+    def saved(self, buffer: Buffer, path: str):
+        # a background save of buffer finished, an inactive buffer catches up when activated
+        if buffer is not self.active:
+            buffer.saved_path = path
+            return
+        self.ctx.highlighter.set_language(path)
+        if buffer.journal is not None:
+            buffer.journal.saved(path)
+        else:
+            self.ctx.journal = self.start_journal(buffer)
+
+    def evict(self):
+        # views of background buffers, least recently used first, until they fit the budget
+        cached = sorted((buffer for buffer in self.buffers if buffer.views is not None and buffer is not self.active),
+                        key=lambda buffer: buffer.last_used)
+        used = sum(buffer.cache_size() for buffer in cached)
+        for buffer in cached:
+            if used <= self.memory_budget:
+                break
+            used -= buffer.cache_size()
+            buffer.views = None
+
+    def step(self, offset: int) -> Buffer:
+        # buffer offset places after the active one, wrapping around
+        index = self.buffers.index(self.active)
+        return self.buffers[(index + offset) % len(self.buffers)]
+
+    def close(self, buffer: Buffer):
+        # a running save is finished, the journal flushed and the file closed, the neighbour
+        # becomes active, an empty untitled buffer replaces the last one
+        document = buffer.document
+        if document.save_task is not None and self.ctx.executor is not None:
+            self.ctx.executor.wait(document.save_task)
+        document.storage.stop_loading()
+        if document.paste_transfer is not None:
+            document.paste_transfer.cancel()
+        index = self.buffers.index(buffer)
+        if buffer is self.active:
+            self.activate(self.buffers[index + 1] if index + 1 < len(self.buffers) else self.buffers[index - 1] if index else self.new())
+        if buffer.journal is not None:
+            buffer.journal.close()
+        document.storage.close()
+        self.buffers.remove(buffer)
+
+    def close_all(self):
+        for buffer in self.buffers:
+            if buffer.document.save_task is not None and self.ctx.executor is not None:
+                self.ctx.executor.wait(buffer.document.save_task)
+            buffer.document.storage.stop_loading()
+        for buffer in self.buffers:
+            if buffer.journal is not None:
+                buffer.journal.close()
+            buffer.document.storage.close()
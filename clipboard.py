@@ -0,0 +1,224 @@
+from __future__ import annotations
+import time
+import tkinter as tk
+
+from commands import InsertCommand, CompoundCommand
+
+
+# copy and paste
+#
+# a copy keeps the selected ranges of a storage snapshot (O(1), see PieceTable.snapshot)
+# instead of their text, the text is read a chunk at a time when something needs it:
+# the system clipboard is filled by one clipboard_append per chunk over several frames
+# and pasting the editor's own copy reads the snapshot directly
+#
+# a big paste is inserted a chunk per step by PasteTransfer, the window runs the steps of
+# running transfers in slices between frames and shows their progress, Escape cancels
+
+CHUNK_SIZE = 1 << 18 # characters read, appended or inserted per step
+
+
+class ClipboardContent:
+    # ranges of a snapshot joined by separator, like copy_text joins several selections
+    def __init__(self, storage: TextStorage, ranges: list, separator: str = "\n"):
+        self.storage = storage
+        self.ranges = ranges # (start, end), sorted
+        self.separator = separator
+        self.length = sum(end - start for start, end in ranges) + len(separator) * max(0, len(ranges) - 1)
+
+    def __len__(self):
+        return self.length
+
+    def chunks(self, size: int = CHUNK_SIZE):
+        # the text in pieces of size characters, the last one shorter
+        parts, length = [], 0
+        for index, (start, end) in enumerate(self.ranges):
+            if index:
+                parts.append(self.separator)
+                length += len(self.separator)
+            while start < end or length >= size:
+                if length >= size:
+                    text = "".join(parts)
+                    yield text[:size]
+                    parts, length = [text[size:]], length - size
+                    continue
+                take = min(end - start, size - length)
+                parts.append(self.storage.text(start, start + take))
+                length += take
+                start += take
+        if length:
+            yield "".join(parts)
+
+    def text(self) -> str:
+        return "".join(self.chunks())
+
+
+def content_chunks(content, size: int = CHUNK_SIZE):
+    # chunks of a ClipboardContent or a plain string from the system clipboard
+    if isinstance(content, str):
+        return (content[start:start + size] for start in range(0, len(content), size))
+    return content.chunks(size)
+
+def content_text(content) -> str:
+    return content if isinstance(content, str) else content.text()
+
+
+class LocalClipboard:
+    # stand-in for the system clipboard, used by headless contexts and benchmarks,
+    # a copy is kept as it was given, spans stay spans
+    def __init__(self):
+        self.content = None
+
+    def copy(self, content):
+        # returns the transfer still to run, none here
+        self.content = content
+        return None
+
+    def paste(self):
+        return self.content
+
+
+class ClipboardService:
+    # the system clipboard of the window's Tk instance
+    def __init__(self, root):
+        self.root = root
+        self.content = None # last copy, pasted from its spans while the clipboard is still ours
+
+    def copy(self, content):
+        self.root.clipboard_clear()
+        self.content = content
+        if isinstance(content, str):
+            self.root.clipboard_append(content)
+            return None
+        return CopyTransfer(self, content)
+
+    def owned(self) -> bool:
+        # no other application copied anything since our last copy
+        try:
+            return self.root.selection_own_get(selection="CLIPBOARD") is not None
+        except (tk.TclError, KeyError):
+            return False
+
+    def paste(self):
+        # Tk hands out the clipboard of another application in one piece only
+        if self.content is not None and self.owned():
+            return self.content
+        self.content = None
+        try:
+            return self.root.clipboard_get()
+        except tk.TclError:
+            return None
+
+
+# --- transfers ---
+
+class Transfer:
+    # a copy or paste done a chunk per step, run() does steps for up to a time budget
+    label = "transfer"
+
+    def __init__(self, total: int):
+        self.total = total # characters
+        self.done = 0
+        self.finished = False
+        self.cancelled = False
+
+    def ready(self) -> bool:
+        # whether steps can run now
+        return not self.finished
+
+    def progress(self) -> float:
+        return self.done / self.total if self.total else 1.0
+
+    def step(self):
+        # one chunk, sets finished after the last one
+        self.finished = True
+
+    def run(self, budget: float = 0.008) -> bool:
+        # returns True once finished or cancelled
+        deadline = time.perf_counter() + budget
+        while not self.finished:
+            self.step()
+            if time.perf_counter() >= deadline:
+                break
+        return self.finished
+
+    def finish(self):
+        # the rest at once, e.g. headless or before the window closes
+        while not self.finished:
+            self.step()
+
+    def cancel(self):
+        self.finished = self.cancelled = True
+
+
+class CopyTransfer(Transfer):
+    # the system clipboard filled one clipboard_append per chunk, the clipboard is
+    # already ours and emptied when the copy starts
+    label = "copying"
+
+    def __init__(self, service: ClipboardService, content: ClipboardContent):
+        super().__init__(len(content))
+        self.service = service
+        self.content = content
+        self.chunks = content.chunks()
+
+    def step(self):
+        chunk = next(self.chunks, None)
+        if chunk is None:
+            self.finished = True
+            return
+        self.service.root.clipboard_append(chunk)
+        self.done += len(chunk)
+
+    def cancel(self):
+        # the clipboard stays ours but empty, a paste must not bring the copy back
+        self.service.root.clipboard_clear()
+        if self.service.content is self.content:
+            self.service.content = None
+        super().cancel()
+
+
+class PasteTransfer(Transfer):
+    # content inserted at the cursor of the document a chunk per step, the selection it
+    # replaces goes first, the paste becomes one undo step (and one journal record) when the
+    # last chunk is in, cancel() takes the inserted part out again
+    #
+    # steps only run while the document is shown, the input manager keeps other edits out
+    # while document.paste_transfer is set
+    label = "pasting"
+
+    def __init__(self, document: DocumentModel, content):
+        super().__init__(len(content))
+        self.document = document
+        self.chunks = content_chunks(content)
+        self.commands = []
+        if not document.selection.empty():
+            delete = document.selection_delete_command()
+            document.clear_selection()
+            delete.execute(document)
+            self.commands.append(delete)
+        self.offset = document.selection.active
+
+    def ready(self) -> bool:
+        return not self.finished and self.document is self.document.ctx.document
+
+    def step(self):
+        chunk = next(self.chunks, None)
+        if chunk is None:
+            self.finished = True
+            self.document.paste_transfer = None
+            self.document.ctx.command_manager.record(CompoundCommand(self.commands))
+            return
+        command = InsertCommand(self.offset, chunk)
+        command.execute(self.document)
+        self.commands.append(command)
+        self.offset += len(chunk)
+        self.done += len(chunk)
+
+    def cancel(self):
+        CompoundCommand(self.commands).undo(self.document)
+        self.document.paste_transfer = None
+        super().cancel()
+        journal = self.document.ctx.journal
+        if journal is not None and journal.compact_pending and self.document is self.document.ctx.document:
+            journal.compact() # a save during the paste left its snapshot for now
@@ -0,0 +1,239 @@
+from __future__ import annotations
+from array import array
+from collections import deque
+from itertools import accumulate
+from operator import add, ne, sub
+
+
+# undoable edits and the undo / redo history
+# (DocumentModel and EditorContext live in main.py)
+
+class Command:
+    # for commander pattern
+    # must support execute/undo for each command
+    # commands only keep offsets and the changed text, the document is passed in
+    __slots__ = ()
+    
+    def execute(self, doc: DocumentModel):
+        pass
+
+    def undo(self, doc: DocumentModel):
+        pass
+    
+    def size(self):
+        # rough memory use, counted against the history budget
+        return 64
+    
+    def merge(self, command: Command):
+        # absorb the next command into this one, for coalescing typing
+        return False
+    
+class InsertCommand(Command):
+    __slots__ = ("offset", "text")
+    
+    def __init__(self, offset: int, text: str):
+        self.offset = offset
+        self.text = text
+        
+    def execute(self, doc: DocumentModel):
+        doc.insert_text(self.offset, self.text)
+        
+    def undo(self, doc: DocumentModel):
+        doc.delete_range(self.offset, self.offset + len(self.text))
+    
+    def size(self):
+        return 64 + len(self.text)
+    
+    def merge(self, command: Command):
+        # typing one character right after this insert
+        if type(command) is InsertCommand and len(command.text) == 1 and command.offset == self.offset + len(self.text):
+            self.text += command.text
+            return True
+        return False
+
+class DeleteCommand(Command):
+    __slots__ = ("offset", "text")
+    
+    def __init__(self, offset: int, text: str):
+        self.offset = offset
+        self.text = text # deleted text, needed to undo
+        
+    def execute(self, doc: DocumentModel):
+        doc.delete_range(self.offset, self.offset + len(self.text))
+        
+    def undo(self, doc: DocumentModel):
+        doc.insert_text(self.offset, self.text)
+    
+    def size(self):
+        return 64 + len(self.text)
+    
+    def merge(self, command: Command):
+        if type(command) is not DeleteCommand or len(command.text) != 1:
+            return False
+        if command.offset + 1 == self.offset: # backspace
+            self.offset = command.offset
+            self.text = command.text + self.text
+            return True
+        if command.offset == self.offset: # delete key
+            self.text += command.text
+            return True
+        return False
+
+class SplitLineCommand(InsertCommand):
+    # Return: a newline at offset, its own undo step instead of merging with typing,
+    # the journal stores it like any insert
+    __slots__ = ()
+    
+    def __init__(self, offset: int):
+        super().__init__(offset, "\n")
+    
+    def execute(self, doc: DocumentModel):
+        doc.split_line(self.offset)
+    
+    def undo(self, doc: DocumentModel):
+        doc.join_lines(doc.storage.offset_to_position(self.offset)[0])
+    
+    def merge(self, command: Command):
+        return False
+
+class JoinLinesCommand(DeleteCommand):
+    # backspace at the start of a line: the newline at offset goes, its own undo step
+    __slots__ = ()
+    
+    def __init__(self, offset: int):
+        super().__init__(offset, "\n")
+    
+    def execute(self, doc: DocumentModel):
+        doc.join_lines(doc.storage.offset_to_position(self.offset)[0])
+    
+    def undo(self, doc: DocumentModel):
+        doc.split_line(self.offset)
+    
+    def merge(self, command: Command):
+        return False
+
+class CompoundCommand(Command):
+    # several commands undone as one, e.g. typing over a selection
+    __slots__ = ("commands",)
+    
+    def __init__(self, commands: list):
+        self.commands = commands
+    
+    def execute(self, doc: DocumentModel):
+        for command in self.commands:
+            command.execute(doc)
+    
+    def undo(self, doc: DocumentModel):
+        for command in reversed(self.commands):
+            command.undo(doc)
+    
+    def size(self):
+        return 64 + sum(command.size() for command in self.commands)
+
+class ReplaceAllCommand(Command):
+    # many replacements applied as one storage edit, e.g. replace all matches of a search
+    # or typing at several cursors, offsets are in the text before the command,
+    # equal strings are stored once
+    __slots__ = ("offsets", "old_texts", "new_texts", "text_size")
+    
+    def __init__(self, offsets, old_texts: list, new_texts: list):
+        self.offsets = array("q", offsets)
+        shared = {}
+        self.old_texts = [shared.setdefault(text, text) for text in old_texts]
+        self.new_texts = [shared.setdefault(text, text) for text in new_texts]
+        self.text_size = sum(map(len, shared))
+    
+    def execute(self, doc: DocumentModel):
+        ends = map(add, self.offsets, map(len, self.old_texts))
+        doc.apply_edits(list(zip(self.offsets, ends, self.new_texts)))
+    
+    def undo(self, doc: DocumentModel):
+        # the same edits the other way round, offsets moved by the replacements before them
+        shifts = accumulate(map(sub, map(len, self.new_texts), map(len, self.old_texts)), initial=0)
+        starts = list(map(add, self.offsets, shifts))
+        ends = map(add, starts, map(len, self.new_texts))
+        doc.apply_edits(list(zip(starts, ends, self.old_texts)))
+    
+    def size(self):
+        return 64 + 24 * len(self.offsets) + self.text_size
+    
+    def merge(self, command: Command):
+        # typing one more character at every cursor, right after the text this command put there
+        if (type(command) is not ReplaceAllCommand or len(command.offsets) != len(self.offsets)
+                or any(command.old_texts) or any(len(text) != 1 for text in command.new_texts)):
+            return False
+        shifts = accumulate(map(sub, map(len, self.new_texts), map(len, self.old_texts)), initial=0)
+        ends = map(add, map(add, self.offsets, shifts), map(len, self.new_texts))
+        if any(map(ne, ends, command.offsets)):
+            return False
+        self.new_texts = list(map(add, self.new_texts, command.new_texts))
+        self.text_size += len(command.new_texts)
+        return True
+
+class CommandManager:
+    def __init__(self, ctx: EditorContext, memory_budget: int = 8 * 1024 * 1024):
+        self.ctx = ctx
+        self.undo_stack = deque()
+        self.redo_stack = []
+        # oldest history is dropped once undo + redo commands use more than this (roughly bytes)
+        self.memory_budget = memory_budget
+        self.memory_used = 0
+        self.can_merge = False # false after undo/redo so new typing starts a new entry
+        self.observers = [] # callbacks taking ("execute" | "undo" | "redo", command), e.g. the journal
+    
+    def add_observer(self, callback):
+        self.observers.append(callback)
+    
+    def notify(self, action: str, command: Command):
+        for callback in self.observers:
+            callback(action, command)
+        
+    def execute(self, command: Command):
+        command.execute(self.ctx.document)
+        self.record(command)
+    
+    def record(self, command: Command):
+        # a command that is already applied, e.g. a paste inserted over several frames
+        for undone in self.redo_stack:
+            self.memory_used -= undone.size()
+        self.redo_stack.clear()
+        top = self.undo_stack[-1] if self.can_merge and self.undo_stack else None
+        before = top.size() if top is not None else 0
+        if top is not None and top.merge(command):
+            self.memory_used += top.size() - before
+        else:
+            self.undo_stack.append(command)
+            self.memory_used += command.size()
+            self.can_merge = True
+        self.evict()
+        self.notify("execute", command)
+    
+    def evict(self):
+        while self.memory_used > self.memory_budget and len(self.undo_stack) > 1:
+            self.memory_used -= self.undo_stack.popleft().size()
+        
+    def undo(self):
+        if not self.undo_stack:
+            return
+        command = self.undo_stack.pop()
+        command.undo(self.ctx.document)
+        self.redo_stack.append(command)
+        self.can_merge = False
+        self.notify("undo", command)
+    
+    def redo(self):
+        if not self.redo_stack:
+            return
+        command = self.redo_stack.pop()
+        command.execute(self.ctx.document)
+        self.undo_stack.append(command)
+        self.can_merge = False
+        self.notify("redo", command)
+    
+    def restore(self, undo_stack: list, redo_stack: list, can_merge: bool):
+        # replace the whole history, used when a journal snapshot is loaded
+        self.undo_stack = deque(undo_stack)
+        self.redo_stack = list(redo_stack)
+        self.memory_used = sum(command.size() for command in self.undo_stack) + sum(command.size() for command in self.redo_stack)
+        self.can_merge = can_merge
+        self.evict()
@@ -0,0 +1,229 @@
+from __future__ import annotations
+import builtins
+import keyword
+import os
+import re
+import time
+from collections import OrderedDict
+
+
+# syntax highlighting
+#
+# a lexer turns one line plus the state left by the line above into spans
+# (start column, end column, kind) and the state at the end of the line,
+# Highlighter keeps the end state of every line so an edit only re-lexes forward
+# from the edited line until the states match what was there before
+
+UNKNOWN = object() # end state of a line that was not lexed yet
+BLANK = re.compile(r"[^\t]") # tabs stay so masked layers keep their alignment
+
+
+class PythonLexer:
+    # state is None or the quote of a triple quoted string left open
+    TOKEN = re.compile(r"""
+        (?P<comment>\#.*)
+        |(?P<string>(?:[rRbBuUfF]{1,2})?(?:\"\"\"|'''|"(?:[^"\\]|\\.)*"?|'(?:[^'\\]|\\.)*'?))
+        |(?P<number>\b(?:0[xXoObB][0-9a-fA-F_]+|\d[\d_]*\.?\d*(?:[eE][+-]?\d+)?[jJ]?))
+        |(?P<name>[A-Za-z_]\w*)
+    """, re.VERBOSE)
+    KEYWORDS = frozenset(keyword.kwlist + keyword.softkwlist)
+    BUILTINS = frozenset(name for name in dir(builtins) if not name.startswith("_"))
+
+    def lex(self, text: str, state):
+        spans = []
+        position = 0
+        if state is not None:
+            # inside a triple quoted string from the line above
+            end = text.find(state)
+            if end < 0:
+                return [(0, len(text), "string")] if text else [], state
+            position = end + 3
+            spans.append((0, position, "string"))
+            state = None
+        definition = False
+        while True:
+            match = self.TOKEN.search(text, position)
+            if match is None:
+                break
+            kind = match.lastgroup
+            start, position = match.span()
+            if kind == "name":
+                word = match.group()
+                if definition:
+                    spans.append((start, position, "definition"))
+                elif word in self.KEYWORDS:
+                    spans.append((start, position, "keyword"))
+                elif word in self.BUILTINS:
+                    spans.append((start, position, "builtin"))
+                definition = word in ("def", "class")
+                continue
+            definition = False
+            if kind == "string":
+                quote = match.group().lstrip("rRbBuUfF")
+                if quote in ('"""', "'''"):
+                    end = text.find(quote, position)
+                    if end < 0:
+                        spans.append((start, len(text), "string"))
+                        return spans, quote
+                    position = end + 3
+            spans.append((start, position, kind))
+        return spans, state
+
+
+LEXERS = {".py": PythonLexer, ".pyw": PythonLexer}
+
+
+class Highlighter:
+    # document observer, registered before the renderer
+    eager_lines = 200 # lines re-lexed inside the edit callback, the rest goes through run()
+    read_lines = 500 # lines read from storage at once
+    cache_lines = 4096
+
+    def __init__(self, ctx: EditorContext, tables: dict | None = None):
+        self.ctx = ctx
+        # lexer class -> (lexer, span cache), lexers and spans of a line only depend on its text
+        # and start state so the highlighters of several documents can share them
+        self.tables = {} if tables is None else tables
+        self.lexer = None
+        self.states = [] # lexer state at the end of each line, only while a lexer is set
+        self.frontier = None # first line whose start state is not final yet, None when done
+        self.relex_until = -1 # edited lines up to here are lexed even if their state matches
+        self.span_cache = OrderedDict() # (text, start state) -> (spans, end state) of the lexer
+        self.changed = None # (first, last) lines whose colors changed since the last paint
+
+    def set_language(self, path: str | None):
+        # lexer by file extension, plain text has no spans
+        lexer_class = LEXERS.get(os.path.splitext(path or "")[1].lower())
+        if lexer_class is None:
+            self.lexer, self.span_cache = None, OrderedDict()
+        else:
+            if lexer_class not in self.tables:
+                self.tables[lexer_class] = (lexer_class(), OrderedDict())
+            self.lexer, self.span_cache = self.tables[lexer_class]
+        line_count = self.ctx.document.get_line_number()
+        if self.lexer is None:
+            self.states = []
+            self.frontier = None
+        else:
+            self.states = [UNKNOWN] * line_count
+            self.frontier = 0
+            self.relex_until = line_count - 1
+            self.run(lines=self.eager_lines)
+        self.mark_changed(0, line_count - 1)
+
+    def pending(self):
+        return self.frontier is not None
+
+    def size(self) -> int:
+        # rough memory use of the line states in bytes, the shared span cache is not counted
+        return 8 * len(self.states)
+
+    def mark_changed(self, first: int, last: int):
+        if self.changed is None:
+            self.changed = (first, last)
+        else:
+            self.changed = (min(first, self.changed[0]), max(last, self.changed[1]))
+
+    def take_changed(self):
+        changed = self.changed
+        self.changed = None
+        return changed
+
+    def on_document_change(self, change: DocumentChange):
+        if self.lexer is None or change.start_line is None:
+            return
+        start, old_end, new_end = change.start_line, change.old_end_line, change.new_end_line
+        delta = change.line_delta()
+        self.states[start:old_end + 1] = [UNKNOWN] * (new_end - start + 1)
+        # pending work below the edit moves with the lines, lines from the old frontier on
+        # were not lexed with the right start state so the pass must get past it
+        if self.frontier is not None:
+            if self.frontier > old_end:
+                self.frontier += delta
+            if self.relex_until > old_end:
+                self.relex_until += delta
+            self.relex_until = max(self.relex_until, self.frontier, new_end)
+            self.frontier = min(self.frontier, start)
+        else:
+            self.frontier = start
+            self.relex_until = new_end
+        self.run(lines=self.eager_lines)
+
+    def lex(self, text: str, state):
+        # cached for the lines being painted
+        key = (text, state)
+        result = self.span_cache.get(key)
+        if result is not None:
+            self.span_cache.move_to_end(key)
+            return result
+        result = self.lexer.lex(text, state)
+        self.span_cache[key] = result
+        if len(self.span_cache) > self.cache_lines:
+            self.span_cache.popitem(last=False)
+        return result
+
+    def run(self, budget: float | None = None, lines: int | None = None):
+        # lex forward from the frontier until the states converge, or until budget
+        # seconds / lines are used up, returns True when nothing is left
+        if self.frontier is None:
+            return True
+        deadline = None if budget is None else time.perf_counter() + budget
+        storage = self.ctx.document.storage
+        states = self.states
+        line_count = len(states)
+        line = self.frontier
+        state = states[line - 1] if line > 0 else None
+        start_changed = True # colors of a line change with its text or its start state
+        done = 0
+        while True:
+            end = min(line + self.read_lines, line_count)
+            if lines is not None:
+                end = min(end, line + lines - done)
+            texts = storage.text(storage.line_start(line), storage.line_end(end - 1)).split("\n")
+            for text in texts:
+                old_end = states[line]
+                state = self.lexer.lex(text, state)[1]
+                states[line] = state
+                if start_changed or line <= self.relex_until:
+                    self.mark_changed(line, line)
+                start_changed = state != old_end
+                line += 1
+                done += 1
+                if (line > self.relex_until and not start_changed) or line >= line_count:
+                    self.frontier = None
+                    return True
+            if (lines is not None and done >= lines) or (deadline is not None and time.perf_counter() >= deadline):
+                self.frontier = line
+                return False
+
+    def start_state(self, line: int):
+        if line == 0 or self.lexer is None:
+            return None
+        state = self.states[line - 1]
+        # not lexed yet, painted as if no string was open until the lexer gets there
+        return None if state is UNKNOWN else state
+
+    def layers(self, line: int, text: str):
+        # text of the line once per span kind, characters of other kinds blanked out,
+        # "text" holds everything that is not highlighted
+        if self.lexer is None:
+            return {"text": text}
+        spans = self.lex(text, self.start_state(line))[0]
+        if not spans:
+            return {"text": text}
+        segments = []
+        position = 0
+        for start, end, kind in spans:
+            if start > position:
+                segments.append((text[position:start], "text"))
+            segments.append((text[start:end], kind))
+            position = end
+        if position < len(text):
+            segments.append((text[position:], "text"))
+        layers = {}
+        for kind in {kind for _, kind in segments}:
+            layers[kind] = "".join(
+                part if part_kind == kind else (" " * len(part) if "\t" not in part else BLANK.sub(" ", part))
+                for part, part_kind in segments
+            )
+        return layers
@@ -0,0 +1,393 @@
+from __future__ import annotations
+import os
+import queue
+import struct
+import threading
+import time
+from array import array
+
+from commands import Command, InsertCommand, DeleteCommand, SplitLineCommand, JoinLinesCommand, CompoundCommand, ReplaceAllCommand
+from storage import atomic_write
+
+
+# append-only edit journal for crash recovery and reopening with the undo history
+#
+# .<name>.journal      header (stamp of the file it applies to) + length prefixed records,
+#                      a torn record at the end (crash while writing) is ignored
+# .<name>.journal.snap compacted state: the document as pieces of the file plus the history
+#
+# replay = file -> snapshot -> journal records, the journal is compacted into a new
+# snapshot every compact_every records so replay time stays bounded
+
+MAGIC = b"TEJ1"
+HEADER = struct.Struct("<4sqqq") # magic, file size, file mtime_ns, generation
+RECORD = struct.Struct("<I") # payload length
+ACTION = struct.Struct("<B")
+EDIT = struct.Struct("<Bqq") # kind, offset, text byte length (child count for compound, replacement count for replace, 0 for split / join)
+PIECE = struct.Struct("<Bqq") # kind, start, length (text byte length for text pieces)
+COUNT = struct.Struct("<q")
+
+ACTIONS = {"execute": 1, "undo": 2, "redo": 3}
+INSERT, DELETE, COMPOUND, REPLACE, SPLIT, JOIN = 1, 2, 3, 4, 5, 6
+FILE_RANGE, TEXT = 1, 2
+
+
+def encode_command(command: Command, out: list):
+    if type(command) is CompoundCommand:
+        out.append(EDIT.pack(COMPOUND, 0, len(command.commands)))
+        for child in command.commands:
+            encode_command(child, out)
+        return
+    if type(command) is ReplaceAllCommand:
+        # offsets, char lengths of the old and new texts, then both texts joined,
+        # whole arrays at once so a million replacements stay cheap to write
+        old_lengths = array("q", map(len, command.old_texts))
+        new_lengths = array("q", map(len, command.new_texts))
+        old_data = "".join(command.old_texts).encode("utf-8", "surrogatepass")
+        new_data = "".join(command.new_texts).encode("utf-8", "surrogatepass")
+        out.append(EDIT.pack(REPLACE, 0, len(command.offsets)))
+        out.append(COUNT.pack(len(old_data)))
+        out.append(COUNT.pack(len(new_data)))
+        out.extend((command.offsets.tobytes(), old_lengths.tobytes(), new_lengths.tobytes(), old_data, new_data))
+        return
+    if type(command) in (SplitLineCommand, JoinLinesCommand):
+        # Return / backspace over a line end, kept apart from a "\n" that was typed or pasted
+        # so it is undone on its own after replay like it was live
+        out.append(EDIT.pack(SPLIT if type(command) is SplitLineCommand else JOIN, command.offset, 0))
+        return
+    data = command.text.encode("utf-8", "surrogatepass")
+    out.append(EDIT.pack(INSERT if isinstance(command, InsertCommand) else DELETE, command.offset, len(data)))
+    out.append(data)
+
+
+def decode_command(data: bytes, pos: int):
+    # returns (command, position after it)
+    kind, offset, length = EDIT.unpack_from(data, pos)
+    pos += EDIT.size
+    if kind == COMPOUND:
+        children = []
+        for _ in range(length):
+            child, pos = decode_command(data, pos)
+            children.append(child)
+        return CompoundCommand(children), pos
+    if kind == REPLACE:
+        (old_size,), (new_size,) = COUNT.unpack_from(data, pos), COUNT.unpack_from(data, pos + COUNT.size)
+        pos += 2 * COUNT.size
+        arrays = []
+        for _ in range(3):
+            values = array("q")
+            values.frombytes(data[pos:pos + 8 * length])
+            arrays.append(values)
+            pos += 8 * length
+        offsets, old_lengths, new_lengths = arrays
+        old_text = data[pos:pos + old_size].decode("utf-8", "surrogatepass")
+        pos += old_size
+        new_text = data[pos:pos + new_size].decode("utf-8", "surrogatepass")
+        pos += new_size
+        return ReplaceAllCommand(offsets, split_lengths(old_text, old_lengths), split_lengths(new_text, new_lengths)), pos
+    if kind == SPLIT:
+        return SplitLineCommand(offset), pos
+    if kind == JOIN:
+        return JoinLinesCommand(offset), pos
+    text = data[pos:pos + length].decode("utf-8", "surrogatepass")
+    return (InsertCommand if kind == INSERT else DeleteCommand)(offset, text), pos + length
+
+
+def split_lengths(text: str, lengths) -> list:
+    parts = []
+    position = 0
+    for length in lengths:
+        parts.append(text[position:position + length])
+        position += length
+    return parts
+
+
+def snapshot_bytes(storage: PieceTable, undo_stack: list, undo_top: list, redo_stack: list, can_merge: bool):
+    # storage pieces and the history, undo_top is the already encoded last undo step (or nothing)
+    out = []
+    pieces = list(storage.pieces())
+    out.append(COUNT.pack(len(pieces)))
+    for node in pieces:
+        if node.buffer is storage.source:
+            out.append(PIECE.pack(FILE_RANGE, node.start, node.length))
+        else:
+            data = node.buffer.slice(node.start, node.start + node.length).encode("utf-8", "surrogatepass")
+            out.append(PIECE.pack(TEXT, 0, len(data)))
+            out.append(data)
+    out.append(COUNT.pack(len(undo_stack) + bool(undo_top)))
+    for command in undo_stack:
+        encode_command(command, out)
+    out.extend(undo_top)
+    encode_commands(redo_stack, out)
+    out.append(ACTION.pack(can_merge))
+    return b"".join(out)
+
+
+def encode_commands(commands, out: list):
+    out.append(COUNT.pack(len(commands)))
+    for command in commands:
+        encode_command(command, out)
+
+
+def decode_commands(data: bytes, pos: int):
+    (count,), pos = COUNT.unpack_from(data, pos), pos + COUNT.size
+    commands = []
+    for _ in range(count):
+        command, pos = decode_command(data, pos)
+        commands.append(command)
+    return commands, pos
+
+
+class EditJournal:
+    compact_every = 2000 # records
+    flush_interval = 0.5 # seconds the writer waits to batch records
+
+    def __init__(self, ctx: EditorContext):
+        self.ctx = ctx
+        self.path = None
+        self.snapshot_path = None
+        self.file_stamp = (0, 0)
+        self.generation = 0
+        self.records = 0 # records since the last snapshot
+        self.replaying = False
+        self.items = None # queue feeding the writer thread
+        self.writer = None
+        self.compact_task = None # executor job writing the last snapshot
+        self.compact_pending = False # a snapshot asked for while a chunked paste was running
+
+    @staticmethod
+    def journal_path(file_path: str | None):
+        if file_path is None:
+            return os.path.join(os.path.expanduser("~"), ".text_editor_untitled.journal")
+        directory, name = os.path.split(os.path.abspath(file_path))
+        return os.path.join(directory, "." + name + ".journal")
+
+    @staticmethod
+    def stamp(file_path: str | None):
+        if file_path is None or not os.path.exists(file_path):
+            return 0, 0
+        stat = os.stat(file_path)
+        return stat.st_size, stat.st_mtime_ns
+
+    def attach(self, file_path: str | None):
+        # replay what a previous session left for this file, then journal new edits
+        self.close()
+        self.path = self.journal_path(file_path)
+        self.snapshot_path = self.path + ".snap"
+        self.file_stamp = self.stamp(file_path)
+        self.start_writer()
+        if not self.recover():
+            self.generation = 0
+            self.records = 0
+            self.items.put(("reset", self.header(), None))
+
+    def close(self):
+        if self.writer is not None:
+            self.items.put(None)
+            self.writer.join()
+            self.writer = None
+
+    def start_writer(self):
+        self.items = queue.Queue()
+        self.writer = threading.Thread(target=self.run_writer, args=(self.path, self.snapshot_path, self.items), daemon=True)
+        self.writer.start()
+
+    def suspend(self):
+        # the buffer went to the background, pending records are written and the writer stops
+        self.close()
+        self.items = None
+
+    def resume(self):
+        # the buffer is active again, records go on at the end of the same journal
+        if self.writer is None and self.path is not None:
+            self.start_writer()
+
+    def header(self):
+        return HEADER.pack(MAGIC, self.file_stamp[0], self.file_stamp[1], self.generation)
+
+    # --- writing ---
+    def on_command(self, action: str, command: Command):
+        # command manager observer, runs on the UI thread so it only encodes
+        if self.replaying or self.items is None:
+            return
+        out = [ACTION.pack(ACTIONS[action])]
+        if action == "execute":
+            encode_command(command, out)
+        payload = b"".join(out)
+        self.items.put(("append", RECORD.pack(len(payload)) + payload, None))
+        self.records += 1
+        if self.records >= self.compact_every or self.compact_pending:
+            self.compact()
+
+    def compact(self):
+        # the document is taken as an O(1) storage snapshot and encoded and written off the UI
+        # thread, on the executor when there is one, the writer starts the new journal once the
+        # snapshot file is there
+        if self.ctx.document.storage.loading():
+            return # the file is still loading, pieces would not cover it yet
+        if self.ctx.document.paste_transfer is not None:
+            # the storage holds part of the paste but the history not its command yet, the
+            # snapshot waits for that record (or for the cancel)
+            self.compact_pending = True
+            return
+        self.compact_pending = False
+        self.generation += 1
+        self.records = 0
+        history = self.ctx.command_manager
+        undo_stack, redo_stack = list(history.undo_stack), list(history.redo_stack)
+        # typing may still merge into the last undo step, it is encoded as it is now
+        top = []
+        if undo_stack:
+            encode_command(undo_stack.pop(), top)
+        storage = self.ctx.document.storage.snapshot()
+        header, snapshot_path, can_merge = self.header(), self.snapshot_path, history.can_merge
+        def write():
+            data = snapshot_bytes(storage, undo_stack, top, redo_stack, can_merge)
+            atomic_write(snapshot_path, lambda out: out.write(header + data))
+            return True
+        executor = self.ctx.executor
+        if executor is None:
+            self.items.put(("snapshot", header, write)) # written on the writer thread
+            return
+        written = []
+        previous = self.compact_task
+        def job(task):
+            if previous is not None:
+                previous.wait() # an older snapshot must not be renamed over this one
+            written.append(write())
+        task = self.compact_task = executor.submit(job)
+        def wait():
+            task.wait()
+            return bool(written)
+        self.items.put(("snapshot", header, wait))
+
+    def saved(self, file_path: str):
+        # the saved file is the new base, the history is kept in a fresh snapshot
+        old_path = self.path
+        if self.journal_path(file_path) != old_path:
+            self.close()
+            for path in (old_path, old_path + ".snap"):
+                if os.path.exists(path):
+                    os.unlink(path)
+            self.path = self.journal_path(file_path)
+            self.snapshot_path = self.path + ".snap"
+            self.start_writer()
+        self.file_stamp = self.stamp(file_path)
+        self.compact()
+
+    def run_writer(self, path: str, snapshot_path: str, items: queue.Queue):
+        # batches records for flush_interval, then writes and fsyncs them in one go
+        journal = open(path, "ab")
+        try:
+            while True:
+                batch = [items.get()]
+                deadline = time.monotonic() + self.flush_interval
+                while batch[-1] is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    try:
+                        batch.append(items.get(timeout=remaining))
+                    except queue.Empty:
+                        break
+                pending = []
+                for item in batch:
+                    if item is None:
+                        break
+                    kind, data, write_snapshot = item
+                    if kind == "append":
+                        pending.append(data)
+                        continue
+                    if kind == "snapshot":
+                        # write_snapshot() returns once the snapshot file is written, False if it
+                        # failed or was cancelled, the old journal then goes on
+                        if not write_snapshot():
+                            continue
+                    elif os.path.exists(snapshot_path):
+                        os.unlink(snapshot_path)
+                    # reset / snapshot: earlier records are obsolete
+                    pending.clear()
+                    journal.close()
+                    journal = open(path, "wb")
+                    journal.write(data)
+                if pending:
+                    journal.write(b"".join(pending))
+                journal.flush()
+                os.fsync(journal.fileno())
+                if batch[-1] is None:
+                    return
+        finally:
+            journal.close()
+
+    # --- replay ---
+    def read_header(self, data: bytes):
+        if len(data) < HEADER.size:
+            return None
+        magic, size, mtime, generation = HEADER.unpack_from(data, 0)
+        if magic != MAGIC or (size, mtime) != self.file_stamp:
+            return None # written for another version of the file
+        return generation
+
+    def recover(self):
+        snapshot = None
+        generation = 0
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, "rb") as f:
+                data = f.read()
+            snapshot_generation = self.read_header(data)
+            if snapshot_generation is not None:
+                snapshot, generation = data, snapshot_generation
+        records = []
+        if os.path.exists(self.path):
+            with open(self.path, "rb") as f:
+                data = f.read()
+            if self.read_header(data) == generation:
+                pos = HEADER.size
+                while pos + RECORD.size <= len(data):
+                    (length,) = RECORD.unpack_from(data, pos)
+                    pos += RECORD.size
+                    if pos + length > len(data):
+                        break # torn write
+                    records.append(data[pos:pos + length])
+                    pos += length
+        if snapshot is None and not records:
+            return False
+        self.replay(snapshot, records)
+        self.generation = generation
+        self.records = len(records)
+        return True
+
+    def replay(self, snapshot: bytes | None, records: list):
+        document = self.ctx.document
+        history = self.ctx.command_manager
+        document.finish_loading() # journal offsets are relative to the whole file
+        self.replaying = True
+        try:
+            if snapshot is not None:
+                pos = HEADER.size
+                (count,) = COUNT.unpack_from(snapshot, pos)
+                pos += COUNT.size
+                pieces = []
+                for _ in range(count):
+                    kind, start, length = PIECE.unpack_from(snapshot, pos)
+                    pos += PIECE.size
+                    if kind == FILE_RANGE:
+                        pieces.append((start, length))
+                    else:
+                        pieces.append(snapshot[pos:pos + length].decode("utf-8", "surrogatepass"))
+                        pos += length
+                undo_stack, pos = decode_commands(snapshot, pos)
+                redo_stack, pos = decode_commands(snapshot, pos)
+                (can_merge,) = ACTION.unpack_from(snapshot, pos)
+                document.set_storage(document.storage_class.from_pieces(document.storage.source, pieces))
+                history.restore(undo_stack, redo_stack, bool(can_merge))
+            for record in records:
+                (action,) = ACTION.unpack_from(record, 0)
+                if action == ACTIONS["execute"]:
+                    history.execute(decode_command(record, ACTION.size)[0])
+                elif action == ACTIONS["undo"]:
+                    history.undo()
+                else:
+                    history.redo()
+        finally:
+            self.replaying = False
@@ -0,0 +1,508 @@
+from __future__ import annotations
+import time
+from array import array
+from bisect import bisect_right
+from collections import OrderedDict
+from itertools import accumulate
+
+
+# layout stage between DocumentModel and Renderer
+#
+# every logical line takes one or more visual rows (wrapped lines take more),
+# pixel positions come from the number of rows above a line instead of line * line_height,
+# x positions inside a row from the glyph advances of the editor font (GlyphMetrics)
+
+class Fenwick:
+    # prefix sums over a list of ints with point updates, everything O(log n)
+    __slots__ = ("tree", "size", "top")
+
+    def __init__(self, values=()):
+        self.size = len(values)
+        tree = [0]
+        tree.extend(values)
+        for i in range(1, self.size + 1):
+            parent = i + (i & -i)
+            if parent <= self.size:
+                tree[parent] += tree[i]
+        self.tree = tree
+        self.top = 1 << (self.size.bit_length() - 1) if self.size else 0
+
+    def add(self, index: int, delta: int):
+        index += 1
+        tree = self.tree
+        while index <= self.size:
+            tree[index] += delta
+            index += index & -index
+
+    def prefix(self, index: int) -> int:
+        # sum of values[:index]
+        total = 0
+        tree = self.tree
+        while index > 0:
+            total += tree[index]
+            index -= index & -index
+        return total
+
+    def total(self) -> int:
+        return self.prefix(self.size)
+
+    def find(self, target: int):
+        # (index, rest) with sum(values[:index]) + rest == target and rest < values[index],
+        # index == size when target is past the end
+        position = 0
+        step = self.top
+        tree = self.tree
+        while step:
+            next_position = position + step
+            if next_position <= self.size and tree[next_position] <= target:
+                position = next_position
+                target -= tree[next_position]
+            step >>= 1
+        return position, target
+
+
+class GlyphMetrics:
+    # pixel advances of one font, every character is measured once
+    #
+    # a row of printable ascii in a monospaced font is column * char_width without any
+    # lookup, other rows (tabs, wide or proportional characters) get the x of every column
+    # from the advances, cached by row text so an edited row is never found stale
+    tab_stops = 8 # Tk puts a tab stop every 8 widths of "0"
+    cache_rows = 4096
+
+    def __init__(self, font):
+        self.font = font
+        self.char_width = font.measure("M")
+        self.tab_width = self.tab_stops * font.measure("0")
+        self.advances = {} # character -> pixels
+        self.narrow = set() # characters as wide as "M"
+        printable = [chr(code) for code in range(32, 127)]
+        for char in printable:
+            self.advance(char)
+        self.monospace = self.narrow.issuperset(printable)
+        self.row_cache = OrderedDict() # row text -> x of every column
+
+    def advance(self, char: str) -> int:
+        advance = self.advances.get(char)
+        if advance is None:
+            advance = self.advances[char] = self.font.measure(char)
+            if advance == self.char_width:
+                self.narrow.add(char)
+        return advance
+
+    def measure_new(self, text: str):
+        for char in set(text).difference(self.advances):
+            self.advance(char)
+
+    def simple(self, text: str) -> bool:
+        # x of a column is column * char_width
+        return self.monospace and text.isascii() and text.isprintable()
+
+    def uniform(self, text: str) -> bool:
+        # every character but tabs as wide as "M", text with characters blanked out to
+        # spaces keeps its glyphs where they were
+        if self.simple(text):
+            return True
+        chars = set(text)
+        chars.discard("\t")
+        self.measure_new(chars)
+        return self.narrow.issuperset(chars)
+
+    def positions(self, text: str):
+        # x of every column of a row from its start, len(text) + 1 of them
+        positions = self.row_cache.get(text)
+        if positions is not None:
+            self.row_cache.move_to_end(text)
+            return positions
+        self.measure_new(text)
+        advances = self.advances
+        if "\t" not in text:
+            positions = list(accumulate(map(advances.__getitem__, text), initial=0))
+        else:
+            positions = [0]
+            x = 0
+            tab_width = self.tab_width
+            for char in text:
+                x = (x // tab_width + 1) * tab_width if char == "\t" else x + advances[char]
+                positions.append(x)
+        self.row_cache[text] = positions
+        if len(self.row_cache) > self.cache_rows:
+            self.row_cache.popitem(last=False)
+        return positions
+
+    def x_at(self, text: str, column: int) -> int:
+        # x of column in a row
+        if self.simple(text):
+            return column * self.char_width
+        return self.positions(text)[column]
+
+    def column_at(self, text: str, x: float) -> int:
+        # column of a row closest to x, past half a character counts as the next column
+        if self.simple(text):
+            column = min(max(int(x // self.char_width), 0), len(text))
+            if column < len(text) and x - column * self.char_width > self.char_width / 2:
+                column += 1
+            return column
+        positions = self.positions(text)
+        column = min(max(bisect_right(positions, x) - 1, 0), len(text))
+        if column < len(text) and x - positions[column] > (positions[column + 1] - positions[column]) / 2:
+            column += 1
+        return column
+
+    def fit(self, text: str, start: int, width: int) -> int:
+        # end of the longest piece of text from start that is at most width pixels wide,
+        # at least one character
+        self.measure_new(text)
+        advances = self.advances
+        tab_width = self.tab_width
+        x = 0
+        end = start
+        while end < len(text):
+            char = text[end]
+            x = (x // tab_width + 1) * tab_width if char == "\t" else x + advances[char]
+            if x > width and end > start:
+                break
+            end += 1
+        return end
+
+
+class LineHeightIndex:
+    # visual row count of every logical line
+    #
+    # lines are grouped in blocks, a block keeps an array of row counts or None while
+    # all its lines are one row high (unwrapped documents cost nothing per line),
+    # two fenwick trees over the blocks give line -> block and row -> block lookups
+    block_size = 512
+    max_rows = 0xFFFF
+
+    def __init__(self, line_count: int = 1):
+        self.reset(line_count)
+
+    def reset(self, line_count: int):
+        full, rest = divmod(line_count, self.block_size)
+        self.counts = [self.block_size] * full + ([rest] if rest or not full else [])
+        self.heights = [None] * len(self.counts)
+        self.rows = list(self.counts)
+        self.rebuild()
+
+    def rebuild(self):
+        # after blocks were added or removed
+        self.line_tree = Fenwick(self.counts)
+        self.row_tree = Fenwick(self.rows)
+
+    def line_count(self) -> int:
+        return self.line_tree.total()
+
+    def total_rows(self) -> int:
+        return self.row_tree.total()
+
+    def locate(self, line: int):
+        # (block, line inside the block), line_count maps to the end of the last block
+        block, rest = self.line_tree.find(max(line, 0))
+        if block >= len(self.counts):
+            block = len(self.counts) - 1
+            rest = self.counts[block]
+        return block, rest
+
+    def line_rows(self, line: int) -> int:
+        block, rest = self.locate(line)
+        heights = self.heights[block]
+        if heights is None or rest >= len(heights):
+            return 1
+        return heights[rest]
+
+    def rows_before(self, line: int) -> int:
+        block, rest = self.locate(line)
+        heights = self.heights[block]
+        return self.row_tree.prefix(block) + (rest if heights is None else sum(heights[:rest]))
+
+    def line_at_row(self, row: int):
+        # (line, row inside that line), rows past the end land on the last row of the last line
+        total = self.total_rows()
+        if row >= total:
+            last_line = self.line_count() - 1
+            return last_line, self.line_rows(last_line) - 1
+        block, rest = self.row_tree.find(max(row, 0))
+        first_line = self.line_tree.prefix(block)
+        heights = self.heights[block]
+        if heights is None:
+            return first_line + rest, 0
+        ends = list(accumulate(heights))
+        line = bisect_right(ends, rest)
+        return first_line + line, rest - (ends[line - 1] if line else 0)
+
+    def set_rows(self, line: int, rows: int):
+        rows = min(max(rows, 1), self.max_rows)
+        block, rest = self.locate(line)
+        heights = self.heights[block]
+        if heights is None:
+            if rows == 1:
+                return
+            heights = self.heights[block] = array("H", [1]) * self.counts[block]
+        delta = rows - heights[rest]
+        if delta:
+            heights[rest] = rows
+            self.rows[block] += delta
+            self.row_tree.add(block, delta)
+
+    def set_rows_range(self, line: int, rows: list):
+        # rows of consecutive lines from line on, returns True if any count changed
+        block, rest = self.locate(line)
+        changed = False
+        position = 0
+        while position < len(rows) and block < len(self.counts):
+            size = min(len(rows) - position, self.counts[block] - rest)
+            part = rows[position:position + size]
+            heights = self.heights[block]
+            if heights is None and part.count(1) != size:
+                heights = self.heights[block] = array("H", [1]) * self.counts[block]
+            if heights is not None:
+                new = array("H", [min(max(count, 1), self.max_rows) for count in part])
+                old = heights[rest:rest + size]
+                if new != old:
+                    heights[rest:rest + size] = new
+                    delta = sum(new) - sum(old)
+                    self.rows[block] += delta
+                    self.row_tree.add(block, delta)
+                    changed = True
+            position += size
+            block += 1
+            rest = 0
+        return changed
+
+    def clear_rows(self):
+        # every line back to one row
+        self.heights = [None] * len(self.counts)
+        self.rows = list(self.counts)
+        self.row_tree = Fenwick(self.rows)
+
+    def insert_lines(self, line: int, count: int):
+        # count one row lines before line
+        if count <= 0:
+            return
+        block, rest = self.locate(line)
+        heights = self.heights[block]
+        if heights is not None:
+            heights[rest:rest] = array("H", [1]) * count
+        self.counts[block] += count
+        self.rows[block] += count
+        if self.counts[block] > 2 * self.block_size:
+            self.split(block)
+        else:
+            self.line_tree.add(block, count)
+            self.row_tree.add(block, count)
+
+    def split(self, block: int):
+        count = self.counts[block]
+        heights = self.heights[block]
+        counts, parts, rows = [], [], []
+        for start in range(0, count, self.block_size):
+            size = min(self.block_size, count - start)
+            part = None if heights is None else heights[start:start + size]
+            if part is not None and part.count(1) == size:
+                part = None
+            counts.append(size)
+            parts.append(part)
+            rows.append(size if part is None else sum(part))
+        self.counts[block:block + 1] = counts
+        self.heights[block:block + 1] = parts
+        self.rows[block:block + 1] = rows
+        self.rebuild()
+
+    def delete_lines(self, line: int, count: int):
+        block, rest = self.locate(line)
+        removed_blocks = False
+        while count > 0 and block < len(self.counts):
+            size = min(count, self.counts[block] - rest)
+            heights = self.heights[block]
+            if heights is None:
+                removed_rows = size
+            else:
+                removed_rows = sum(heights[rest:rest + size])
+                del heights[rest:rest + size]
+            self.counts[block] -= size
+            self.rows[block] -= removed_rows
+            count -= size
+            if self.counts[block] == 0 and len(self.counts) > 1:
+                del self.counts[block], self.heights[block], self.rows[block]
+                removed_blocks = True
+            else:
+                if not removed_blocks:
+                    self.line_tree.add(block, -size)
+                    self.row_tree.add(block, -removed_rows)
+                block += 1
+            rest = 0
+        if removed_blocks:
+            self.rebuild()
+
+
+class LineLayout:
+    # soft wrap and pixel geometry of the document, kept in sync through document change notifications
+    #
+    # rows of a line come from its wrap breaks, breaks are cached by (line text, columns)
+    # edits re-wrap the touched lines right away, a width change re-wraps the visible lines
+    # first (see ScrollManager.calculate_visible_lines) and the rest in slices through fill()
+    wrap = True
+    eager_lines = 1000 # bigger changes are wrapped lazily
+    fill_chunk = 2000 # lines read from storage at once while filling
+    cache_lines = 4096
+
+    def __init__(self, ctx: EditorContext, break_cache: OrderedDict | None = None):
+        self.ctx = ctx
+        self.index = LineHeightIndex()
+        self.columns = None # wrap width in characters, None while not wrapping
+        # (text, columns) -> row start columns, one cache can serve the layouts of several documents
+        self.break_cache = OrderedDict() if break_cache is None else break_cache
+        self.fill_line = None # first line that may still have rows of an old width
+        self.rows_changed = False # the last edit moved the lines below it
+        self.version = 0 # bumped whenever line positions may have changed, for geometry caches
+
+    # --- wrapping ---
+    def update_width(self):
+        # returns True if the wrap width changed
+        width = self.ctx.canvas.winfo_width()
+        columns = None
+        if self.wrap and width > 1: # width is 1 until the canvas is mapped
+            columns = max(1, (width - self.ctx.renderer.left_padding) // self.ctx.renderer.char_width)
+        if columns == self.columns:
+            return False
+        self.columns = columns
+        self.version += 1
+        if columns is None:
+            self.index.clear_rows()
+            self.fill_line = None
+        else:
+            self.fill_line = 0
+        return True
+
+    def breaks(self, text: str):
+        # start column of every visual row, words are kept whole when they fit a row,
+        # rows with tabs or wide characters are filled up to the same pixel width
+        columns = self.columns
+        if columns is None:
+            return (0,)
+        metrics = self.ctx.renderer.metrics
+        simple = metrics.simple(text)
+        if simple and len(text) <= columns:
+            return (0,)
+        key = (text, columns)
+        breaks = self.break_cache.get(key)
+        if breaks is not None:
+            self.break_cache.move_to_end(key)
+            return breaks
+        breaks = [0]
+        start = 0
+        width = columns * metrics.char_width
+        while True:
+            end = start + columns if simple else metrics.fit(text, start, width)
+            if end >= len(text):
+                break
+            space = text.rfind(" ", start, end)
+            start = space + 1 if space > start else end
+            breaks.append(start)
+        breaks = tuple(breaks)
+        self.break_cache[key] = breaks
+        if len(self.break_cache) > self.cache_lines:
+            self.break_cache.popitem(last=False)
+        return breaks
+
+    def line_breaks(self, line: int):
+        return self.breaks(self.ctx.document.get_line(line))
+
+    def join_rows(self, text: str, breaks):
+        # line text with a newline at every wrap break, one canvas text item draws all rows
+        if len(breaks) == 1:
+            return text
+        ends = breaks[1:] + (len(text),)
+        return "\n".join(text[start:end] for start, end in zip(breaks, ends))
+
+    def row_of(self, line: int, column: int):
+        # (visual row inside the line, column the row starts at)
+        breaks = self.line_breaks(line)
+        row = bisect_right(breaks, column) - 1
+        return row, breaks[row]
+
+    def column_x(self, line: int, column: int):
+        # (visual row inside the line, x of the column from the row start)
+        text = self.ctx.document.get_line(line)
+        breaks = self.breaks(text)
+        row = bisect_right(breaks, column) - 1
+        start = breaks[row]
+        metrics = self.ctx.renderer.metrics
+        if metrics.simple(text):
+            return row, (column - start) * metrics.char_width
+        end = breaks[row + 1] if row + 1 < len(breaks) else len(text)
+        return row, metrics.x_at(text[start:end], column - start)
+
+    def wrap_lines(self, start: int, end: int):
+        # re-wrap lines start..end (exclusive), returns True if any row count changed
+        if self.columns is None or start >= end:
+            return False
+        storage = self.ctx.document.storage
+        texts = storage.text(storage.line_start(start), storage.line_end(end - 1)).split("\n")
+        if not self.index.set_rows_range(start, [len(self.breaks(text)) for text in texts]):
+            return False
+        self.version += 1
+        return True
+
+    def pending(self):
+        return self.fill_line is not None
+
+    def size(self) -> int:
+        # rough memory use of the row index in bytes, the break cache is not counted
+        index = self.index
+        return 100 * len(index.counts) + sum(2 * len(heights) for heights in index.heights if heights is not None)
+
+    def fill(self, budget: float = 0.01):
+        # wrap lines left from a width change or a big edit for about budget seconds,
+        # returns True if any row count changed
+        changed = False
+        deadline = time.perf_counter() + budget
+        line_count = self.ctx.document.get_line_number()
+        while self.fill_line is not None:
+            end = min(self.fill_line + self.fill_chunk, line_count)
+            changed = self.wrap_lines(self.fill_line, end) or changed
+            self.fill_line = end if end < line_count else None
+            if time.perf_counter() >= deadline:
+                break
+        return changed
+
+    def on_document_change(self, change: DocumentChange):
+        if change.start_line is None:
+            return
+        self.version += 1
+        # lines start..old_end became start..new_end, rows of the surviving lines are kept
+        delta = change.line_delta()
+        self.rows_changed = delta != 0
+        if delta > 0:
+            self.index.insert_lines(change.old_end_line + 1, delta)
+        elif delta < 0:
+            self.index.delete_lines(change.new_end_line + 1, -delta)
+        if self.columns is None:
+            return
+        if self.fill_line is not None and self.fill_line > change.start_line:
+            # keep the lazy pass on the same text when lines above it come or go
+            self.fill_line = change.start_line if self.fill_line <= change.old_end_line else self.fill_line + delta
+        if change.new_end_line - change.start_line < self.eager_lines:
+            if self.wrap_lines(change.start_line, change.new_end_line + 1):
+                self.rows_changed = True
+        elif self.fill_line is None or change.start_line < self.fill_line:
+            self.fill_line = change.start_line
+
+    # --- geometry ---
+    def line_top(self, line: int) -> int:
+        return self.index.rows_before(line) * self.ctx.renderer.line_height
+
+    def line_bottom(self, line: int) -> int:
+        return self.index.rows_before(line + 1) * self.ctx.renderer.line_height
+
+    def line_at(self, y: int) -> int:
+        # logical line under document pixel y
+        return self.index.line_at_row(y // self.ctx.renderer.line_height)[0]
+
+    def position_at(self, y: int):
+        # (line, visual row inside the line) under document pixel y
+        return self.index.line_at_row(y // self.ctx.renderer.line_height)
+
+    def total_height(self) -> int:
+        return self.index.total_rows() * self.ctx.renderer.line_height
@@ -1,24 +1,40 @@
 from __future__ import annotations
+import math
+import sys
+import time
 import tkinter as tk
-from tkinter import font
+from tkinter import font, filedialog, simpledialog
 from enum import Enum, auto
+from bisect import bisect_left, bisect_right
+from itertools import accumulate
+from operator import itemgetter, sub
+from storage import PieceTable
+from commands import InsertCommand, DeleteCommand, SplitLineCommand, JoinLinesCommand, CompoundCommand, ReplaceAllCommand, CommandManager
+from layout import LineLayout, GlyphMetrics
+from highlight import Highlighter
+from tasks import TaskExecutor
+from search import Search, compile_query, iter_chunks
+from minimap import DocumentSummary, Minimap
+from profiler import Profiler
+from buffers import BufferManager
+from clipboard import ClipboardContent, LocalClipboard, ClipboardService, PasteTransfer, CHUNK_SIZE, content_text
 
 
 # TODO: 
 
-# create editor state class that store scroll, cursor, selection, and undo redo
+# create editor state class that store scroll, cursor, selection, and undo redo DONE
 # split input and delete into document layer 
 
-# line wrapping
+# line wrapping DONE
 # clipboard support, ctrl cvax
-# text highlight
-# undo redo stack
-# scrolbar
+# text highlight DONE
+# undo redo stack DONE
+# scrolbar DONE
 # i/o
 
-# minimize redraw (render whole line, dirty region, caching , only move index onscroll, non rerender highlight)
-# use data structure for text storage
-# observer pattern
+# minimize redraw (render whole line, dirty region, caching , only move index onscroll, non rerender highlight) DONE
+# use data structure for text storage DONE
+# observer pattern DONE
 
 # scroll when moving cursor out of view DONE
 # cursor renders on top padding DONE
@@ -29,7 +45,7 @@ from enum import Enum, auto
 # maybe split render to draw_text and draw_cursor DONE
 # split on_key to movement, insertion, backspace return...
 
-# maybe single index for cursor position instead of (x, y)
+# maybe single index for cursor position instead of (x, y) DONE
 
 
 # undo: 
@@ -41,11 +57,50 @@ class EditorContext:
     def __init__(self):
         self.canvas = None
         self.renderer = None
+        self.layout = None
+        self.highlighter = None
+        self.summary = None
+        self.minimap = None
         self.document = None
         self.scroll = None
         self.input = None
         self.clipboard = None
+        self.command_manager = None
+        self.journal = None
+        self.executor = None
+        self.profiler = None
+        self.buffers = None
         self.editor = None
+
+def create_context(canvas, editor_font=None) -> EditorContext:
+    # document, layout, scroll, render, input and command layers wired together, none of
+    # them needs a display: canvas can be any object with the tk.Canvas methods the renderer
+    # calls and editor_font anything with measure() and metrics() (a tk font by default),
+    # the clipboard is a local stand-in, the window adds the system clipboard, background
+    # tasks, journal and minimap on top
+    #
+    # the document, its history and its views (layout, highlighter, summary) belong to the
+    # active buffer and are swapped in by ctx.buffers, the rest is shared by all buffers
+    ctx = EditorContext()
+    ctx.canvas = canvas
+    ctx.renderer = Renderer(ctx, editor_font)
+    ctx.scroll = ScrollManager(ctx)
+    ctx.input = InputManager(ctx)
+    ctx.clipboard = LocalClipboard()
+    ctx.profiler = Profiler(ctx)
+    ctx.buffers = BufferManager(ctx, lambda: create_document(ctx), lambda: create_views(ctx))
+    ctx.buffers.activate(ctx.buffers.new())
+    return ctx
+
+def create_document(ctx: EditorContext):
+    return DocumentModel(ctx), CommandManager(ctx)
+
+def create_views(ctx: EditorContext):
+    # wrap breaks and lexer spans are cached by line text, the caches of the first views
+    # serve every buffer
+    if ctx.layout is None:
+        return LineLayout(ctx), Highlighter(ctx), DocumentSummary(ctx)
+    return LineLayout(ctx, ctx.layout.break_cache), Highlighter(ctx, ctx.highlighter.tables), DocumentSummary(ctx)
         
 class Direction(Enum):
     LEFT = auto()
@@ -55,6 +110,56 @@ class Direction(Enum):
     LINE_START = auto()
     LINE_END = auto()
 
+class DocumentChange:
+    # sent to document observers after every edit / cursor or selection move
+    # lines start_line..old_end_line (inclusive) were replaced by start_line..new_end_line,
+    # start_line is None when no text changed
+    __slots__ = ("start_line", "old_end_line", "new_end_line", "cursor_moved", "selection_moved")
+    
+    def __init__(self, start_line=None, old_end_line=None, new_end_line=None, cursor_moved=False, selection_moved=False):
+        self.start_line = start_line
+        self.old_end_line = old_end_line
+        self.new_end_line = new_end_line
+        self.cursor_moved = cursor_moved
+        self.selection_moved = selection_moved
+    
+    def line_delta(self):
+        # number of lines added (or removed if negative) by the edit
+        if self.start_line is None:
+            return 0
+        return self.new_end_line - self.old_end_line
+
+class Selection:
+    # cursor and selection as absolute offsets into the text, the cursor is the active end,
+    # (line, column) positions come from the storage line index when something needs them
+    __slots__ = ("anchor", "active", "preferred_column")
+    
+    def __init__(self, anchor: int = 0, active: int | None = None):
+        self.anchor = anchor
+        self.active = anchor if active is None else active
+        self.preferred_column = None # column kept while moving up / down, None until set
+    
+    def empty(self) -> bool:
+        return self.anchor == self.active
+    
+    def start(self) -> int:
+        return min(self.anchor, self.active)
+    
+    def end(self) -> int:
+        return max(self.anchor, self.active)
+    
+    def collapse(self, offset: int):
+        # cursor at offset, nothing selected
+        self.anchor = self.active = offset
+    
+    def shift(self, offset: int, delta: int):
+        # text was inserted (delta > 0) at offset or removed (delta < 0) from offset on,
+        # ends right at offset stay in front of inserted text
+        if self.anchor > offset:
+            self.anchor = max(offset, self.anchor + delta)
+        if self.active > offset:
+            self.active = max(offset, self.active + delta)
+
 class Changes(Enum): # changes for undo, redo
     INSERT = auto() # also paste
     DELETE = auto()
@@ -66,366 +171,860 @@ class CustomEditor(tk.Frame):
         super().__init__(master)
         
         # --- canvas ---
+        # scrollbar and minimap on the right, the text canvas takes the rest
+        self.scrollbar = tk.Scrollbar(self, orient=tk.VERTICAL)
+        self.scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        self.minimap_canvas = tk.Canvas(self, width=Minimap.width, height=400, bg=Minimap.background, highlightthickness=0)
+        self.minimap_canvas.pack(side=tk.RIGHT, fill=tk.Y)
         self.canvas = tk.Canvas(self, width=600, height=400, bg="white")
-        self.canvas.pack(fill=tk.BOTH, expand=True)
+        self.canvas.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
         
         # --- components ---
-        self.ctx = EditorContext()
-        self.ctx.renderer = Renderer(self.ctx)
-        self.ctx.document = DocumentModel(self.ctx)
-        self.ctx.scroll = ScrollManager(self.ctx)
-        self.ctx.input = InputManager(self.ctx)
+        self.ctx = create_context(self.canvas)
+        self.ctx.minimap = Minimap(self.ctx, self.minimap_canvas)
         self.ctx.editor = self
-        self.ctx.canvas = self.canvas
         
         # --- services ---
         self.ctx.clipboard = ClipboardService(master)
+        self.ctx.executor = TaskExecutor(self.ctx) # background jobs, results come back through after()
         
         # --- command system ---
-        self.command_manager = CommandManager()
+        # every buffer has its own journal, written while the buffer is active
+        self.ctx.buffers.journals = True
+        
+        # --- render scheduling ---
+        # input handlers only request a frame, requests between two frames share one paint
+        self.max_fps = 60
+        self.render_pending = None # after id of the scheduled frame
+        self.full_render_requested = False
+        self.last_frame_time = 0.0
+        self.frames_executed = 0
+        self.frames_coalesced = 0
+        self.layout_pending = None # after id of the next lazy wrap slice
+        self.layout_slice = 0.01 # seconds of wrapping per slice
+        self.highlight_pending = None # after id of the next lexing slice
+        self.highlight_slice = 0.008 # seconds of lexing per slice
+        self.scroll_pending = None # after id of the next smooth scroll frame
+        self.file_loading_pending = None # after id of the next check for newly indexed text
+        self.summary_pending = None # after id of the next minimap counting slice
+        self.summary_slice = 0.005 # seconds of counting per slice
+        self.scrollbar_view = None # (first, last) fractions last given to the scrollbar
+        self.transfers = [] # chunked copies and pastes still running, see clipboard.py
+        self.transfer_pending = None # after id of the next transfer slice
+        self.transfer_slice = 0.008 # seconds of copying or pasting per slice
+        self.status = None # short message after the title, e.g. where a profile dump went
+        self.status_pending = None # after id that clears the status
+        self.first_request_time = None # first render request since the last frame, while profiling
                 
         # --- bindings ---
         self.canvas.bind("<Configure>", self.on_canvas_resize)
-        self.canvas.bind("<Button-1>", self.ctx.input.on_leftclick)
-        self.canvas.bind("<B1-Motion>", self.ctx.input.on_left_drag)
-        self.canvas.bind("<MouseWheel>", self.ctx.input.on_mousewheel)
-        self.bind_all("<Key>", self.ctx.input.on_key)
-        self.bind_all("<Control-c>", self.ctx.input.on_ctrl_c)
-        self.bind_all("<Control-v>", self.ctx.input.on_ctrl_v)
-        self.bind_all("<Control-z>", self.ctx.input.on_ctrl_z)
-        self.bind_all("<Control-t>", self.ctx.input.on_ctrl_t) # text
+        self.canvas.bind("<Button-1>", self.input_handler("on_leftclick"))
+        self.canvas.bind("<B1-Motion>", self.input_handler("on_left_drag"))
+        self.canvas.bind("<Control-Button-1>", self.input_handler("on_ctrl_leftclick")) # add a cursor
+        self.canvas.bind("<Alt-Button-1>", self.input_handler("on_alt_leftclick")) # block selection
+        self.canvas.bind("<Alt-B1-Motion>", self.input_handler("on_alt_drag"))
+        self.canvas.bind("<MouseWheel>", self.input_handler("on_mousewheel"))
+        self.canvas.bind("<Button-4>", self.input_handler("on_mousewheel"))
+        self.canvas.bind("<Button-5>", self.input_handler("on_mousewheel"))
+        self.scrollbar.configure(command=self.input_handler("on_scrollbar"))
+        self.minimap_canvas.bind("<Configure>", lambda event: self.request_render())
+        self.minimap_canvas.bind("<Button-1>", self.input_handler("on_minimap_click"))
+        self.minimap_canvas.bind("<B1-Motion>", self.input_handler("on_minimap_click"))
+        self.minimap_canvas.bind("<MouseWheel>", self.input_handler("on_mousewheel"))
+        self.minimap_canvas.bind("<Button-4>", self.input_handler("on_mousewheel"))
+        self.minimap_canvas.bind("<Button-5>", self.input_handler("on_mousewheel"))
+        self.bind_all("<Key>", self.input_handler("on_key"))
+        self.bind_all("<Control-c>", self.input_handler("on_ctrl_c"))
+        self.bind_all("<Control-v>", self.input_handler("on_ctrl_v"))
+        self.bind_all("<Control-z>", self.input_handler("on_ctrl_z"))
+        self.bind_all("<Control-y>", self.input_handler("on_ctrl_y"))
+        self.bind_all("<Control-Z>", self.input_handler("on_ctrl_y")) # ctrl shift z
+        self.bind_all("<Control-t>", self.input_handler("on_ctrl_t")) # text
+        self.bind_all("<Control-o>", self.input_handler("on_ctrl_o"))
+        self.bind_all("<Control-s>", self.input_handler("on_ctrl_s"))
+        self.bind_all("<Control-f>", self.input_handler("on_ctrl_f"))
+        self.bind_all("<Control-h>", self.input_handler("on_ctrl_h"))
+        self.bind_all("<Control-L>", self.input_handler("on_ctrl_shift_l")) # a cursor on every match
+        self.bind_all("<F3>", self.input_handler("on_f3"))
+        self.bind_all("<Shift-F3>", self.input_handler("on_f3"))
+        self.bind_all("<F12>", self.input_handler("on_f12")) # profiler and overlay on / off
+        self.bind_all("<Control-F12>", self.input_handler("on_f12")) # same with cProfile
+        self.bind_all("<Shift-F12>", self.input_handler("on_shift_f12")) # dump profile to files
+        self.bind_all("<Control-n>", self.input_handler("on_ctrl_n")) # new buffer
+        self.bind_all("<Control-w>", self.input_handler("on_ctrl_w")) # close buffer
+        self.bind_all("<Control-Tab>", self.input_handler("on_ctrl_tab")) # next buffer
+        self.bind_all("<Control-Next>", self.input_handler("on_ctrl_tab"))
+        self.bind_all("<Control-Prior>", self.input_handler("on_ctrl_shift_tab")) # previous buffer
 
         
         
         # initial set up
-        self.ctx.document.lines = self.ctx.document.parse_text()
+        self.ctx.document.set_storage(self.ctx.document.parse_text())
         self.ctx.document.trailing_line()
+        self.ctx.journal = self.ctx.buffers.start_journal(self.ctx.buffers.active) # recover unsaved edits of the untitled document
+        self.update_title()
 
+    def input_handler(self, name: str):
+        # looked up on every event so the profiler's wrappers on ctx.input are the ones called
+        return lambda *args: getattr(self.ctx.input, name)(*args)
+    
     def on_canvas_resize(self, event):
+        # only the visible lines are re-wrapped here, the rest in poll_layout slices
+        self.ctx.layout.update_width()
         self.ctx.scroll.calculate_visible_lines()
-        self.ctx.renderer.render()
-
-class ClipboardService:
-    def __init__(self, root):
-        self.root = root
-        
-    def copy(self, str):
-        root.clipboard_clear()
-        root.clipboard_append(str)
-        
-    def paste(self):
-        try:
-            text = root.clipboard_get()
-            return text
-        except tk.TclError:
+        self.request_render(full=True)
+    
+    def open_file(self, path: str):
+        # in a buffer of its own, or the buffer that already has it
+        self.show_buffer(self.ctx.buffers.open(path))
+    
+    def show_buffer(self, buffer):
+        # only the drawn band is repainted, from the canvas items the last buffer left
+        self.ctx.buffers.activate(buffer)
+        self.update_title()
+        self.request_render(full=True)
+        if self.ctx.document.storage.loading():
+            self.poll_file_loading()
+        self.schedule_transfers() # a paste paused in the background goes on
+    
+    def close_buffer(self):
+        self.ctx.buffers.close(self.ctx.buffers.active)
+        self.show_buffer(self.ctx.buffers.active)
+    
+    def update_title(self):
+        buffers = self.ctx.buffers
+        title = f"{buffers.active.name()} [{buffers.buffers.index(buffers.active) + 1}/{len(buffers.buffers)}]"
+        for transfer in self.transfers:
+            if transfer.finished:
+                continue
+            title += f" - {transfer.label} {transfer.progress():.0%}"
+        if self.status is not None:
+            title += f" - {self.status}"
+        self.master.title(title)
+    
+    def show_status(self, text: str, seconds: float = 5):
+        if self.status_pending is not None:
+            self.after_cancel(self.status_pending)
+        self.status = text
+        self.status_pending = self.after(int(seconds * 1000), self.clear_status)
+        self.update_title()
+    
+    def clear_status(self):
+        self.status = None
+        self.status_pending = None
+        self.update_title()
+    
+    def save_file(self, path: str):
+        # written on a worker, editing goes on while it runs, the buffer may be in the background when it is done
+        buffer = self.ctx.buffers.active
+        def saved():
+            self.ctx.buffers.saved(buffer, path)
+            self.update_title()
+        self.ctx.document.save_in_background(path, saved)
+    
+    def close(self):
+        # running saves are finished, loading stopped and the journals flushed before the window goes
+        self.ctx.buffers.close_all()
+        self.ctx.executor.shutdown()
+        self.master.destroy()
+    
+    def poll_file_loading(self):
+        # the document grows while the rest of the file is indexed in the background,
+        # a buffer switched away from picks up where it was when it is shown again
+        self.ctx.document.load_more()
+        self.request_render()
+        if self.ctx.document.storage.loading() and self.file_loading_pending is None:
+            self.file_loading_pending = self.after(50, self.poll_next_file_loading)
+    
+    def poll_next_file_loading(self):
+        self.file_loading_pending = None
+        self.poll_file_loading()
+    
+    def start_transfer(self, transfer):
+        # copy or paste too big for one frame, None when it was done at once
+        if transfer is None:
             return
-
-class Command:
-    # for commander pattern
-    # must support execute/undo for each command
-    def execute(self):
-        pass
-
-    def undo(self):
-        pass
-    
-class InsertCommand(Command):
-    def __init__(self, doc: DocumentModel, text: str):
-        self.doc = doc
-        self.text = text
-        self.inserted_str = ""
-        self.str_end = (0, 0)
-    def execute(self):
-        self.doc.insert_at_cursor(self.text)
-        self.inserted_str = self.text
-        self.str_end = (self.doc.cursor_x_index, self.doc.cursor_y_index)
-    def undo(self):
-        self.doc.move_cursor_to_index(self.str_end[0], self.str_end[1])
-        self.doc.delete_at_cursor(len(self.inserted_str))
-
-class CommandManager:
-    def __init__(self):
-        self.undo_stack = []
-        
-    def execute(self, command: Command):
-        command.execute()
-        self.undo_stack.append(command)
-        
-    def undo(self):
-        if not self.undo_stack:
+        self.transfers.append(transfer)
+        self.update_title()
+        self.schedule_transfers()
+    
+    def cancel_transfers(self):
+        # Escape: running copies and the paste into the shown document stop
+        cancelled = [transfer for transfer in self.transfers if transfer.ready()]
+        for transfer in cancelled:
+            transfer.cancel()
+        self.poll_transfers()
+        return bool(cancelled)
+    
+    def schedule_transfers(self):
+        if self.transfer_pending is None and any(transfer.ready() for transfer in self.transfers):
+            self.transfer_pending = self.after(1, self.poll_transfers)
+    
+    def poll_transfers(self):
+        # a slice of every transfer that can run, progress in the title
+        if self.transfer_pending is not None:
+            self.after_cancel(self.transfer_pending)
+        self.transfer_pending = None
+        for transfer in self.transfers:
+            if transfer.ready():
+                transfer.run(self.transfer_slice)
+        self.transfers = [transfer for transfer in self.transfers if not transfer.finished]
+        self.update_title()
+        self.request_render()
+        self.schedule_transfers()
+    
+    def poll_layout(self):
+        # wrap lines that still have rows of an old width, the top visible line stays in place
+        self.layout_pending = None
+        layout = self.ctx.layout
+        scroll = self.ctx.scroll
+        top_line = layout.line_at(scroll.scroll_y)
+        offset = scroll.scroll_y - layout.line_top(top_line)
+        if layout.fill(self.layout_slice):
+            scroll.scroll_y = layout.line_top(top_line) + offset
+            scroll.move_scroll(0)
+            self.request_render(full=True)
+        if layout.pending():
+            self.layout_pending = self.after(1, self.poll_layout)
+    
+    def animate_scroll(self):
+        if self.scroll_pending is None:
+            self.scroll_pending = self.after(1, self.poll_scroll)
+    
+    def poll_scroll(self):
+        # one smooth scroll step per frame until the view stops
+        self.scroll_pending = None
+        if self.ctx.scroll.step():
+            self.scroll_pending = self.after(int(1000 / self.max_fps), self.poll_scroll)
+        self.request_render()
+    
+    def poll_summary(self):
+        # count the blocks of lines a large edit or a newly opened file left for the minimap
+        self.summary_pending = None
+        self.ctx.summary.fill(self.summary_slice)
+        self.request_render()
+        if self.ctx.summary.pending():
+            self.summary_pending = self.after(1, self.poll_summary)
+    
+    def update_scrollbar(self):
+        total = max(1, self.ctx.layout.total_height())
+        scroll_y = self.ctx.scroll.scroll_y
+        view = (scroll_y / total, min(1.0, (scroll_y + self.canvas.winfo_height()) / total))
+        if view != self.scrollbar_view:
+            self.scrollbar.set(*view)
+            self.scrollbar_view = view
+    
+    def poll_highlight(self):
+        # lex the lines an edit or a newly opened file left behind, one slice per callback
+        self.highlight_pending = None
+        self.ctx.highlighter.run(self.highlight_slice)
+        self.request_render()
+        if self.ctx.highlighter.pending():
+            self.highlight_pending = self.after(1, self.poll_highlight)
+    
+    def request_render(self, full: bool = False):
+        self.full_render_requested = self.full_render_requested or full
+        if self.ctx.profiler.enabled and self.first_request_time is None:
+            self.first_request_time = time.perf_counter()
+        if self.render_pending is not None:
+            self.frames_coalesced += 1
             return
-        command = self.undo_stack.pop()
-        command.undo()
-      
+        # paint when idle, but no sooner than one frame after the previous paint
+        wait = self.last_frame_time + 1 / self.max_fps - time.perf_counter()
+        if wait > 0:
+            self.render_pending = self.after(int(wait * 1000) + 1, self.run_frame)
+        else:
+            self.render_pending = self.after_idle(self.run_frame)
+    
+    def run_frame(self):
+        self.render_pending = None
+        self.last_frame_time = start = time.perf_counter()
+        self.frames_executed += 1
+        if self.full_render_requested:
+            self.full_render_requested = False
+            self.ctx.renderer.render()
+        else:
+            self.ctx.renderer.update()
+        self.ctx.minimap.render()
+        self.update_scrollbar()
+        if self.ctx.profiler.enabled:
+            self.ctx.profiler.end_frame(start, self.first_request_time)
+            self.first_request_time = None
+        if self.ctx.layout.pending() and self.layout_pending is None:
+            self.layout_pending = self.after(1, self.poll_layout)
+        if self.ctx.highlighter.pending() and self.highlight_pending is None:
+            self.highlight_pending = self.after(1, self.poll_highlight)
+        if self.ctx.summary.pending() and self.summary_pending is None:
+            self.summary_pending = self.after(1, self.poll_summary)
+
 class DocumentModel:
-    def __init__(self, ctx: EditorContext):
+    def __init__(self, ctx: EditorContext, storage_class=PieceTable):
         self.ctx = ctx
         self.text = "Hello World\nThis is a sample text\nEach line is separated by a newline character\nPython handles this using \\n\na\nb\nc\na\na\na\na\na\na\na\na\na\na\na\na\na\na\na\na\na\na\na\na\na\na\na\na\na\na\na\na\na\na\nend"
-        self.lines = []
-        #TODO: reformat cursor index
-        self.cursor_x_index = 0  # position of the cursor in the text
-        self.cursor_y_index = 0
-        self.preferred_cursor_x = self.cursor_x_index
-        #selection
-        self.selection_index = {
-            'anchor': None, #x,y
-            'active': None,
-            #'direction': ""
-            }
+        self.storage_class = storage_class # pluggable text storage backend, see storage.py
+        self.storage = self.storage_class()
+        self.file_path = None
+        self.encoding = "utf-8"
+        self.save_task = None # background save in progress
+        self.edits_since_snapshot = None # storage edits made while save_task runs
+        self.search = None # last find, its match index follows the edits
+        self.paste_transfer = None # chunked paste in progress, see clipboard.py
+        self.selection = Selection() # primary cursor and selection, the one kept in view
+        self.selections = [self.selection] # every cursor, sorted and not overlapping
+        #observers
+        self.observers = [] # callbacks taking a DocumentChange
 
+    def add_observer(self, callback):
+        self.observers.append(callback)
+    
+    def notify(self, change: DocumentChange):
+        for callback in self.observers:
+            callback(change)
+    
+    def announce(self):
+        # observers that start out empty (one empty line) learn the whole document,
+        # e.g. the views of a buffer that is shown for the first time
+        self.notify(DocumentChange(0, 0, self.get_line_number() - 1, cursor_moved=True, selection_moved=True))
+    
     def parse_text(self):
-        # split text into lines based on newline characters
-        lines = self.text.split("\n")
-        return lines
+        # load text into the storage backend, lines are split by the storage
+        return self.storage_class(self.text)
+    
+    def open_file(self, path: str):
+        # the storage maps the file and only decodes the lines that are read,
+        # big files keep loading in the background, see load_more
+        self.file_path = path
+        self.storage.stop_loading() # the previous file is not needed anymore
+        self.set_storage(self.storage_class.from_file(path, self.encoding, executor=self.ctx.executor))
+        self.trailing_line()
+    
+    def set_storage(self, storage):
+        # swap in new document contents, cursor and view go back to the start
+        old_last_line = self.get_line_number() - 1
+        if self.save_task is not None:
+            # a save of the old contents must not re-base the new ones
+            self.save_task.cancel()
+            self.save_task = None
+            self.edits_since_snapshot = None
+        if self.search is not None:
+            self.search.cancel()
+            self.search = None
+        self.replace_storage(storage)
+        self.set_cursor(0)
+        self.notify(DocumentChange(0, old_last_line, self.get_line_number() - 1, cursor_moved=True, selection_moved=True))
+        self.ctx.scroll.scroll_y = 0
+        self.ctx.scroll.stop()
+        self.ctx.scroll.calculate_visible_lines()
+    
+    def save(self, path: str | None = None):
+        # streamed to a temp file and renamed over the target, unchanged parts of the
+        # opened file are copied as bytes
+        path = path or self.file_path
+        self.finish_loading()
+        self.storage.write_file(path, self.encoding)
+        self.file_path = path
+        # keep editing on top of the saved file, this also folds all pieces into one
+        self.replace_storage(self.storage_class.from_file(path, self.encoding, background=False))
+    
+    def replace_storage(self, storage):
+        # the old storage's file is closed unless the new storage reads it too (journal replay)
+        old = self.storage
+        self.storage = storage
+        if old is not storage and not old.shares_source(storage):
+            old.close()
+    
+    def save_in_background(self, path: str | None = None, on_saved=None):
+        # save() on a worker: the text as of now is written from a storage snapshot,
+        # edits made meanwhile are recorded and replayed on the saved file once it is done
+        path = path or self.file_path
+        self.finish_loading() # the snapshot must cover the whole file
+        previous = self.save_task
+        if previous is not None:
+            previous.cancel()
+        snapshot = self.storage.snapshot()
+        encoding = self.encoding
+        storage_class = self.storage_class
+        self.edits_since_snapshot = []
+        
+        def write(task):
+            if previous is not None:
+                previous.wait() # an older save of the same file must not rename over this one
+            snapshot.write_file(path, encoding, task.cancelled)
+            return storage_class.from_file(path, encoding, background=False)
+        
+        def done(storage):
+            for name, args in self.edits_since_snapshot:
+                getattr(storage, name)(*args)
+            self.replace_storage(storage) # same text, observers have nothing to update
+            self.file_path = path
+            self.save_task = None
+            self.edits_since_snapshot = None
+            if on_saved is not None:
+                on_saved()
+        
+        def failed(error):
+            self.save_task = None
+            self.edits_since_snapshot = None
+            raise error
+        
+        self.save_task = self.ctx.executor.submit(write, on_done=done, on_error=failed)
+        return self.save_task
+    
+    def finish_loading(self):
+        # index the rest of the opened file now and add it to the document
+        self.storage.finish_loading()
+        self.load_more()
+    
+    def load_more(self):
+        # add the part of the file that was indexed since the last call
+        line_count = self.get_line_number()
+        previous = len(self.storage)
+        offset = self.storage.load_more()
+        if offset is None:
+            return
+        line = self.storage.offset_to_position(offset)[0]
+        for selection in self.selections:
+            selection.shift(offset, len(self.storage) - previous)
+        self.notify(DocumentChange(line, line, line + self.get_line_number() - line_count))
+        self.ctx.scroll.calculate_visible_lines()
     
     def trailing_line(self):
-        if self.lines[-1] != "":
-            self.lines.append("")  # ensure there's an empty line at the end for new text  
+        last_line = self.get_line_number() - 1
+        if self.line_length(last_line) != 0:
+            self.storage_insert(len(self.storage), "\n")  # ensure there's an empty line at the end for new text  
+            self.notify(DocumentChange(last_line, last_line, last_line + 1))
     
     def get_line_number(self):
-        return len(self.lines)
+        return self.storage.line_count()
+    
+    def get_line(self, line: int):
+        return self.storage.get_line(line)
+    
+    def line_length(self, line: int):
+        return self.storage.line_length(line)
+    
+    def cursor_offset(self):
+        return self.selection.active
+    
+    def cursor_position(self):
+        # (line, column) of the cursor
+        return self.storage.offset_to_position(self.selection.active)
     
     def move_cursor(self, direction: Direction):
+        # moves collapse the selections, every cursor moves the same way
+        had_selection = self.has_selection()
+        for selection in self.selections:
+            self.move_selection(selection, direction)
+        if len(self.selections) > 1:
+            self.normalize_selections()
+        self.ctx.scroll.keep_cursor_in_view()
+        self.notify(DocumentChange(cursor_moved=True, selection_moved=had_selection))
+    
+    def move_selection(self, selection: Selection, direction: Direction):
+        # up / down keep the column of the last horizontal move
+        offset = selection.active
+        line, column = self.storage.offset_to_position(offset)
         if direction == Direction.LEFT:
-            if self.cursor_x_index > 0:
-                self.cursor_x_index -= 1
-            elif self.cursor_x_index == 0 and self.cursor_y_index > 0:
-                self.cursor_y_index -= 1
-                self.cursor_x_index = len(self.lines[self.cursor_y_index])
-            self.normalize_cursor_position()
-            self.preferred_cursor_x = self.cursor_x_index
+            offset = max(0, offset - 1)
         elif direction == Direction.RIGHT:
-            if self.cursor_x_index == len(self.lines[self.cursor_y_index]):
-                self.cursor_y_index += 1
-                self.cursor_x_index = 0
-            else: 
-                self.cursor_x_index += 1
-            self.normalize_cursor_position()
-            self.preferred_cursor_x = self.cursor_x_index
-        elif direction == Direction.UP:
-            self.cursor_y_index -= 1
-            self.normalize_cursor_position(use_preferred=True)
-        elif direction == Direction.DOWN:
-            self.cursor_y_index += 1
-            self.normalize_cursor_position(use_preferred=True)
+            offset = min(len(self.storage), offset + 1)
+        elif direction in (Direction.UP, Direction.DOWN):
+            if selection.preferred_column is None:
+                selection.preferred_column = column
+            line += -1 if direction == Direction.UP else 1
+            if 0 <= line < self.get_line_number():
+                offset = self.storage.line_start(line) + min(selection.preferred_column, self.line_length(line))
         elif direction == Direction.LINE_START:
-            self.cursor_x_index = 0
-            self.normalize_cursor_position()
-            self.preferred_cursor_x = self.cursor_x_index
+            offset -= column
         elif direction == Direction.LINE_END:
-            line = self.lines[self.cursor_y_index]
-            self.cursor_x_index = len(line)
-            self.normalize_cursor_position()
-            self.preferred_cursor_x = self.cursor_x_index
-        self.ctx.scroll.keep_cursor_in_view()
-        
-    def normalize_cursor_position(self, use_preferred: bool = False):
-        # Vertical bounds
-        self.cursor_y_index = max(self.cursor_y_index, 0)
-        self.cursor_y_index = min(self.cursor_y_index, self.get_line_number() - 1)   
-        
-        line = self.lines[self.cursor_y_index] # current line after vertical normalization to avoid index errors
-        
-        # Horizontal bounds
-        if use_preferred:
-            self.cursor_x_index = min(self.preferred_cursor_x, len(line))
-        else:
-            self.cursor_x_index = max(self.cursor_x_index, 0)
-            self.cursor_x_index = min(self.cursor_x_index, len(line))    
+            offset = self.storage.line_end(line)
+        preferred_column = selection.preferred_column if direction in (Direction.UP, Direction.DOWN) else None
+        selection.collapse(offset)
+        selection.preferred_column = preferred_column
     
-    def insert_at_cursor(self, str):
-        line = self.lines[self.cursor_y_index]
-        self.lines[self.cursor_y_index] = (
-                line[: self.cursor_x_index]
-                + str
-                + line[self.cursor_x_index :]
-            )
+    # every storage edit goes through these so a background save can replay them and
+    # the search index can follow them, edits are (storage method name, args)
+    def storage_edited(self, name: str, args: tuple):
+        if self.edits_since_snapshot is not None:
+            self.edits_since_snapshot.append((name, args))
+        if self.search is not None:
+            self.search.on_edit(name, args)
+    
+    def storage_insert(self, offset: int, text: str):
+        self.storage.insert(offset, text)
+        self.storage_edited("insert", (offset, text))
+    
+    def storage_delete(self, start: int, end: int):
+        self.storage.delete(start, end)
+        self.storage_edited("delete", (start, end))
+    
+    def storage_apply_edits(self, edits: list):
+        self.storage.apply_edits(edits)
+        self.storage_edited("apply_edits", (edits,))
+    
+    def insert_text(self, offset: int, text: str):
+        # insert text at offset in one storage edit, cursor ends after the text
+        if not text:
+            return
+        line = self.storage.offset_to_position(offset)[0]
+        self.storage_insert(offset, text)
+        had_selection = self.has_selection()
+        self.set_cursor(offset + len(text))
+        # observers first, the view update reads line positions from the layout
+        self.notify(DocumentChange(
+            line, line, line + text.count("\n"),
+            cursor_moved=True, selection_moved=had_selection
+        ))
         self.trailing_line()
-        for ch in str:
-            self.move_cursor(Direction.RIGHT)
-        
-        
-    def delete_at_cursor(self, i: int):
-        for j in range(i):
-            text_after_cursor = ""
-            if self.cursor_x_index > 0:
-                current_line = self.lines[self.cursor_y_index]
-                text_after_cursor = current_line[self.cursor_x_index :]
-                current_line = current_line[: self.cursor_x_index - 1] + current_line[self.cursor_x_index :]
-                self.lines[self.cursor_y_index] = current_line
-                self.move_cursor(Direction.LEFT) 
-            elif self.cursor_x_index == 0 and self.cursor_y_index > 0:
-                current_line = self.lines[self.cursor_y_index]
-                text_after_cursor = current_line[self.cursor_x_index :]
-                previous_line = self.lines[self.cursor_y_index - 1]
-                # merge lines
-                previous_line = previous_line + text_after_cursor
-                #move cursor
-                self.move_cursor(Direction.LEFT)
-                #update buffer
-                self.lines[self.cursor_y_index] = previous_line
-                #delete line
-                self.lines.pop(self.cursor_y_index + 1)
-                #recalculate visable lines            
-            elif self.cursor_x_index == 0 and self.cursor_y_index == 0: #if line empty
-                pass
-        self.ctx.scroll.calculate_visible_lines()
+        self.refresh_view()
+    
+    def delete_range(self, start: int, end: int):
+        # delete text between two offsets in one storage edit, cursor ends at the start
+        start, end = min(start, end), max(start, end)
+        if start == end:
+            return
+        start_line = self.storage.offset_to_position(start)[0]
+        end_line = self.storage.offset_to_position(end)[0]
+        self.storage_delete(start, end)
+        had_selection = self.has_selection()
+        self.set_cursor(start)
+        self.notify(DocumentChange(
+            start_line, end_line, start_line,
+            cursor_moved=True, selection_moved=had_selection
+        ))
+        self.refresh_view()
     
-    def move_cursor_to_index(self, x, y):
-        self.cursor_x_index = x
-        self.cursor_y_index = y
-        self.normalize_cursor_position()  
+    def apply_edits(self, edits: list):
+        # (start, end, text) replacements, sorted and not overlapping, as one storage edit
+        # and one notification, the storage applies them back to front
+        if not edits:
+            return
+        first_line = self.storage.offset_to_position(edits[0][0])[0]
+        old_last_line = self.storage.offset_to_position(edits[-1][1])[0]
+        # length change of all edits before each one
+        shifts = list(accumulate(map(len, map(itemgetter(2), edits)), initial=0))
+        removed = list(accumulate(map(sub, map(itemgetter(1), edits), map(itemgetter(0), edits)), initial=0))
+        def moved(offset):
+            # offsets inside or at the edge of a replaced range end up after its new text
+            index = bisect_right(edits, offset, key=itemgetter(0))
+            if index and edits[index - 1][1] >= offset:
+                index -= 1
+                return edits[index][0] + shifts[index] - removed[index] + len(edits[index][2])
+            return offset + shifts[index] - removed[index]
+        self.storage_apply_edits(edits)
+        for selection in self.selections:
+            selection.anchor = moved(selection.anchor)
+            selection.active = moved(selection.active)
+            selection.preferred_column = None
+        self.normalize_selections()
+        self.notify(DocumentChange(
+            first_line, old_last_line, self.storage.offset_to_position(moved(edits[-1][1]))[0],
+            cursor_moved=True, selection_moved=True
+        ))
+        self.trailing_line()
+        self.refresh_view()
+    
+    def split_line(self, offset: int):
+        # the text after offset moves to a new line below, one storage insert and a
+        # two line change for the observers, nothing depends on the document length
+        self.insert_text(offset, "\n")
+    
+    def join_lines(self, line: int):
+        # line and the line below it become one
+        if line + 1 < self.get_line_number():
+            end = self.storage.line_end(line)
+            self.delete_range(end, end + 1)
+    
+    def refresh_view(self):
+        # single scroll / visible line update after an edit
+        if not self.ctx.scroll.keep_cursor_in_view():
+            self.ctx.scroll.calculate_visible_lines()
+    
+    def insert_at_cursor(self, str):
+        self.insert_text(self.selection.active, str)
+        
+    def move_cursor_to(self, offset: int):
+        self.set_cursor(min(max(offset, 0), len(self.storage)))
+        self.notify(DocumentChange(cursor_moved=True, selection_moved=True))
         
     def move_cursor_to_mouse(self, mouse_x, mouse_y): 
-        self.cursor_x_index, self.cursor_y_index = self.coords_to_index(
-        mouse_x, mouse_y + self.ctx.scroll.scroll_y
-        )
-        self.normalize_cursor_position()  
+        self.set_cursor(self.screen_coords_to_offset(mouse_x, mouse_y))
         self.ctx.scroll.keep_cursor_in_view()
+        self.notify(DocumentChange(cursor_moved=True, selection_moved=True))
     
-    # raw pixels to text index
-    def coords_to_index(self, x=0, y=0):
-        line_index = y // self.ctx.renderer.line_height
-        line_index = min(max(line_index, 0), len(self.lines) - 1)
-        column_index = (x - self.ctx.renderer.left_padding) // self.ctx.renderer.char_width
-        column_index = min(max(column_index, 0), len(self.lines[line_index]))
-        # check if cursor is past half a character
-        char_start_x = self.ctx.renderer.left_padding + column_index * self.ctx.renderer.char_width
-        if x - char_start_x > self.ctx.renderer.char_width / 2:
-            column_index += 1
-            column_index = min(column_index, len(self.lines[line_index]))
-        return column_index, line_index
-        
-    def screen_coords_to_index(self, screen_x=0, screen_y=0):
+    # raw pixels to text offset
+    def coords_to_offset(self, x=0, y=0):
+        line_index, row = self.ctx.layout.position_at(y)
+        # columns of the visual row under y, a wrapped row ends before the next row's first column
+        breaks = self.ctx.layout.line_breaks(line_index)
+        row = min(row, len(breaks) - 1)
+        row_start = breaks[row]
+        row_end = breaks[row + 1] - 1 if row + 1 < len(breaks) else self.line_length(line_index)
+        # binary search over the x positions of the row, past half a character is the next column
+        text = self.get_line(line_index)[row_start:row_end]
+        column_index = self.ctx.renderer.metrics.column_at(text, x - self.ctx.renderer.left_padding)
+        return self.storage.line_start(line_index) + row_start + column_index
+        
+    def screen_coords_to_offset(self, screen_x=0, screen_y=0):
         doc_x = screen_x
         doc_y = screen_y + self.ctx.scroll.scroll_y
-        return self.coords_to_index(doc_x, doc_y)
+        return self.coords_to_offset(doc_x, doc_y)
     
     def set_selection(self, cursor_x, cursor_y):
-        column, line = self.screen_coords_to_index(cursor_x, cursor_y)
-        if self.selection_index['anchor'] is None:
-            self.selection_index['anchor'] = (column, line)
-        self.selection_index['active'] = (column, line)
-        self.move_cursor_to_mouse(cursor_x, cursor_y)
+        # drag: the anchor stays where the button went down, the cursor follows the mouse
+        self.selection.active = self.screen_coords_to_offset(cursor_x, cursor_y)
+        self.selection.preferred_column = None
         self.ctx.scroll.keep_cursor_in_view()
+        self.notify(DocumentChange(cursor_moved=True, selection_moved=True))
         
     def clear_selection(self):
-        # Clear previous selection
-        self.selection_index['anchor'] = None
-        self.selection_index['active'] = None
-        
-    def delete_selected_text(self):
-        anchor_x, anchor_y = self.selection_index['anchor']
-        active_x, active_y = self.selection_index['active']
-        
-        #normalize start end index
-        line_start = min(anchor_y, active_y)
-        line_end   = max(anchor_y, active_y)
-        
-        if anchor_y == active_y:
-            column_start = min(anchor_x, active_x)
-            column_end   = max(anchor_x, active_x)
-        elif anchor_y < active_y:
-            column_start = anchor_x
-            column_end   = active_x
-        else:
-            column_start = active_x
-            column_end   = anchor_x
-        # selection in only 1 line
-        if line_start == line_end:
-            current_line = self.lines[line_start]
-            current_line = current_line[: column_start] + current_line[column_end :]
-            self.lines[line_start] = current_line
-            
-        else:
-            for line in range(line_end, line_start - 1, -1):
-                    # line at end index 
-                    if line == line_end:
-                        end_tail = self.lines[line][column_end:]
-                        self.lines.pop(line)
-                    # line at start index
-                    elif line == line_start:
-                        current_line = self.lines[line]
-                        current_line = current_line[: column_start] + end_tail
-                        self.lines[line] = current_line
-                    
-                    #else delete the whole line
-                    else:
-                        self.lines.pop(line)
-        self.normalize_cursor_position()
-        self.cursor_x_index = column_start
-        self.cursor_y_index = line_start
-        self.ctx.scroll.calculate_visible_lines()
-        self.ctx.scroll.keep_cursor_in_view()
-        self.clear_selection()
-    
-    def replace_selected_text(self, str):
-        self.delete_selected_text()
-        self.insert_at_cursor(str)
+        had_selection = self.has_selection()
+        for selection in self.selections:
+            selection.collapse(selection.active)
+        if had_selection:
+            self.notify(DocumentChange(selection_moved=True))
+        
+    def selection_delete_command(self):
+        start, end = self.selection.start(), self.selection.end()
+        return DeleteCommand(start, self.storage.text(start, end))
     
+    # user edits below go through the command manager so they can be undone
     def delete(self, i= 1):
-        if self.selection_index['anchor'] is not None and self.selection_index['active'] is not None:
-            self.delete_selected_text()
+        if len(self.selections) > 1:
+            # selected text, or i characters before each cursor
+            self.edit_selections(lambda selection: (
+                (selection.start(), selection.end(), "") if not selection.empty()
+                else (max(0, selection.active - i), selection.active, "")
+            ))
+            return
+        if not self.selection.empty():
+            command = self.selection_delete_command()
+            self.clear_selection()
         else:
-            self.delete_at_cursor(i)
+            end = self.selection.active
+            start = max(0, end - i)
+            if start == end:
+                return
+            text = self.storage.text(start, end)
+            command = JoinLinesCommand(start) if text == "\n" else DeleteCommand(start, text)
+        self.ctx.command_manager.execute(command)
     
     def insert_str(self, str):
-        if self.selection_index['anchor'] is not None and self.selection_index['active'] is not None:
-            self.replace_selected_text(str)
+        if not str:
+            return
+        if len(self.selections) > 1:
+            self.edit_selections(lambda selection: (selection.start(), selection.end(), str))
+            return
+        if not self.selection.empty():
+            # replace selection
+            delete = self.selection_delete_command()
+            self.clear_selection()
+            command = CompoundCommand([delete, InsertCommand(delete.offset, str)])
         else:
-            self.insert_at_cursor(str)
+            command = InsertCommand(self.selection.active, str)
+        self.ctx.command_manager.execute(command)
     
-    def copy_text(self):
-        if self.selection_index['anchor'] is not None and self.selection_index['active'] is not None:
-            anchor_x, anchor_y = self.selection_index['anchor']
-        active_x, active_y = self.selection_index['active']
-        
-        #normalize start end index
-        line_start = min(anchor_y, active_y)
-        line_end   = max(anchor_y, active_y)
-        
-        if anchor_y == active_y:
-            column_start = min(anchor_x, active_x)
-            column_end   = max(anchor_x, active_x)
-        elif anchor_y < active_y:
-            column_start = anchor_x
-            column_end   = active_x
-        else:
-            column_start = active_x
-            column_end   = anchor_x
-        # add selected text from each line
-        copied_text = []
-        # selection in only 1 line
-        if line_start == line_end:
-            current_line = self.lines[line_start]
-            self.ctx.clipboard.copy(current_line[column_start : column_end])
+    def newline(self):
+        # Return: the line splits at the cursor, a selection or several cursors get a newline each
+        if len(self.selections) > 1 or not self.selection.empty():
+            self.insert_str("\n")
             return
-        for line in range(line_start, line_end + 1):
-                current_line = self.lines[line]
-                # line at start index
-                if line == line_start:
-                    copied_text.append(current_line[column_start :])
-                # line at end index 
-                elif line == line_end:
-                    copied_text.append(current_line[: column_end])
-                #else add the whole line
-                else:
-                    copied_text.append(current_line)
-        copied_text = "\n".join(copied_text)
-        self.ctx.clipboard.copy(copied_text)
+        self.ctx.command_manager.execute(SplitLineCommand(self.selection.active))
+    
+    def copy_text(self):
+        # several selections are copied one per line, as spans of a snapshot, nothing is
+        # read until the text is pasted or handed to the system clipboard,
+        # returns the clipboard's transfer still to run, if any
+        ranges = [(selection.start(), selection.end()) for selection in self.selections if not selection.empty()]
+        if ranges:
+            return self.ctx.clipboard.copy(ClipboardContent(self.storage.snapshot(), ranges))
+        return None
      
-    def paste_text(self): # TODO
-        if self.selection_index['anchor'] is not None and self.selection_index['active'] is not None:
-            self.delete_selected_text()
-        self.insert_at_cursor(self.ctx.clipboard.paste())
+    def paste_text(self):
+        # more than CHUNK_SIZE characters at one cursor are pasted by the returned transfer
+        content = self.ctx.clipboard.paste()
+        if not content or self.paste_transfer is not None:
+            return None
+        if len(self.selections) == 1:
+            if len(content) > CHUNK_SIZE:
+                self.paste_transfer = PasteTransfer(self, content)
+                return self.paste_transfer
+            self.insert_str(content_text(content))
+            return None
+        # one line per cursor when the counts match, like copy_text writes them
+        text = content_text(content)
+        lines = text.split("\n")
+        parts = iter(lines if len(lines) == len(self.selections) else [text] * len(self.selections))
+        self.edit_selections(lambda selection: (selection.start(), selection.end(), next(parts)))
+    
+    # --- multiple cursors ---
+    # self.selections is kept sorted and without overlaps, self.selection is one of them
+    def has_selection(self):
+        return any(not selection.empty() for selection in self.selections)
+    
+    def set_cursor(self, offset: int):
+        # back to a single cursor at offset
+        self.selection.collapse(offset)
+        self.selection.preferred_column = None
+        self.selections = [self.selection]
+    
+    def keep_primary_cursor(self):
+        # drop the other cursors and the selection
+        self.set_cursor(self.selection.active)
+        self.notify(DocumentChange(cursor_moved=True, selection_moved=True))
+    
+    def add_cursor(self, offset: int):
+        # the new cursor becomes the primary one
+        self.selection = Selection(min(max(offset, 0), len(self.storage)))
+        self.selections.append(self.selection)
+        self.normalize_selections()
+        self.notify(DocumentChange(cursor_moved=True, selection_moved=True))
+    
+    def select_block(self, anchor: int, active: int):
+        # rectangular selection between two offsets, one selection per line over the same
+        # columns, clamped to lines that are shorter
+        storage = self.storage
+        anchor_line, anchor_column = storage.offset_to_position(anchor)
+        active_line, active_column = storage.offset_to_position(active)
+        selections = []
+        for line in range(min(anchor_line, active_line), max(anchor_line, active_line) + 1):
+            start = storage.line_start(line)
+            length = storage.line_length(line)
+            selections.append(Selection(start + min(anchor_column, length), start + min(active_column, length)))
+        self.selection = selections[0] if active_line < anchor_line else selections[-1]
+        self.selections = selections
+        self.ctx.scroll.keep_cursor_in_view()
+        self.notify(DocumentChange(cursor_moved=True, selection_moved=True))
+    
+    def select_all_matches(self):
+        # a selection on every match of the last find, the one at the cursor is the primary
+        if self.search is None or not len(self.search.index):
+            return False
+        cursor = self.selection.start()
+        self.selections = [Selection(start, end) for start, end in self.search.index]
+        index = bisect_left(self.selections, cursor, key=Selection.start)
+        self.selection = self.selections[min(index, len(self.selections) - 1)]
+        self.ctx.scroll.keep_cursor_in_view()
+        self.notify(DocumentChange(cursor_moved=True, selection_moved=True))
+        return True
+    
+    def selections_between(self, start: int, end: int):
+        # selections touching [start, end], in order
+        selections = self.selections
+        index = bisect_left(selections, start, key=Selection.end)
+        while index < len(selections) and selections[index].start() <= end:
+            yield selections[index]
+            index += 1
+    
+    def normalize_selections(self):
+        # sort and merge selections that overlap or cursors that meet, the merged
+        # selection stays primary if either part was
+        self.selections.sort(key=Selection.start)
+        merged = []
+        for selection in self.selections:
+            previous = merged[-1] if merged else None
+            if previous is None or selection.start() > previous.end() or (
+                    selection.start() == previous.end() and not selection.empty() and not previous.empty()):
+                merged.append(selection)
+                continue
+            end = max(previous.end(), selection.end())
+            if previous.active >= previous.anchor:
+                previous.active = end
+            else:
+                previous.anchor = end
+            if selection is self.selection:
+                self.selection = previous
+        self.selections = merged
+    
+    def edit_selections(self, edit_for):
+        # edit_for(selection) -> (start, end, text) for every selection, applied as one
+        # storage edit and one undo entry instead of an edit per cursor
+        edits = []
+        for selection in self.selections:
+            start, end, text = edit_for(selection)
+            if start == end and not text:
+                continue
+            if edits and start < edits[-1][1]:
+                # backspace at neighbouring cursors reaching into each other
+                previous = edits[-1]
+                edits[-1] = (previous[0], max(previous[1], end), previous[2] + text)
+            else:
+                edits.append((start, end, text))
+        if not edits:
+            return
+        storage = self.storage
+        self.ctx.command_manager.execute(ReplaceAllCommand(
+            [edit[0] for edit in edits],
+            [storage.text(edit[0], edit[1]) if edit[1] > edit[0] else "" for edit in edits],
+            [edit[2] for edit in edits],
+        ))
+    
+    # --- search ---
+    def find(self, pattern: str, regex: bool = False, case_sensitive: bool = True, on_found=None):
+        # search the whole document from the cursor on, the first match is selected as soon
+        # as the background scan reports it, then on_found() is called
+        self.finish_loading() # the scan must cover the whole file
+        if self.search is not None:
+            self.search.cancel()
+        self.search = Search(self.ctx, pattern, regex, case_sensitive)
+        def found():
+            self.search.on_found = None
+            self.find_next()
+            if on_found is not None:
+                on_found()
+        self.search.on_found = found
+        self.search.start(self.cursor_offset())
+        return self.search
+    
+    def find_next(self, backwards: bool = False):
+        # select the next match after the cursor (before the selection), wrapping around
+        if self.search is None:
+            return False
+        index = self.search.index
+        if backwards:
+            match = index.before(self.selection.start()) or index.last()
+        else:
+            match = index.after(self.selection.active) or index.first()
+        if match is None:
+            return False
+        self.select_range(*match)
+        return True
+    
+    def select_range(self, start: int, end: int):
+        # select [start, end) with the cursor at the end and scroll it into view
+        self.set_cursor(start)
+        self.selection.active = end
+        self.ctx.scroll.keep_cursor_in_view()
+        self.notify(DocumentChange(cursor_moved=True, selection_moved=True))
+    
+    def replace_all(self, replacement: str, pattern: str | None = None, regex: bool = False, case_sensitive: bool = True):
+        # every match replaced in one bulk edit that is undone as one, returns the match count
+        # pattern defaults to the last find, regex replacements may use \1 and \g<name>
+        if pattern is None:
+            if self.search is None:
+                return 0
+            pattern, regex, case_sensitive = self.search.pattern, self.search.regex, self.search.case_sensitive
+        self.finish_loading()
+        compiled = compile_query(pattern, regex, case_sensitive)
+        offsets, old_texts, new_texts = [], [], []
+        # one pass over the text with the match objects, the index has offsets only
+        for base, matches in iter_chunks(compiled, self.storage, 0, len(self.storage), regex=regex):
+            offsets.extend([base + match.start() for match in matches])
+            old_texts.extend([match.group() for match in matches])
+            new_texts.extend([match.expand(replacement) for match in matches] if regex else [replacement] * len(matches))
+        if offsets:
+            self.ctx.command_manager.execute(ReplaceAllCommand(offsets, old_texts, new_texts))
+        return len(offsets)
         
 class Renderer:
-    def __init__(self, ctx: EditorContext):
+    def __init__(self, ctx: EditorContext, editor_font=None):
         self.ctx = ctx
         
         # --- font & metrics ---
-        self.editor_font = font.Font(family="Courier New", size=16)
-        self.char_width = self.editor_font.measure("M")
+        # a tk font unless one is passed in, headless users pass an object with the same measure() / metrics()
+        self.editor_font = editor_font if editor_font is not None else font.Font(family="Courier New", size=16)
+        self.metrics = GlyphMetrics(self.editor_font) # glyph advances, shared by every buffer
+        self.char_width = self.metrics.char_width
         self.line_height = self.editor_font.metrics("linespace")
         self.ascent = self.editor_font.metrics("ascent")
         self.descent = self.editor_font.metrics("descent")
@@ -434,125 +1033,316 @@ class Renderer:
         self.left_padding = 10
         # self.top_padding = 20
         
+        # --- canvas items ---
+        # line mode draws one text item per line (the font is monospaced), items follow
+        # their line between frames and are only updated when it changes, scrolling moves
+        # all of them with one canvas.move and only lines entering or leaving the drawn
+        # band (visible lines plus overscan) take items from free_items or give them back
+        self.line_mode = True
+        self.line_items = {} # line -> {layer: [item id, text, y]}, y in document space
+        self.free_items = [] # blanked text items for lines entering the band
+        self.max_free_items = 256
+        self.origin_y = 0 # scroll_y the canvas items are placed for, screen y = y - origin_y
+        
+        # --- syntax colors ---
+        # a highlighted row is drawn as one text item per span kind (layer), each with the
+        # characters of the other kinds blanked, "text" is the plain layer
+        self.syntax_colors = {
+            "text": "black",
+            "keyword": "#0000FF",
+            "builtin": "#267F99",
+            "definition": "#795E26",
+            "string": "#A31515",
+            "number": "#098658",
+            "comment": "#008000",
+        }
+        self.cursor_items = [] # [item id, coords] per visible cursor
+        self.selection_items = [] # [item id, coords] of the visible selection rectangles
+        self.selection_geometry = {} # (start, end) offsets -> rectangles in document space
+        self.geometry_key = None # (canvas width, layout, its version) the geometry was computed for
+        
+        # --- dirty regions ---
+        # filled from document change notifications, update() repaints only these
+        self.dirty_lines = set()
+        self.dirty_from_line = None # every line from here down moved (lines added or removed)
+        self.cursor_dirty = False
+        self.selection_dirty = False
+        self.painted_view = None # (line_start_index, line_end_index) of the last frame
+        
     def render_text(self):
-        y = (self.ctx.scroll.line_start_index * self.line_height) - self.ctx.scroll.scroll_y
         for line in range(self.ctx.scroll.line_start_index, self.ctx.scroll.line_end_index):
-            x = self.left_padding
-            for ch in self.ctx.document.lines[line]:
+            y = self.ctx.layout.line_top(line) - self.ctx.scroll.scroll_y
+            text = self.ctx.document.get_line(line)
+            positions = self.metrics.positions(text)
+            for column, ch in enumerate(text):
                 self.ctx.canvas.create_text(
-                    x, y,
+                    self.left_padding + positions[column], y,
                     text=ch,
                     font=self.editor_font,
                     anchor="nw"
                 )
-                x += self.char_width
-            y += self.line_height
+    
+    def render_lines(self):
+        # every line of the band is checked, only lines whose text or position changed cost canvas calls
+        first_line, last_line = self.ctx.scroll.line_start_index, self.ctx.scroll.line_end_index
+        self.release_lines(first_line, last_line)
+        for line in range(first_line, last_line):
+            self.render_row(line)
+    
+    def render_row(self, line: int):
+        y = self.ctx.layout.line_top(line)
+        layers = self.row_layers(line)
+        items = self.line_items.setdefault(line, {})
+        for layer, text in layers.items():
+            item = items.get(layer)
+            if item is None:
+                items[layer] = self.acquire_item(layer, text, y)
+                continue
+            if item[1] != text:
+                self.ctx.canvas.itemconfigure(item[0], text=text)
+                item[1] = text
+            if item[2] != y:
+                self.ctx.canvas.coords(item[0], self.left_padding, y - self.origin_y)
+                item[2] = y
+        # layers the line no longer has go back to the pool
+        for layer in [layer for layer in items if layer not in layers]:
+            self.release_item(items.pop(layer))
+    
+    def acquire_item(self, layer: str, text: str, y: int):
+        fill = self.syntax_colors.get(layer, "black")
+        if self.free_items:
+            item_id = self.free_items.pop()
+            self.ctx.canvas.itemconfigure(item_id, text=text, fill=fill)
+            self.ctx.canvas.coords(item_id, self.left_padding, y - self.origin_y)
+        else:
+            item_id = self.ctx.canvas.create_text(
+                self.left_padding, y - self.origin_y,
+                text=text,
+                font=self.editor_font,
+                fill=fill,
+                anchor="nw",
+                tags="text"
+            )
+        return [item_id, text, y]
+    
+    def release_item(self, item: list):
+        # blanked, a pooled item moves with the others but draws nothing
+        if len(self.free_items) < self.max_free_items:
+            self.ctx.canvas.itemconfigure(item[0], text="")
+            self.free_items.append(item[0])
+        else:
+            self.ctx.canvas.delete(item[0])
+    
+    def release_lines(self, first_line: int, last_line: int):
+        # lines outside [first_line, last_line) give their items back
+        for line in [line for line in self.line_items if not first_line <= line < last_line]:
+            for item in self.line_items.pop(line).values():
+                self.release_item(item)
+    
+    def shift_items(self):
+        # follow scroll_y by moving every item at once, positions kept in document space stay valid
+        delta = self.origin_y - self.ctx.scroll.scroll_y
+        if delta:
+            self.ctx.canvas.move("all", 0, delta)
+            self.origin_y = self.ctx.scroll.scroll_y
+    
+    def row_layers(self, line: int):
+        # layer -> text to draw, wrapped rows are drawn by the same item
+        text = self.ctx.document.get_line(line)
+        breaks = self.ctx.layout.breaks(text)
+        if self.ctx.highlighter is None:
+            return {"text": self.ctx.layout.join_rows(text, breaks)}
+        layers = self.ctx.highlighter.layers(line, text)
+        if len(layers) > 1 and not self.metrics.uniform(text):
+            # blanked wide or proportional characters would move the glyphs after them,
+            # such rows are drawn in one color
+            return {"text": self.ctx.layout.join_rows(text, breaks)}
+        return {layer: self.ctx.layout.join_rows(masked, breaks) for layer, masked in layers.items()}
+    
+    def item_count(self):
+        # canvas items owned by the renderer, pooled ones included
+        return sum(map(len, self.line_items.values())) + len(self.free_items) + len(self.cursor_items) + len(self.selection_items)
+    
+    def visible_range(self):
+        # offsets of the first and last character on the visible lines
+        storage = self.ctx.document.storage
+        last_line = max(self.ctx.scroll.line_end_index - 1, self.ctx.scroll.line_start_index)
+        return storage.line_start(self.ctx.scroll.line_start_index), storage.line_end(last_line)
     
     def render_cursor(self):
-        if self.ctx.document.cursor_y_index in range(self.ctx.scroll.line_start_index, self.ctx.scroll.line_end_index):
-            cursor_x = self.left_padding + self.ctx.document.cursor_x_index * self.char_width
-            cursor_y = self.ctx.document.cursor_y_index * self.line_height - self.ctx.scroll.scroll_y
-            self.ctx.canvas.create_line(
-                cursor_x, cursor_y,
-                cursor_x, cursor_y + self.line_height,
-                fill="black",
-            ) 
+        # one line item per visible cursor, items are reused between frames
+        storage = self.ctx.document.storage
+        first, last = self.visible_range()
+        coords = []
+        for selection in self.ctx.document.selections_between(first, last):
+            if not first <= selection.active <= last:
+                continue
+            line, column = storage.offset_to_position(selection.active)
+            row, x = self.ctx.layout.column_x(line, column)
+            cursor_x = self.left_padding + x
+            cursor_y = self.ctx.layout.line_top(line) + row * self.line_height
+            coords.append((cursor_x, cursor_y, cursor_x, cursor_y + self.line_height))
+        origin = self.origin_y
+        for index, coord in enumerate(coords):
+            x1, y1, x2, y2 = coord
+            if index < len(self.cursor_items):
+                item = self.cursor_items[index]
+                if item[1] != coord:
+                    self.ctx.canvas.coords(item[0], x1, y1 - origin, x2, y2 - origin)
+                    item[1] = coord
+            else:
+                item_id = self.ctx.canvas.create_line(x1, y1 - origin, x2, y2 - origin, fill="black", tags="cursor")
+                self.cursor_items.append([item_id, coord])
+        # cursors scrolled out of view
+        for item in self.cursor_items[len(coords):]:
+            self.ctx.canvas.delete(item[0])
+        del self.cursor_items[len(coords):]
 
     def render_select(self):
-        anchor_x, anchor_y = self.ctx.document.selection_index['anchor']
-        active_x, active_y = self.ctx.document.selection_index['active']
-        
-        #normalize start end index
-        line_start = min(anchor_y, active_y)
-        line_end   = max(anchor_y, active_y)
-        
-        if anchor_y == active_y:
-            column_start = min(anchor_x, active_x)
-            column_end   = max(anchor_x, active_x)
-        elif anchor_y < active_y:
-            column_start = anchor_x
-            column_end   = active_x
-        else:
-            column_start = active_x
-            column_end   = anchor_x
-            
-        # clamp selection to visible lines
-        line_start = max(line_start, self.ctx.scroll.line_start_index)
-        line_end   = min(line_end, self.ctx.scroll.line_end_index - 1)
-        
-        if line_start > line_end:
-            return
-        
-        # selection in only 1 line
-        if line_start == line_end:
-            self.ctx.canvas.create_rectangle(
-                #x1
-                column_start * self.char_width + self.left_padding,
-                #y1
-                line_start * self.line_height - self.ctx.scroll.scroll_y,
-                #x2
-                column_end * self.char_width + self.left_padding,
-                #y2
-                line_end * self.line_height - self.ctx.scroll.scroll_y + self.line_height,
-                fill="#CCE8FF",
-                outline=""
-            )
-            return
-        
-        for line in range(line_start, line_end + 1):
-            # line at start index
-            if line == line_start:
-                self.ctx.canvas.create_rectangle(
-                    #x1
-                    column_start * self.char_width + self.left_padding,
-                    #y1
-                    line * self.line_height - self.ctx.scroll.scroll_y,
-                    #x2
-                    len(self.ctx.document.lines[line]) * self.char_width + self.left_padding,
-                    #y2
-                    line * self.line_height - self.ctx.scroll.scroll_y + self.line_height,
-                    fill="#CCE8FF",
-                    outline=""
-                )
-            # line at end index 
-            # - 1 for line_end is exclusive
-            elif line == line_end:
-                self.ctx.canvas.create_rectangle(
-                    #x1
-                    self.left_padding,
-                    #y1
-                    line * self.line_height - self.ctx.scroll.scroll_y,
-                    #x2
-                    column_end * self.char_width + self.left_padding,
-                    #y2
-                    line * self.line_height - self.ctx.scroll.scroll_y + self.line_height,
-                    fill="#CCE8FF",
-                    outline=""
-                )
-            #else print the whole line
+        # selection rectangles are kept as canvas items between frames and only moved when
+        # their coordinates change, so dragging touches the rectangles at the moving end
+        canvas = self.ctx.canvas
+        width = canvas.winfo_width()
+        if self.geometry_key != (width, self.ctx.layout, self.ctx.layout.version):
+            self.geometry_key = (width, self.ctx.layout, self.ctx.layout.version)
+            self.selection_geometry.clear()
+        first, last = self.visible_range()
+        top = self.ctx.scroll.scroll_y
+        bottom = top + canvas.winfo_height()
+        coords = []
+        for selection in self.ctx.document.selections_between(first, last):
+            if selection.empty():
+                continue
+            for x1, y1, x2, y2 in self.selection_rects(selection.start(), selection.end(), width):
+                # clipped to the view, a merged rectangle can be taller than the document shown
+                y1 = max(y1, top - self.line_height)
+                y2 = min(y2, bottom + self.line_height)
+                if y1 < y2:
+                    coords.append((x1, y1, x2, y2))
+        origin = self.origin_y
+        created = False
+        for index, coord in enumerate(coords):
+            x1, y1, x2, y2 = coord
+            if index < len(self.selection_items):
+                item = self.selection_items[index]
+                if item[1] != coord:
+                    canvas.coords(item[0], x1, y1 - origin, x2, y2 - origin)
+                    item[1] = coord
             else:
-                self.ctx.canvas.create_rectangle(
-                    #x1
-                    self.left_padding,
-                    #y1
-                    line * self.line_height - self.ctx.scroll.scroll_y,
-                    #x2
-                    len(self.ctx.document.lines[line]) * self.char_width + self.left_padding,
-                    #y2
-                    line * self.line_height - self.ctx.scroll.scroll_y + self.line_height,
-                    fill="#CCE8FF",
-                    outline=""
-                )
+                item_id = canvas.create_rectangle(x1, y1 - origin, x2, y2 - origin, fill="#CCE8FF", outline="", tags="select")
+                self.selection_items.append([item_id, coord])
+                created = True
+        for item in self.selection_items[len(coords):]:
+            canvas.delete(item[0])
+        del self.selection_items[len(coords):]
+        if created:
+            canvas.tag_lower("select") # keep highlight under the text
+    
+    def selection_rects(self, start: int, end: int, width: int):
+        # document space rectangles of [start, end): the rest of the first row, one rectangle
+        # over every full row in between and the start of the last row, cached until the
+        # text or the layout changes
+        rects = self.selection_geometry.get((start, end))
+        if rects is not None:
+            return rects
+        storage = self.ctx.document.storage
+        layout = self.ctx.layout
+        first_line, first_column = storage.offset_to_position(start)
+        last_line, last_column = storage.offset_to_position(end)
+        row, x = layout.column_x(first_line, first_column)
+        x1 = self.left_padding + x
+        y1 = layout.line_top(first_line) + row * self.line_height
+        row, x = layout.column_x(last_line, last_column)
+        x2 = self.left_padding + x
+        y2 = layout.line_top(last_line) + row * self.line_height
+        right = max(width, x1, x2)
+        if y1 == y2:
+            rects = [(x1, y1, x2, y1 + self.line_height)]
+        else:
+            rects = [(x1, y1, right, y1 + self.line_height)]
+            if y2 > y1 + self.line_height:
+                rects.append((self.left_padding, y1 + self.line_height, right, y2))
+            if x2 > self.left_padding:
+                rects.append((self.left_padding, y2, x2, y2 + self.line_height))
+        if len(self.selection_geometry) >= 4096:
+            self.selection_geometry.clear()
+        self.selection_geometry[(start, end)] = rects
+        return rects
     
     # def move_selected_area(self):
     #     pass
     
+    def on_document_change(self, change: DocumentChange):
+        if change.start_line is not None:
+            # ranges taller than the view and edits that changed the rows of a wrapped line
+            # are treated like a shift from start_line down (the layout is notified first)
+            if not self.ctx.layout.rows_changed and change.new_end_line - change.start_line <= self.ctx.scroll.line_end_index - self.ctx.scroll.line_start_index:
+                self.dirty_lines.update(range(change.start_line, change.new_end_line + 1))
+            elif self.dirty_from_line is None or change.start_line < self.dirty_from_line:
+                self.dirty_from_line = change.start_line
+        if change.cursor_moved:
+            self.cursor_dirty = True
+        if change.selection_moved:
+            self.selection_dirty = True
+    
+    def clear_dirty(self):
+        self.dirty_lines.clear()
+        self.dirty_from_line = None
+        self.cursor_dirty = False
+        self.selection_dirty = False
+        if self.ctx.highlighter is not None:
+            self.ctx.highlighter.take_changed()
+        self.painted_view = (self.ctx.scroll.line_start_index, self.ctx.scroll.line_end_index)
+    
+    def update(self):
+        # repaint only dirty rows, the cursor and the selection, a scroll moves the items
+        # and draws only the lines that entered the band
+        if not self.line_mode:
+            self.render()
+            return
+        first_line, last_line = self.ctx.scroll.line_start_index, self.ctx.scroll.line_end_index
+        scrolled = self.origin_y != self.ctx.scroll.scroll_y
+        self.shift_items()
+        if (first_line, last_line) != self.painted_view:
+            self.release_lines(first_line, last_line)
+            self.dirty_lines.update(line for line in range(first_line, last_line) if line not in self.line_items)
+            self.cursor_dirty = True
+            scrolled = True
+        if self.ctx.highlighter is not None:
+            # lines recolored by lexing after the edit (an opened string or comment)
+            changed = self.ctx.highlighter.take_changed()
+            if changed is not None:
+                self.dirty_lines.update(range(max(changed[0], first_line), min(changed[1] + 1, last_line)))
+        if self.dirty_from_line is not None:
+            self.dirty_lines.update(range(max(self.dirty_from_line, first_line), last_line))
+        for line in self.dirty_lines:
+            if first_line <= line < last_line:
+                self.render_row(line)
+        if self.selection_dirty or scrolled: # the clipped rectangles follow the view
+            self.render_select()
+        if self.cursor_dirty:
+            self.render_cursor()
+        self.clear_dirty()
+    
     def render(self):
-        self.ctx.canvas.delete("all") 
-        if self.ctx.document.selection_index['anchor'] is not None and self.ctx.document.selection_index['active'] is not None:
+        if not self.line_mode:
+            # per character mode redraws everything
+            self.ctx.canvas.delete("all") 
+            self.line_items.clear()
+            self.free_items.clear()
+            self.cursor_items.clear()
+            self.selection_items.clear()
+            self.origin_y = self.ctx.scroll.scroll_y
             self.render_select()
-        self.render_text()
+            self.render_text()
+            self.render_cursor()
+            self.clear_dirty()
+            return
+        self.shift_items()
+        self.render_select()
+        self.render_lines()
         self.render_cursor()
+        self.clear_dirty()
         
 class ScrollManager: 
     def __init__(self, ctx: EditorContext):
@@ -562,47 +1352,147 @@ class ScrollManager:
         self.line_start_index = 0  
         self.line_end_index = 0
         self.visible_line_count = 0 
-        self.overscan_lines = 2
+        self.overscan_lines = 2 # lines drawn past each edge of the view
+        # while scrolling the lines the next overscan_frames frames will reach are drawn
+        # ahead, so a fast scroll finds them on the canvas instead of drawing a whole band at once
+        self.overscan_frames = 3
+        self.max_overscan_lines = 60
+        
+        # --- smooth scrolling ---
+        # the wheel sets a target that step() eases toward one frame at a time, with inertia
+        # it pushes the view instead and friction slows it down, either way one notch
+        # travels about wheel_lines lines
+        self.smooth = True
+        self.inertia = False
+        self.wheel_lines = 3
+        self.ease = 0.35 # part of the remaining distance covered per frame
+        self.friction = 0.9 # velocity kept per frame with inertia
+        self.animating = False
+        self.target_y = 0
+        self.velocity = 0.0 # pixels per frame of the running animation
 
     def calculate_visible_lines(self): 
         view_top = self.scroll_y
         view_bottom = self.scroll_y + self.ctx.canvas.winfo_height()
-        self.line_start_index = view_top // self.ctx.renderer.line_height
-        self.line_end_index = (view_bottom + self.ctx.renderer.line_height - 1) // self.ctx.renderer.line_height #First line outside viewport
+        # lines can be several rows high, the layout index maps pixels to lines in O(log n)
+        layout = self.ctx.layout
+        self.line_start_index = layout.line_at(view_top)
+        self.line_end_index = layout.line_at(max(view_top, view_bottom - 1)) + 1 #First line outside viewport
+        # after a width change the visible lines are wrapped before anything else
+        if layout.pending() and layout.wrap_lines(self.line_start_index, self.line_end_index):
+            # rows of the re-wrapped lines changed, everything painted from there down moved
+            renderer = self.ctx.renderer
+            if renderer.dirty_from_line is None or self.line_start_index < renderer.dirty_from_line:
+                renderer.dirty_from_line = self.line_start_index
+            renderer.cursor_dirty = renderer.selection_dirty = True
+            self.line_start_index = layout.line_at(view_top)
+            self.line_end_index = layout.line_at(max(view_top, view_bottom - 1)) + 1
         # print("before overscan:", self.line_start_index, self.line_end_index)
-        # print("last line", self.ctx.document.lines[self.line_end_index -1])
+        # print("last line", self.ctx.document.get_line(self.line_end_index -1))
+                
+        # extra lines on the side the view is moving to
+        ahead = min(self.max_overscan_lines, math.ceil(abs(self.velocity) * self.overscan_frames / self.ctx.renderer.line_height))
+        before = self.overscan_lines + (ahead if self.velocity < 0 else 0)
+        after = self.overscan_lines + (ahead if self.velocity > 0 else 0)
                 
         #clamp to bounds
-        self.line_start_index = max(0, self.line_start_index - self.overscan_lines)
-        self.line_end_index = min(self.ctx.document.get_line_number(), self.line_end_index + self.overscan_lines)
+        self.line_start_index = max(0, self.line_start_index - before)
+        self.line_end_index = min(self.ctx.document.get_line_number(), self.line_end_index + after)
         
         #visible line count
         self.visible_line_count = self.line_end_index - self.line_start_index - 1 #inclusive
 
+    def max_scroll(self):
+        return max(0, self.ctx.layout.total_height() - self.ctx.canvas.winfo_height())
+    
+    def set_scroll(self, y: int):
+        self.scroll_y = min(max(0, y), self.max_scroll())
+        self.calculate_visible_lines()
+    
     def move_scroll(self, delta_y: int):
-        self.scroll_y += delta_y
-        self.scroll_y = max(0, self.scroll_y)
-        max_scroll = max(0, self.ctx.document.get_line_number() * self.ctx.renderer.line_height - self.ctx.canvas.winfo_height())
-        self.scroll_y = min(self.scroll_y, max_scroll)
-        self.calculate_visible_lines()  
+        # jumps right away, a running animation is stopped
+        self.stop()
+        self.set_scroll(self.scroll_y + delta_y)
+    
+    def stop(self):
+        self.animating = False
+        self.target_y = self.scroll_y
+        self.velocity = 0.0
+    
+    def scroll_by(self, delta_y: float):
+        # wheel input, returns True when step() has to be called every frame from now on
+        if not self.smooth:
+            self.move_scroll(round(delta_y))
+            return False
+        if not self.animating:
+            self.target_y = self.scroll_y
+            self.animating = True
+        if self.inertia:
+            self.velocity += delta_y * (1 - self.friction) # friction brings the total travel back to delta_y
+        else:
+            self.target_y = min(max(0, round(self.target_y + delta_y)), self.max_scroll())
+        return True
+    
+    def step(self):
+        # one animation frame, returns True while the view keeps moving
+        if not self.animating:
+            return False
+        if self.inertia:
+            delta = round(self.velocity)
+            self.velocity *= self.friction
+            done = abs(self.velocity) < 0.5
+        else:
+            remaining = self.target_y - self.scroll_y
+            delta = round(remaining * self.ease) or remaining
+            done = delta == remaining
+            self.velocity = delta
+        if done:
+            self.animating = False
+            self.velocity = 0.0
+        start = self.scroll_y
+        self.set_scroll(start + delta)
+        if self.scroll_y != start + delta: # ran into the top or the bottom
+            self.stop()
+            self.calculate_visible_lines()
+        return self.animating
         
     def keep_cursor_in_view(self):
         view_top_y = 0
         view_bottom_y =self.ctx.canvas.winfo_height()
-        cursor_y = self.ctx.document.cursor_y_index * self.ctx.renderer.line_height - self.scroll_y
+        line, column = self.ctx.document.cursor_position()
+        row = self.ctx.layout.row_of(line, column)[0]
+        cursor_y = self.ctx.layout.line_top(line) + row * self.ctx.renderer.line_height - self.scroll_y
         scroll_offset = 0
         if cursor_y < view_top_y:  
             scroll_offset = view_top_y - cursor_y
             self.move_scroll(-scroll_offset)
+            return True
         if cursor_y + self.ctx.renderer.line_height > view_bottom_y:
             scroll_offset = (cursor_y + self.ctx.renderer.line_height) - view_bottom_y
             self.move_scroll(scroll_offset)
+            return True
+        return False # visible lines were not recalculated
         
 class InputManager:
     def __init__(self, ctx: EditorContext):
         self.ctx = ctx      
+        self.block_anchor = None # offset an alt+drag block selection started at
         
+    def in_editor(self, event):
+        # bind_all also sees keys typed into dialogs (find / replace)
+        return event.widget.winfo_toplevel() is self.ctx.editor.winfo_toplevel()
+    
+    def pasting(self):
+        # a chunked paste owns the document until it is done or cancelled with Escape
+        return self.ctx.document.paste_transfer is not None
+    
     def on_key(self, event):
+        if not self.in_editor(event):
+            return
+        if self.pasting():
+            if event.keysym == "Escape":
+                self.ctx.editor.cancel_transfers()
+            return "break"
         movement_keys = {
             "Left": Direction.LEFT,
             "Right": Direction.RIGHT,
@@ -613,74 +1503,223 @@ class InputManager:
         }
         if event.keysym in movement_keys:
             self.ctx.document.move_cursor(movement_keys[event.keysym])
-            self.ctx.renderer.render()
+            self.ctx.editor.request_render()
             return "break"
         
         if event.char.isprintable() and len(event.char) == 1: 
             self.ctx.document.insert_str(event.char)
-            self.ctx.renderer.render()
+            self.ctx.editor.request_render()
             return "break"
         
         if event.keysym == "BackSpace":
             self.ctx.document.delete()
-            self.ctx.renderer.render()
+            self.ctx.editor.request_render()
             return "break" 
         
         if event.keysym == "Delete":
             pass  
         
-        if event.keysym == "Return": #TODO split logic into document
-            for i,line in enumerate(self.ctx.document.lines):
-                if i == self.ctx.document.cursor_y_index:
-                    new_line = line[self.ctx.document.cursor_x_index :]
-                    self.ctx.document.lines[i] = line[: self.ctx.document.cursor_x_index]
-                    self.ctx.document.lines.insert(i + 1, new_line)
-            self.ctx.document.move_cursor(Direction.DOWN)
-            self.ctx.document.move_cursor(Direction.LINE_START)
-            self.ctx.scroll.calculate_visible_lines()
-            self.ctx.renderer.render()
+        if event.keysym == "Escape":
+            if self.ctx.editor.cancel_transfers():
+                return "break"
+            self.ctx.document.keep_primary_cursor()
+            self.ctx.editor.request_render()
+            return "break"
+        
+        if event.keysym == "Return":
+            self.ctx.document.newline()
+            self.ctx.editor.request_render()
             return "break"  
      
     def on_ctrl_c(self, event=None):
-        self.ctx.document.copy_text()
+        self.ctx.editor.start_transfer(self.ctx.document.copy_text())
        
     def on_ctrl_v(self, event=None):
-        self.ctx.document.paste_text()
-        self.ctx.renderer.render()
+        if event is not None and not self.in_editor(event):
+            return
+        if self.pasting():
+            return "break"
+        self.ctx.editor.start_transfer(self.ctx.document.paste_text())
+        self.ctx.editor.request_render()
         return "break" 
     
     def on_ctrl_z(self, event=None):
-        self.ctx.editor.command_manager.undo()
-        self.ctx.renderer.render()
+        if self.pasting():
+            return "break"
+        self.ctx.command_manager.undo()
+        self.ctx.editor.request_render()
         return "break" 
     
+    def on_ctrl_y(self, event=None):
+        if self.pasting():
+            return "break"
+        self.ctx.command_manager.redo()
+        self.ctx.editor.request_render()
+        return "break" 
+    
+    def on_ctrl_o(self, event=None):
+        path = filedialog.askopenfilename()
+        if path:
+            self.ctx.editor.open_file(path)
+        return "break"
+    
+    def on_ctrl_s(self, event=None):
+        if self.pasting():
+            return "break" # the half pasted text is not saved, Escape cancels the paste
+        path = self.ctx.document.file_path or filedialog.asksaveasfilename()
+        if path:
+            self.ctx.editor.save_file(path)
+        return "break"
+    
+    def on_ctrl_f(self, event=None):
+        document = self.ctx.document
+        pattern = simpledialog.askstring(
+            "Find", "Find:", parent=self.ctx.editor,
+            initialvalue=document.search.pattern if document.search is not None else "",
+        )
+        if pattern:
+            document.find(pattern, on_found=self.ctx.editor.request_render)
+            self.ctx.editor.request_render()
+        return "break"
+    
+    def on_f3(self, event=None):
+        # shift+F3 goes back
+        backwards = event is not None and bool(event.state & 0x1)
+        if self.ctx.document.find_next(backwards):
+            self.ctx.editor.request_render()
+        return "break"
+    
+    def on_ctrl_h(self, event=None):
+        if self.pasting():
+            return "break"
+        document = self.ctx.document
+        pattern = simpledialog.askstring(
+            "Replace all", "Find:", parent=self.ctx.editor,
+            initialvalue=document.search.pattern if document.search is not None else "",
+        )
+        if not pattern:
+            return "break"
+        replacement = simpledialog.askstring("Replace all", "Replace with:", parent=self.ctx.editor)
+        if replacement is not None:
+            document.replace_all(replacement, pattern)
+            self.ctx.editor.request_render()
+        return "break"
+    
     def on_ctrl_t(self, event=None):
-        insert = InsertCommand(self.ctx.document, "testing insert command")
-        self.ctx.editor.command_manager.execute(insert)
-        self.ctx.renderer.render()
+        if self.pasting():
+            return "break"
+        document = self.ctx.document
+        insert = InsertCommand(document.cursor_offset(), "testing insert command")
+        self.ctx.command_manager.execute(insert)
+        self.ctx.editor.request_render()
         return "break"
         
+    def on_f12(self, event=None):
+        # profiling with the overlay on / off, ctrl adds cProfile for a pstats dump
+        profiler = self.ctx.profiler
+        if profiler.enabled:
+            profiler.disable()
+        else:
+            profiler.enable(overlay=True, python_profile=bool(event is not None and event.state & 0x4))
+        self.ctx.editor.request_render(full=True)
+        return "break"
+    
+    def on_shift_f12(self, event=None):
+        paths = self.ctx.profiler.dump(time.strftime("editor-profile-%Y%m%d-%H%M%S"))
+        self.ctx.editor.show_status("profile written to " + ", ".join(paths))
+        return "break"
+    
+    def on_ctrl_n(self, event=None):
+        self.ctx.editor.show_buffer(self.ctx.buffers.new())
+        return "break"
+    
+    def on_ctrl_w(self, event=None):
+        self.ctx.editor.close_buffer()
+        return "break"
+    
+    def on_ctrl_tab(self, event=None):
+        self.ctx.editor.show_buffer(self.ctx.buffers.step(1))
+        return "break"
+    
+    def on_ctrl_shift_tab(self, event=None):
+        self.ctx.editor.show_buffer(self.ctx.buffers.step(-1))
+        return "break"
+    
     def on_mousewheel(self, event):
-        if event.delta:
-            self.ctx.scroll.move_scroll(-1 * (event.delta // 120) * self.ctx.renderer.line_height) 
-            self.ctx.renderer.render()
+        # windows and mac send a delta (120 a notch, less on touchpads), x11 buttons 4 and 5
+        notches = event.delta / 120 if event.delta else {4: 1, 5: -1}.get(event.num, 0)
+        if notches:
+            scroll = self.ctx.scroll
+            if scroll.scroll_by(-notches * scroll.wheel_lines * self.ctx.renderer.line_height):
+                self.ctx.editor.animate_scroll()
+            self.ctx.editor.request_render()
             return "break"
         
+    def on_scrollbar(self, action, amount, unit=None):
+        # tk scrollbar command: ("moveto", fraction) or ("scroll", count, "units" / "pages")
+        scroll = self.ctx.scroll
+        if action == "moveto":
+            scroll.move_scroll(round(float(amount) * self.ctx.layout.total_height()) - scroll.scroll_y)
+        elif unit == "pages":
+            scroll.move_scroll(int(amount) * self.ctx.canvas.winfo_height())
+        else:
+            scroll.move_scroll(int(amount) * self.ctx.renderer.line_height)
+        self.ctx.editor.request_render()
+    
+    def on_minimap_click(self, event):
+        # centers the view on the line under the mouse
+        scroll = self.ctx.scroll
+        line = self.ctx.minimap.line_at(event.y)
+        scroll.move_scroll(self.ctx.layout.line_top(line) - self.ctx.canvas.winfo_height() // 2 - scroll.scroll_y)
+        self.ctx.editor.request_render()
+        return "break"
+    
     def on_leftclick(self, event):
+        self.block_anchor = None
         self.ctx.document.move_cursor_to_mouse(event.x, event.y)
         self.ctx.document.clear_selection()
-        self.ctx.renderer.render()
+        self.ctx.editor.request_render()
         return "break" 
         
+    def on_ctrl_leftclick(self, event):
+        document = self.ctx.document
+        document.add_cursor(document.screen_coords_to_offset(event.x, event.y))
+        self.ctx.editor.request_render()
+        return "break"
+    
+    def on_alt_leftclick(self, event):
+        document = self.ctx.document
+        self.block_anchor = document.screen_coords_to_offset(event.x, event.y)
+        document.select_block(self.block_anchor, self.block_anchor)
+        self.ctx.editor.request_render()
+        return "break"
+    
+    def on_alt_drag(self, event):
+        document = self.ctx.document
+        if self.block_anchor is None:
+            self.block_anchor = document.selection.anchor
+        document.select_block(self.block_anchor, document.screen_coords_to_offset(event.x, event.y))
+        self.ctx.editor.request_render()
+        return "break"
+    
+    def on_ctrl_shift_l(self, event=None):
+        if self.ctx.document.select_all_matches():
+            self.ctx.editor.request_render()
+        return "break"
+    
     def on_left_drag(self, event):
         self.ctx.document.set_selection(event.x, event.y)
-        self.ctx.renderer.render()
+        self.ctx.editor.request_render()
         return "break"
         
 # --- basic window ---
-root = tk.Tk()
-editor = CustomEditor(root)
-editor.pack(fill=tk.BOTH, expand=True) # expand frame to fill window
-root.mainloop()
+if __name__ == "__main__":
+    root = tk.Tk()
+    editor = CustomEditor(root)
+    editor.pack(fill=tk.BOTH, expand=True) # expand frame to fill window
+    root.protocol("WM_DELETE_WINDOW", editor.close)
+    if len(sys.argv) > 1:
+        editor.open_file(sys.argv[1])
+    root.mainloop()
 
     
\ No newline at end of file
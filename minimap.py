@@ -0,0 +1,250 @@
+from __future__ import annotations
+import time
+import tkinter as tk
+from bisect import bisect_right
+from itertools import accumulate
+from operator import add, and_
+
+from layout import Fenwick
+
+
+# document overview next to the text
+#
+# DocumentSummary keeps the line count, characters and leading whitespace of blocks of
+# lines, at most twice target_blocks of them whatever the document size, so an edit recounts
+# only the block it touched and a million line file is summarized in a few thousand numbers
+#
+# Minimap draws the summary into one PhotoImage, every pixel row is a bar from the average
+# indent to the average length of the lines it covers, only rows whose bar changed are written
+
+class DocumentSummary:
+    # document observer, registered after the layout
+    #
+    # a fenwick tree over the block line counts finds the block of a line in O(log n), an
+    # edit only moves lines between the blocks it touched until one of them holds more than
+    # twice block_lines (or none), then those blocks are cut again and the tree is rebuilt
+    # when read next
+    target_blocks = 2048 # blocks are merged in pairs when there are twice as many
+    recount_lines = 4096 # edited lines counted in the edit callback, the rest through fill()
+
+    def __init__(self, ctx: EditorContext):
+        self.ctx = ctx
+        self.block_lines = 1
+        self.lines = [] # line count of every block
+        self.chars = [] # characters of every block, newlines not counted
+        self.indents = [] # leading whitespace of every block
+        self.known = [] # False until the block was counted
+        self.version = 0 # bumped whenever a count changes
+        self.line_tree = None # Fenwick over lines, None until read after blocks were cut or merged
+
+    def reset(self):
+        line_count = self.ctx.document.get_line_number()
+        self.block_lines = max(1, -(-line_count // self.target_blocks))
+        self.lines, self.chars, self.indents, self.known = [], [], [], []
+        self.line_tree = None
+        self.set_blocks(0, 0, 0, line_count)
+
+    def tree(self) -> Fenwick:
+        if self.line_tree is None:
+            self.line_tree = Fenwick(self.lines)
+        return self.line_tree
+
+    def line_count(self) -> int:
+        return self.tree().total()
+
+    def pending(self):
+        return False in self.known
+
+    def size(self) -> int:
+        # rough memory use in bytes
+        return 40 * len(self.lines)
+
+    def locate(self, line: int):
+        # (block, first line of the block) of a line in the document
+        block, rest = self.tree().find(line)
+        return block, line - rest
+
+    def set_blocks(self, first: int, last: int, line: int, count: int):
+        # blocks first..last (exclusive) now hold count lines from line
+        blocks = last - first
+        if blocks <= count <= 2 * self.block_lines * blocks:
+            # the lines still fit, spread over the same blocks
+            for block in range(first, last):
+                size = count // blocks + (block - first < count % blocks)
+                if self.line_tree is not None:
+                    self.line_tree.add(block, size - self.lines[block])
+                self.lines[block] = size
+                self.known[block] = False
+        else:
+            parts = max(1, round(count / self.block_lines)) if count else 0
+            self.lines[first:last] = [count // parts + (part < count % parts) for part in range(parts)]
+            self.chars[first:last] = [0] * parts
+            self.indents[first:last] = [0] * parts
+            self.known[first:last] = [False] * parts
+            self.line_tree = None
+            last = first + parts
+        self.version += 1
+        if count <= self.recount_lines:
+            for block in range(first, last):
+                self.count_block(block, line)
+                line += self.lines[block]
+
+    def count_block(self, block: int, line: int):
+        storage = self.ctx.document.storage
+        text = storage.text(storage.line_start(line), storage.line_end(line + self.lines[block] - 1))
+        self.chars[block] = len(text) - text.count("\n")
+        self.indents[block] = self.chars[block] - sum(map(len, map(str.lstrip, text.split("\n"))))
+        self.known[block] = True
+        self.version += 1
+
+    def merge(self):
+        # the document grew, neighbouring blocks become one
+        self.block_lines *= 2
+        odd = len(self.lines) % 2
+        def pairs(values, combine):
+            merged = list(map(combine, values[0::2], values[1::2]))
+            if odd:
+                merged.append(values[-1])
+            return merged
+        self.lines = pairs(self.lines, add)
+        self.chars = pairs(self.chars, add)
+        self.indents = pairs(self.indents, add)
+        self.known = pairs(self.known, and_)
+        self.line_tree = None
+        self.version += 1
+
+    def on_document_change(self, change: DocumentChange):
+        if change.start_line is None:
+            return
+        start, old_end, new_end = change.start_line, change.old_end_line, change.new_end_line
+        if start == 0 and old_end >= self.line_count() - 1:
+            self.reset() # a new document
+            return
+        # the blocks holding the edited lines take their new line count
+        first, line = self.locate(start)
+        last, last_line = self.locate(old_end)
+        end_line = last_line + self.lines[last]
+        self.set_blocks(first, last + 1, line, end_line - line + new_end - old_end)
+        while len(self.lines) > 2 * self.target_blocks:
+            self.merge()
+
+    def fill(self, budget: float = 0.005):
+        # count blocks a large edit or a newly loaded file left behind,
+        # returns True when nothing is left
+        deadline = time.perf_counter() + budget
+        block = 0
+        while True:
+            try:
+                block = self.known.index(False, block)
+            except ValueError:
+                return True
+            self.count_block(block, self.tree().prefix(block))
+            if time.perf_counter() >= deadline:
+                return False
+
+    def bars(self, height: int, scale: float, width: int):
+        # (start x, end x) of every pixel row, scale is pixels per line and one pixel per character
+        if not self.lines:
+            return [(0, 0)] * height
+        starts = list(accumulate(self.lines, initial=0))
+        char_totals = list(accumulate(self.chars, initial=0))
+        indent_totals = list(accumulate(self.indents, initial=0))
+        line_count = starts[-1]
+        last_block = len(self.lines) - 1
+        def totals(line):
+            # characters and indent above line, a fraction of a block counts as that part of it
+            block = min(bisect_right(starts, line) - 1, last_block)
+            part = (line - starts[block]) / self.lines[block]
+            return char_totals[block] + self.chars[block] * part, indent_totals[block] + self.indents[block] * part
+        bars = []
+        previous = totals(0)
+        for row in range(height):
+            first_line = row / scale
+            last_line = min((row + 1) / scale, line_count)
+            if last_line <= first_line:
+                bars.append((0, 0))
+                continue
+            current = totals(last_line)
+            lines = last_line - first_line
+            indent = min(round((current[1] - previous[1]) / lines), width)
+            length = min(round((current[0] - previous[0]) / lines), width)
+            bars.append((indent, max(indent, length)))
+            previous = current
+        return bars
+
+
+class Minimap:
+    # whole document squeezed into the minimap canvas, up to max_line_pixels rows per line
+    width = 80
+    max_line_pixels = 2
+    background = "#F3F3F3"
+    ink = "#A8A8A8"
+    view_color = "#808080"
+
+    def __init__(self, ctx: EditorContext, canvas):
+        self.ctx = ctx
+        self.canvas = canvas
+        self.image = tk.PhotoImage(master=canvas, width=self.width, height=1)
+        self.image_item = canvas.create_image(0, 0, image=self.image, anchor="nw")
+        self.view_item = canvas.create_rectangle(0, 0, 0, 0, outline=self.view_color)
+        self.bars = [] # bar drawn on every pixel row of the image
+        self.row_cache = {} # bar -> pixel row data for PhotoImage.put
+        self.painted = None # (summary, its version, height) of the image
+        self.view_coords = None
+
+    def scale(self, height: int) -> float:
+        # pixels per line
+        return min(self.max_line_pixels, height / max(1, self.ctx.summary.line_count()))
+
+    def line_at(self, y: int) -> int:
+        height = max(1, self.canvas.winfo_height())
+        line = int(y / self.scale(height))
+        return min(max(line, 0), self.ctx.document.get_line_number() - 1)
+
+    def row_data(self, bar):
+        data = self.row_cache.get(bar)
+        if data is None:
+            start, end = bar
+            pixels = [self.background] * start + [self.ink] * (end - start) + [self.background] * (self.width - end)
+            data = self.row_cache[bar] = "{" + " ".join(pixels) + "}"
+        return data
+
+    def render(self):
+        height = max(1, self.canvas.winfo_height())
+        # the summary is another object after a buffer switch
+        painted = (self.ctx.summary, self.ctx.summary.version, height)
+        if self.painted != painted:
+            self.painted = painted
+            self.render_image(height)
+        self.render_view(height)
+
+    def render_image(self, height: int):
+        if self.image.height() != height:
+            self.image.configure(height=height)
+            self.bars = []
+        bars = self.ctx.summary.bars(height, self.scale(height), self.width)
+        # one put per run of changed rows
+        row = 0
+        while row < height:
+            if row < len(self.bars) and self.bars[row] == bars[row]:
+                row += 1
+                continue
+            end = row + 1
+            while end < height and (end >= len(self.bars) or self.bars[end] != bars[end]):
+                end += 1
+            self.image.put(" ".join(map(self.row_data, bars[row:end])), to=(0, row))
+            row = end
+        self.bars = bars
+
+    def render_view(self, height: int):
+        # frame around the part of the document the editor shows
+        scroll = self.ctx.scroll
+        document_height = max(1, self.ctx.layout.total_height())
+        pixels = self.ctx.summary.line_count() * self.scale(height)
+        top = scroll.scroll_y / document_height * pixels
+        bottom = min(scroll.scroll_y + self.ctx.canvas.winfo_height(), document_height) / document_height * pixels
+        top = min(round(top), height - 2)
+        coords = (0, top, self.width - 1, max(top + 2, round(bottom)))
+        if coords != self.view_coords:
+            self.canvas.coords(self.view_item, *coords)
+            self.view_coords = coords
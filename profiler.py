@@ -0,0 +1,176 @@
+from __future__ import annotations
+import cProfile
+import json
+import time
+from collections import deque
+
+
+# instrumentation for finding where a slow frame went
+#
+# enable() wraps the methods listed in STAGES on the component instances (an instance
+# attribute shadows the class method) and disable() deletes the wrappers again, so a
+# disabled profiler costs one enabled check per frame and nothing per call
+#
+# stage times are inclusive, an input handler's time contains the document and scroll
+# work it triggered, frames record the paint time and the input to paint latency (from
+# the first render request after the previous frame to the end of the paint)
+
+STAGES = {
+    # stage -> (EditorContext attribute, method names, None for every on_ handler)
+    "input": ("input", None),
+    "document": ("document", ("storage_insert", "storage_delete", "storage_apply_edits")),
+    "observers": ("document", ("notify",)),
+    "scroll": ("scroll", ("calculate_visible_lines", "step")),
+    "render": ("renderer", ("render", "update")),
+    "minimap": ("minimap", ("render",)),
+}
+
+
+def percentile(values, fraction: float):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+class Profiler:
+    history = 600 # frames and calls per stage kept
+    span_limit = 100_000 # calls kept for the trace
+
+    def __init__(self, ctx: EditorContext):
+        self.ctx = ctx
+        self.enabled = False
+        self.overlay = False # draw the numbers on the canvas after every frame
+        self.frames = deque(maxlen=self.history) # (start, paint seconds, latency seconds or None, canvas items)
+        self.stage_times = {} # stage -> deque of call seconds
+        self.spans = deque(maxlen=self.span_limit) # (stage, method, start, seconds)
+        self.wrapped = [] # (component, method name) with a timing wrapper
+        self.python_profile = None # cProfile.Profile while enabled with python_profile
+
+    def enable(self, overlay: bool = True, python_profile: bool = False):
+        if self.enabled:
+            return
+        self.enabled = True
+        self.overlay = overlay
+        self.wrap_stages()
+        if python_profile:
+            self.python_profile = cProfile.Profile()
+            self.python_profile.enable()
+
+    def disable(self):
+        if not self.enabled:
+            return
+        self.unwrap_stages()
+        if self.python_profile is not None:
+            self.python_profile.disable() # kept for dump()
+        self.enabled = False
+        self.overlay = False
+        if self.ctx.canvas is not None:
+            self.ctx.canvas.delete("overlay")
+
+    def wrap_stages(self):
+        for stage, (component_name, names) in STAGES.items():
+            component = getattr(self.ctx, component_name)
+            if component is None:
+                continue
+            if names is None:
+                names = [name for name in dir(type(component)) if name.startswith("on_")]
+            for name in names:
+                self.wrap(stage, component, name)
+
+    def unwrap_stages(self):
+        for component, name in self.wrapped:
+            delattr(component, name)
+        self.wrapped.clear()
+
+    def rewrap(self):
+        # the context got other components (another buffer became active)
+        if self.enabled:
+            self.unwrap_stages()
+            self.wrap_stages()
+
+    def wrap(self, stage: str, component, name: str):
+        method = getattr(component, name)
+        times = self.stage_times.setdefault(stage, deque(maxlen=self.history))
+        spans = self.spans
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                duration = time.perf_counter() - start
+                times.append(duration)
+                spans.append((stage, name, start, duration))
+        setattr(component, name, timed)
+        self.wrapped.append((component, name))
+
+    def end_frame(self, start: float, requested: float | None):
+        # called by the frame loop after the paint
+        end = time.perf_counter()
+        latency = end - requested if requested is not None else None
+        self.frames.append((start, end - start, latency, self.ctx.renderer.item_count()))
+        if self.overlay:
+            self.draw_overlay()
+
+    def summary(self):
+        paints = [frame[1] for frame in self.frames]
+        latencies = [frame[2] for frame in self.frames if frame[2] is not None]
+        return {
+            "frames": len(paints),
+            "paint_ms": {"p50": percentile(paints, 0.5) * 1000, "p99": percentile(paints, 0.99) * 1000},
+            "input_to_paint_ms": {"p50": percentile(latencies, 0.5) * 1000, "p99": percentile(latencies, 0.99) * 1000},
+            "canvas_items": self.frames[-1][3] if self.frames else 0,
+            "stages_ms": {
+                stage: {"calls": len(times), "p50": percentile(times, 0.5) * 1000, "p99": percentile(times, 0.99) * 1000}
+                for stage, times in self.stage_times.items() if times
+            },
+        }
+
+    def overlay_text(self):
+        summary = self.summary()
+        latency = summary["input_to_paint_ms"]
+        paint = summary["paint_ms"]
+        lines = [
+            f"input->paint p50 {latency['p50']:6.2f} p99 {latency['p99']:6.2f} ms",
+            f"paint        p50 {paint['p50']:6.2f} p99 {paint['p99']:6.2f} ms",
+            f"canvas items {summary['canvas_items']}",
+        ]
+        for stage, times in summary["stages_ms"].items():
+            lines.append(f"{stage:<12} p50 {times['p50']:6.2f} p99 {times['p99']:6.2f} ms")
+        return "\n".join(lines)
+
+    def draw_overlay(self):
+        # drawn again after every frame, renderer scrolling moves every canvas item
+        canvas = self.ctx.canvas
+        canvas.delete("overlay")
+        canvas.create_text(
+            canvas.winfo_width() - 8, 8,
+            text=self.overlay_text(),
+            font=("Courier New", 9),
+            fill="#B00000",
+            anchor="ne",
+            justify="left",
+            tags="overlay"
+        )
+
+    def dump(self, path: str):
+        # path.trace.json: the recorded calls and frames as chrome trace events
+        # (chrome://tracing, perfetto) plus the summary, path.pstats: cProfile data for
+        # pstats when profiling ran with python_profile, returns the written paths
+        events = [
+            {"name": name, "cat": stage, "ph": "X", "ts": start * 1e6, "dur": duration * 1e6, "pid": 0, "tid": 0}
+            for stage, name, start, duration in self.spans
+        ]
+        for start, paint, latency, items in self.frames:
+            events.append({"name": "frame", "cat": "frame", "ph": "X", "ts": start * 1e6, "dur": paint * 1e6,
+                           "pid": 0, "tid": 1, "args": {"input_to_paint_ms": latency and latency * 1000, "canvas_items": items}})
+        paths = []
+        if self.python_profile is not None:
+            paths.append(path + ".pstats")
+            self.python_profile.dump_stats(paths[-1]) # stops the profile
+            if self.enabled:
+                self.python_profile.enable()
+        paths.append(path + ".trace.json")
+        with open(paths[-1], "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms", "summary": self.summary()}, f)
+        return paths
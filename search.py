@@ -0,0 +1,266 @@
+from __future__ import annotations
+import re
+from array import array
+from bisect import bisect_left, bisect_right
+
+from storage import edits_delta
+from tasks import TaskCancelled
+
+
+# find / replace
+#
+# the text is searched a chunk at a time with one compiled regex per chunk (literal
+# queries are escaped), never line by line, matches are reported in batches so the first
+# hits show while the rest of the document is still being scanned
+#
+# MatchIndex keeps the (start, end) offsets of all matches, an edit shifts the matches
+# after it and only the edited lines are searched again
+
+FIRST_CHUNK = 1 << 14 # small first chunks so the first hits come back quickly
+CHUNK_SIZE = 1 << 20 # characters searched per regex call
+OVERLAP = 1 << 12 # read past the chunk end, longer matches are cut where chunks meet
+BATCH_SIZE = 1000 # matches per reported batch
+
+
+def compile_query(pattern: str, regex: bool = False, case_sensitive: bool = True):
+    flags = re.MULTILINE | (0 if case_sensitive else re.IGNORECASE)
+    return re.compile(pattern if regex else re.escape(pattern), flags)
+
+
+def iter_chunks(compiled, storage, start: int, end: int, limit: int | None = None, cancelled=None, regex: bool = True):
+    # (base, matches) per chunk with the non empty matches starting in [start, end),
+    # match offsets are relative to base, no match runs past limit (default: the end of the text)
+    limit = len(storage) if limit is None else limit
+    position = start
+    size = FIRST_CHUNK
+    while position < end:
+        if cancelled is not None and cancelled():
+            raise TaskCancelled()
+        chunk_end = min(position + size, end)
+        size = min(size * 2, CHUNK_SIZE)
+        # one character of context before the chunk so ^, \b and lookbehinds see the real text
+        base = max(position - 1, 0)
+        text = storage.text(base, min(chunk_end + OVERLAP, limit))
+        cut = chunk_end - base
+        matches = list(compiled.finditer(text, position - base))
+        while matches and matches[-1].start() >= cut: # found in the overlap, the next chunk reports them
+            matches.pop()
+        if regex: # escaped literals are never empty
+            matches = [match for match in matches if match.end() > match.start()]
+        position = max(chunk_end, base + matches[-1].end()) if matches else chunk_end
+        yield base, matches
+
+
+def scan(compiled, storage, start: int, end: int, report, cancelled=None, limit: int | None = None, regex: bool = True):
+    # report(batch) with sorted lists of (start, end) offsets
+    for base, matches in iter_chunks(compiled, storage, start, end, limit, cancelled, regex):
+        spans = [(base + match.start(), base + match.end()) for match in matches]
+        for position in range(0, len(spans), BATCH_SIZE):
+            report(spans[position:position + BATCH_SIZE])
+
+
+class MatchIndex:
+    # sorted, non overlapping matches in blocks of about block_size
+    #
+    # a block stores its first start (bases) and the starts relative to it, so an edit
+    # moves the blocks after it by changing one int each and only rewrites the blocks it touches
+    block_size = 1024
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.bases = []
+        self.starts = [] # array of starts relative to the block base
+        self.lengths = [] # array of match lengths
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        for base, starts, lengths in zip(self.bases, self.starts, self.lengths):
+            for start, length in zip(starts, lengths):
+                yield base + start, base + start + length
+
+    def block_matches(self, block: int):
+        base = self.bases[block]
+        return [(base + start, base + start + length) for start, length in zip(self.starts[block], self.lengths[block])]
+
+    def set_blocks(self, first: int, last: int, matches: list):
+        # blocks first..last (exclusive) hold matches from now on
+        bases, starts, lengths = [], [], []
+        for position in range(0, len(matches), self.block_size):
+            part = matches[position:position + self.block_size]
+            base = part[0][0]
+            bases.append(base)
+            starts.append(array("q", [start - base for start, _ in part]))
+            lengths.append(array("q", [end - start for start, end in part]))
+        self.count += len(matches) - sum(len(self.starts[block]) for block in range(first, last))
+        self.bases[first:last] = bases
+        self.starts[first:last] = starts
+        self.lengths[first:last] = lengths
+
+    def add_run(self, run: list):
+        # sorted matches that don't overlap the ones already here
+        if not run:
+            return
+        first = max(bisect_right(self.bases, run[0][0]) - 1, 0)
+        last = min(max(bisect_right(self.bases, run[-1][0]), first + 1), len(self.bases))
+        merged = run
+        if first < last:
+            merged = [match for block in range(first, last) for match in self.block_matches(block)]
+            merged.extend(run)
+            merged.sort()
+        self.set_blocks(first, last, merged)
+
+    def replace(self, start: int, end: int, delta: int, matches: list):
+        # text [start, end) was edited and got delta characters longer: matches overlapping
+        # it go, matches after it move by delta, then the matches found in the new text are added
+        first = max(bisect_right(self.bases, start) - 1, 0)
+        last = bisect_left(self.bases, end)
+        if first < last:
+            kept = []
+            for match_start, match_end in (match for block in range(first, last) for match in self.block_matches(block)):
+                if match_end <= start:
+                    kept.append((match_start, match_end))
+                elif match_start >= end:
+                    kept.append((match_start + delta, match_end + delta))
+            if delta:
+                bases = self.bases
+                for block in range(last, len(bases)):
+                    bases[block] += delta
+            self.set_blocks(first, last, kept)
+        elif delta:
+            bases = self.bases
+            for block in range(last, len(bases)):
+                bases[block] += delta
+        self.add_run(matches)
+
+    def after(self, offset: int):
+        # first match starting at or after offset
+        block = max(bisect_right(self.bases, offset) - 1, 0)
+        while block < len(self.bases):
+            starts = self.starts[block]
+            index = bisect_left(starts, offset - self.bases[block])
+            if index < len(starts):
+                start = self.bases[block] + starts[index]
+                return start, start + self.lengths[block][index]
+            block += 1
+        return None
+
+    def before(self, offset: int):
+        # last match starting before offset
+        block = bisect_left(self.bases, offset) - 1
+        if block < 0:
+            return None
+        starts = self.starts[block]
+        index = bisect_left(starts, offset - self.bases[block]) - 1
+        start = self.bases[block] + starts[index]
+        return start, start + self.lengths[block][index]
+
+    def first(self):
+        return self.after(0)
+
+    def last(self):
+        if not self.bases:
+            return None
+        start = self.bases[-1] + self.starts[-1][-1]
+        return start, start + self.lengths[-1][-1]
+
+
+class Search:
+    # one query over the document: a background scan of a storage snapshot fills the
+    # index, DocumentModel reports every storage edit through on_edit to keep it current
+    rescan_limit = 1 << 20 # edited text searched again right away, bigger edits restart the scan
+
+    def __init__(self, ctx: EditorContext, pattern: str, regex: bool = False, case_sensitive: bool = True):
+        self.ctx = ctx
+        self.pattern = pattern
+        self.regex = regex
+        self.case_sensitive = case_sensitive
+        self.compiled = compile_query(pattern, regex, case_sensitive)
+        self.index = MatchIndex()
+        self.task = None # running scan
+        self.edits = [] # (start, end, delta) edited since the running scan's snapshot
+        self.on_found = None # called after a batch of matches was added
+
+    def start(self, offset: int = 0):
+        # scan from the line of offset to the end, then from the top back to that line
+        self.cancel()
+        self.index.clear()
+        storage = self.ctx.document.storage
+        split = storage.line_start(storage.offset_to_position(offset)[0])
+        if self.ctx.executor is None:
+            # headless: scan right here, batches still arrive one by one
+            self.run(None, storage, split, self.add_batch)
+            return
+        self.task = self.ctx.executor.submit(
+            self.run, storage.snapshot(), split, None,
+            on_done=self.finished, on_progress=self.add_batch,
+        )
+
+    def run(self, task, storage, split: int, report):
+        # on a worker with a snapshot, or inline without an executor
+        cancelled = None
+        if task is not None:
+            report, cancelled = task.report, task.cancelled
+        scan(self.compiled, storage, split, len(storage), report, cancelled, regex=self.regex)
+        # matches running over the split were found by the first pass
+        scan(self.compiled, storage, 0, split, report, cancelled, split, self.regex)
+
+    def running(self) -> bool:
+        return self.task is not None
+
+    def cancel(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        self.edits = []
+
+    def finished(self, result):
+        self.task = None
+        self.edits = []
+
+    def add_batch(self, batch: list):
+        if self.edits:
+            # found in the snapshot, moved to the current text like the index was
+            batch = [match for match in map(self.map_match, batch) if match is not None]
+        self.index.add_run(batch)
+        if batch and self.on_found is not None:
+            self.on_found()
+
+    def map_match(self, match):
+        start, end = match
+        for edit_start, edit_end, delta in self.edits:
+            if start < edit_end and end > edit_start:
+                return None # that text was searched again after the edit
+            if start >= edit_end:
+                start += delta
+                end += delta
+        return start, end
+
+    def on_edit(self, name: str, args: tuple):
+        # called after a storage edit, the same (name, args) a background save replays
+        storage = self.ctx.document.storage
+        if name == "insert":
+            offset, text = args
+            first, last, delta = offset, offset + len(text), len(text)
+        elif name == "delete":
+            start, end = args
+            first, last, delta = start, start, start - end
+        else:
+            edits = args[0]
+            delta = edits_delta(edits)
+            first, last = edits[0][0], edits[-1][1] + delta
+        # the edited lines, with the newline after them, are searched again
+        region_start = storage.line_start(storage.offset_to_position(first)[0])
+        region_end = min(storage.line_end(storage.offset_to_position(last)[0]) + 1, len(storage))
+        if region_end - region_start > self.rescan_limit:
+            self.start(self.ctx.document.cursor_offset())
+            return
+        matches = []
+        scan(self.compiled, storage, region_start, region_end, matches.extend, limit=region_end, regex=self.regex)
+        self.index.replace(region_start, region_end - delta, delta, matches)
+        if self.task is not None:
+            self.edits.append((region_start, region_end - delta, delta))
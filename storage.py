@@ -0,0 +1,707 @@
+from __future__ import annotations
+import codecs
+import mmap
+import os
+import random
+import re
+import tempfile
+import threading
+import weakref
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from itertools import accumulate, islice
+from operator import itemgetter
+
+
+# text storage backends for DocumentModel
+#
+# the document only talks to storage through the line-access API below,
+# offsets are character offsets into the whole text, lines are separated by "\n"
+# and do not include it
+
+def edits_delta(edits: list) -> int:
+    # length change of applying (start, end, text) edits
+    return sum(map(len, map(itemgetter(2), edits))) - sum(map(itemgetter(1), edits)) + sum(map(itemgetter(0), edits))
+
+
+class TextStorage:
+    # interface every storage backend must support
+    @classmethod
+    def from_file(cls, path: str, encoding: str = "utf-8", background: bool = True, executor=None):
+        # executor: TaskExecutor that runs the background loading, a thread of its own if None
+        raise NotImplementedError
+
+    def __len__(self):
+        raise NotImplementedError
+
+    def line_count(self) -> int:
+        raise NotImplementedError
+
+    def line_start(self, line: int) -> int:
+        raise NotImplementedError
+
+    def get_line(self, line: int) -> str:
+        raise NotImplementedError
+
+    def text(self, start: int = 0, end: int | None = None) -> str:
+        raise NotImplementedError
+
+    def insert(self, offset: int, text: str):
+        raise NotImplementedError
+
+    def delete(self, start: int, end: int):
+        raise NotImplementedError
+
+    def apply_edits(self, edits: list):
+        # (start, end, text) replacements, sorted, not overlapping, offsets in the text before any of them
+        for start, end, text in reversed(edits):
+            self.delete(start, end)
+            self.insert(start, text)
+
+    def write_file(self, path: str, encoding: str = "utf-8", cancelled=None):
+        # cancelled() is checked while writing, the target is left untouched if it returns True
+        raise NotImplementedError
+
+    def snapshot(self) -> TextStorage:
+        # read-only copy for background jobs, later edits don't show up in it
+        raise NotImplementedError
+
+    def close(self):
+        # the document replaced this storage or was closed, files it reads can go
+        pass
+
+    def shares_source(self, other: TextStorage) -> bool:
+        # other reads the same file, closing this storage would close it for both
+        return False
+
+    # backends that load files in the background report progress here
+    def loading(self) -> bool:
+        return False
+
+    def stop_loading(self):
+        pass
+
+    def load_more(self):
+        # make newly loaded text part of the document, returns the offset it was added at or None
+        return None
+
+    # --- derived helpers, backends may override with faster versions ---
+    def line_end(self, line: int) -> int:
+        # offset of the end of the line, not counting the "\n"
+        if line + 1 < self.line_count():
+            return self.line_start(line + 1) - 1
+        return len(self)
+
+    def line_length(self, line: int) -> int:
+        return self.line_end(line) - self.line_start(line)
+
+    def position_to_offset(self, line: int, column: int) -> int:
+        return self.line_start(line) + column
+
+    def offset_to_position(self, offset: int):
+        # returns (line, column), slow default: binary search over line starts
+        low, high = 0, self.line_count() - 1
+        while low < high:
+            mid = (low + high + 1) // 2
+            if self.line_start(mid) <= offset:
+                low = mid
+            else:
+                high = mid - 1
+        return low, offset - self.line_start(low)
+
+
+class TextBuffer:
+    # immutable block of text referenced by pieces
+    # line_starts holds the offset right after every "\n" in the buffer
+    __slots__ = ("text", "line_starts")
+
+    def __init__(self, text: str):
+        self.text = text
+        parts = text.split("\n")
+        self.line_starts = list(accumulate(map((1).__add__, map(len, parts[:-1]))))
+
+    def __len__(self):
+        return len(self.text)
+
+    def extended(self, text: str) -> TextBuffer:
+        # a new buffer with text appended, only text is searched for newlines
+        grown = TextBuffer(text)
+        base = len(self.text)
+        grown.line_starts = self.line_starts + [base + start for start in grown.line_starts]
+        grown.text = self.text + text
+        return grown
+
+    def slice(self, start: int, end: int) -> str:
+        return self.text[start:end]
+
+    def count_newlines(self, start: int, end: int) -> int:
+        # number of "\n" in text[start:end]
+        return bisect_right(self.line_starts, end) - bisect_right(self.line_starts, start)
+
+    def nth_line_start(self, start: int, n: int) -> int:
+        # offset right after the n-th "\n" found at or after start (n >= 1)
+        return self.line_starts[bisect_right(self.line_starts, start) + n - 1]
+
+    def write_range(self, out, start: int, end: int, encoding: str, encode):
+        write_text(out, self.text[start:end], encode)
+
+
+# chars encoded per write when saving
+WRITE_CHUNK = 1 << 20
+
+
+def write_text(out, text: str, encode):
+    # encode is the encode method of an incremental encoder shared by the whole save
+    for start in range(0, len(text), WRITE_CHUNK):
+        out.write(encode(text[start:start + WRITE_CHUNK]))
+
+
+def atomic_write(path: str, write):
+    # write(out) fills a temp file next to path, which then replaces path in one rename
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temp_path = tempfile.mkstemp(prefix=".", suffix=".tmp", dir=directory)
+    try:
+        with open(fd, "wb", buffering=0) as out:
+            write(out)
+            os.fsync(out.fileno())
+        if os.path.exists(path):
+            os.chmod(temp_path, os.stat(path).st_mode & 0o7777)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+    # make the rename itself durable
+    if hasattr(os, "O_DIRECTORY"):
+        dir_fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+
+_NEWLINE = re.compile(b"\n")
+
+
+class MappedBuffer:
+    # read-only file contents used as a piece table buffer without reading the file into memory,
+    # the encoding must be ascii compatible (newlines are found in the raw bytes)
+    #
+    # the file is cut into blocks of about block_size bytes that end on a newline,
+    # the block table only records the char and newline count of every block and is built
+    # on a background thread, line offsets inside a block are indexed when the block is
+    # first used and kept in a small cache, so memory is the block table plus the blocks
+    # around the viewport
+    block_size = 1 << 20
+    cache_blocks = 32
+
+    def __init__(self, path: str, encoding: str = "utf-8"):
+        self.path = path
+        self.encoding = encoding
+        self.file = open(path, "rb")
+        self.size = os.fstat(self.file.fileno()).st_size
+        # mmap can't map empty files
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if self.size else b""
+        # per block starts, one extra entry at the end for the total
+        self.block_bytes = [0]
+        self.block_chars = [0]
+        self.block_newlines = [0]
+        self.block_ascii = []
+        self.block_count = 0 # blocks fully indexed, written last so readers never see half a block
+        self.line_start_cache = OrderedDict() # block -> array of line starts (absolute char offsets)
+        self.text_cache = OrderedDict() # block -> decoded text, only for non ascii blocks
+        self.cache_lock = threading.Lock() # snapshots read the caches from worker threads
+        self.index_thread = None
+        self.index_task = None # when indexing runs on a TaskExecutor
+        self.stopped = False # background indexing gives up at the next block
+        self.readers = 0 # snapshots that may still read the file
+        self.closing = False # closed by its owner, released with the last reader
+
+    def indexed(self) -> bool:
+        return self.block_bytes[self.block_count] >= self.size
+
+    def index_blocks(self, count: int, background: bool = False):
+        # add up to count blocks to the block table
+        for _ in range(count):
+            if background and self.stopped:
+                return
+            start = self.block_bytes[self.block_count]
+            if start >= self.size:
+                return
+            end = min(start + self.block_size, self.size)
+            if end < self.size:
+                newline = self.map.find(b"\n", end - 1)
+                end = self.size if newline == -1 else newline + 1
+            chunk = self.map[start:end]
+            is_ascii = chunk.isascii()
+            chars = len(chunk) if is_ascii else len(chunk.decode(self.encoding, "surrogateescape"))
+            self.block_bytes.append(end)
+            self.block_newlines.append(self.block_newlines[-1] + chunk.count(b"\n"))
+            self.block_ascii.append(is_ascii)
+            self.block_chars.append(self.block_chars[-1] + chars)
+            self.block_count += 1
+
+    def start_indexing(self, executor=None):
+        # the rest of the block table is built off the UI thread
+        if self.index_thread is not None or self.index_task is not None or self.indexed():
+            return
+        if executor is not None:
+            self.index_task = executor.submit(lambda task: self.index_blocks(len(self.map), background=True))
+        else:
+            self.index_thread = threading.Thread(target=self.index_blocks, args=(len(self.map), True), daemon=True)
+            self.index_thread.start()
+
+    def stop_indexing(self):
+        # returns once the background indexer is gone, the table stays valid up to where it got
+        self.stopped = True
+        if self.index_thread is not None:
+            self.index_thread.join()
+        if self.index_task is not None:
+            self.index_task.wait()
+
+    def add_reader(self, table: PieceTable):
+        # table is a snapshot (a search, a save, a copy), the file stays open until it is collected
+        self.readers += 1
+        weakref.finalize(table, self.remove_reader)
+
+    def remove_reader(self):
+        self.readers -= 1
+        if self.closing and not self.readers:
+            self.release()
+
+    def close(self):
+        # the owner is done with the file, the mapping and file object go with the last snapshot
+        self.closing = True
+        self.stop_indexing()
+        if not self.readers:
+            self.release()
+
+    def release(self):
+        if isinstance(self.map, mmap.mmap):
+            self.map.close()
+        self.file.close()
+
+    def __len__(self):
+        # chars indexed so far
+        return self.block_chars[self.block_count]
+
+    def block_of(self, offset: int) -> int:
+        block = bisect_right(self.block_chars, offset, 0, self.block_count + 1) - 1
+        return min(max(block, 0), self.block_count - 1)
+
+    def block_text(self, block: int) -> str:
+        with self.cache_lock:
+            text = self.text_cache.get(block)
+            if text is not None:
+                self.text_cache.move_to_end(block)
+                return text
+        raw = self.map[self.block_bytes[block]:self.block_bytes[block + 1]]
+        text = raw.decode(self.encoding, "surrogateescape")
+        with self.cache_lock:
+            self.text_cache[block] = text
+            if len(self.text_cache) > self.cache_blocks:
+                self.text_cache.popitem(last=False)
+        return text
+
+    def block_line_starts(self, block: int):
+        with self.cache_lock:
+            starts = self.line_start_cache.get(block)
+            if starts is not None:
+                self.line_start_cache.move_to_end(block)
+                return starts
+        char_start = self.block_chars[block]
+        byte_start = self.block_bytes[block]
+        if self.block_ascii[block]:
+            # one char per byte, offsets come straight from the mapped bytes
+            starts = array("q", (char_start + match.end() - byte_start
+                                 for match in _NEWLINE.finditer(self.map, byte_start, self.block_bytes[block + 1])))
+        else:
+            parts = self.block_text(block).split("\n")
+            starts = array("q", (char_start + end for end in accumulate(len(part) + 1 for part in parts[:-1])))
+        with self.cache_lock:
+            self.line_start_cache[block] = starts
+            if len(self.line_start_cache) > self.cache_blocks:
+                self.line_start_cache.popitem(last=False)
+        return starts
+
+    def newlines_before(self, offset: int) -> int:
+        if self.block_count == 0:
+            return 0
+        block = self.block_of(offset)
+        return self.block_newlines[block] + bisect_right(self.block_line_starts(block), offset)
+
+    def slice(self, start: int, end: int) -> str:
+        chunks = []
+        block = self.block_of(start)
+        while start < end:
+            char_start = self.block_chars[block]
+            block_end = min(end, self.block_chars[block + 1])
+            if self.block_ascii[block]:
+                byte_start = self.block_bytes[block]
+                chunks.append(self.map[byte_start + start - char_start:byte_start + block_end - char_start].decode("ascii"))
+            else:
+                chunks.append(self.block_text(block)[start - char_start:block_end - char_start])
+            start = block_end
+            block += 1
+        return "".join(chunks)
+
+    def count_newlines(self, start: int, end: int) -> int:
+        return self.newlines_before(end) - self.newlines_before(start)
+
+    def nth_line_start(self, start: int, n: int) -> int:
+        target = self.newlines_before(start) + n # global number of the newline we want
+        block = bisect_left(self.block_newlines, target) - 1
+        return self.block_line_starts(block)[target - self.block_newlines[block] - 1]
+
+    def byte_offset(self, offset: int) -> int:
+        block = self.block_of(offset)
+        if self.block_ascii[block]:
+            return self.block_bytes[block] + offset - self.block_chars[block]
+        prefix = self.block_text(block)[:offset - self.block_chars[block]]
+        return self.block_bytes[block] + len(prefix.encode(self.encoding, "surrogateescape"))
+
+    def write_range(self, out, start: int, end: int, encoding: str, encode):
+        if codecs.lookup(encoding).name != codecs.lookup(self.encoding).name:
+            for chunk_start in range(start, end, WRITE_CHUNK):
+                write_text(out, self.slice(chunk_start, min(end, chunk_start + WRITE_CHUNK)), encode)
+            return
+        # unchanged file content is copied as bytes, never decoded
+        byte_start = self.byte_offset(start)
+        byte_end = self.byte_offset(end)
+        if hasattr(os, "sendfile"):
+            try:
+                while byte_start < byte_end:
+                    sent = os.sendfile(out.fileno(), self.file.fileno(), byte_start, byte_end - byte_start)
+                    if sent == 0:
+                        break
+                    byte_start += sent
+            except OSError:
+                pass # not supported for this file, copy the rest below
+        view = memoryview(self.map)
+        for chunk_start in range(byte_start, byte_end, WRITE_CHUNK):
+            out.write(view[chunk_start:min(byte_end, chunk_start + WRITE_CHUNK)])
+
+
+class _Piece:
+    # treap node, nodes are never mutated after creation so old roots stay valid
+    __slots__ = ("buffer", "start", "length", "newlines", "priority",
+                 "left", "right", "total_length", "total_newlines")
+
+    def __init__(self, buffer, start, length, newlines, priority, left=None, right=None):
+        self.buffer = buffer
+        self.start = start
+        self.length = length
+        self.newlines = newlines
+        self.priority = priority
+        self.left = left
+        self.right = right
+        self.total_length = length
+        self.total_newlines = newlines
+        if left is not None:
+            self.total_length += left.total_length
+            self.total_newlines += left.total_newlines
+        if right is not None:
+            self.total_length += right.total_length
+            self.total_newlines += right.total_newlines
+
+    def with_children(self, left, right):
+        return _Piece(self.buffer, self.start, self.length, self.newlines, self.priority, left, right)
+
+
+def _leaf(buffer, start, length):
+    newlines = buffer.count_newlines(start, start + length)
+    return _Piece(buffer, start, length, newlines, random.random())
+
+
+def _merge(a, b):
+    if a is None:
+        return b
+    if b is None:
+        return a
+    if a.priority > b.priority:
+        return a.with_children(a.left, _merge(a.right, b))
+    return b.with_children(_merge(a, b.left), b.right)
+
+
+def _split(node, offset):
+    # split into (first offset chars, rest), cutting a piece in two if needed
+    if node is None:
+        return None, None
+    left_length = node.left.total_length if node.left is not None else 0
+    if offset <= left_length:
+        left, right = _split(node.left, offset)
+        return left, node.with_children(right, node.right)
+    if offset >= left_length + node.length:
+        left, right = _split(node.right, offset - left_length - node.length)
+        return node.with_children(node.left, left), right
+    cut = offset - left_length
+    head = _leaf(node.buffer, node.start, cut)
+    tail = _leaf(node.buffer, node.start + cut, node.length - cut)
+    return _merge(node.left, head), _merge(tail, node.right)
+
+
+def _last(node):
+    while node.right is not None:
+        node = node.right
+    return node
+
+
+def _replace_last(node, piece):
+    if node.right is None:
+        return piece.with_children(node.left, None)
+    return node.with_children(node.left, _replace_last(node.right, piece))
+
+
+class PieceTable(TextStorage):
+    # piece table kept in a persistent treap ordered by document position
+    # every node caches the length and newline count of its subtree,
+    # so offset and line lookups, inserts and deletes are O(log n) in the piece count
+
+    # typed text is appended to the previous piece while its buffer is small
+    coalesce_limit = 4096
+
+    # blocks indexed before a file is shown, the rest is indexed in the background
+    preload_blocks = 4
+
+    # apply_edits folds edits closer than region_gap into one new buffer of at most
+    # about region_limit chars, the tree grows by one piece per region and not per edit
+    region_gap = 1 << 12
+    region_limit = 1 << 20
+
+    def __init__(self, text: str = ""):
+        self.root = _leaf(TextBuffer(text), 0, len(text)) if text else None
+        self.source = None # MappedBuffer of the opened file
+        self.source_length = 0 # chars of the source that are part of the document so far
+
+    @classmethod
+    def from_file(cls, path: str, encoding: str = "utf-8", background: bool = True, executor=None):
+        # the file becomes the original buffer, nothing is decoded until lines are read
+        table = cls()
+        buffer = MappedBuffer(path, encoding)
+        buffer.index_blocks(cls.preload_blocks if background else len(buffer.map))
+        table.source = buffer
+        table.source_length = len(buffer)
+        if table.source_length:
+            table.root = _leaf(buffer, 0, table.source_length)
+        buffer.start_indexing(executor)
+        return table
+
+    @classmethod
+    def from_pieces(cls, source: MappedBuffer | None, pieces: list):
+        # pieces are (start, length) ranges of source or str, in document order
+        table = cls()
+        table.source = source
+        table.source_length = len(source) if source is not None else 0
+        for piece in pieces:
+            if isinstance(piece, str):
+                node = _leaf(TextBuffer(piece), 0, len(piece)) if piece else None
+            else:
+                node = _leaf(source, piece[0], piece[1]) if piece[1] else None
+            table.root = _merge(table.root, node)
+        return table
+
+    def finish_loading(self):
+        # index the rest of the source now instead of in the background,
+        # load_more() then adds it to the document
+        if self.source is not None:
+            self.source.stop_indexing()
+            self.source.index_blocks(len(self.source.map))
+
+    def stop_loading(self):
+        if self.source is not None:
+            self.source.stop_indexing()
+
+    def snapshot(self) -> PieceTable:
+        # O(1), nodes and buffers are never changed after they are created
+        table = type(self)()
+        table.root = self.root
+        table.source = self.source
+        table.source_length = self.source_length
+        if self.source is not None:
+            self.source.add_reader(table)
+        return table
+
+    def close(self):
+        if self.source is not None:
+            self.source.close()
+
+    def shares_source(self, other: TextStorage) -> bool:
+        return self.source is not None and getattr(other, "source", None) is self.source
+
+    def loading(self) -> bool:
+        return self.source is not None and (not self.source.indexed() or self.source_length < len(self.source))
+
+    def load_more(self):
+        if self.source is None:
+            return None
+        new_length = len(self.source)
+        if new_length <= self.source_length:
+            return None
+        # newly indexed text goes right after the furthest part of the source still in the document
+        offset = self.source_end_offset()
+        left, right = _split(self.root, offset)
+        piece = _leaf(self.source, self.source_length, new_length - self.source_length)
+        self.root = _merge(_merge(left, piece), right)
+        self.source_length = new_length
+        return offset
+
+    def source_end_offset(self) -> int:
+        # O(pieces) but only runs while a file is loading
+        best_end, best_offset = -1, len(self)
+        offset = 0
+        for node in self.pieces():
+            offset += node.length
+            if node.buffer is self.source and node.start + node.length > best_end:
+                best_end, best_offset = node.start + node.length, offset
+        return best_offset
+
+    def pieces(self):
+        # pieces in document order
+        stack, node = [], self.root
+        while stack or node is not None:
+            while node is not None:
+                stack.append(node)
+                node = node.left
+            node = stack.pop()
+            yield node
+            node = node.right
+
+    def write_file(self, path: str, encoding: str = "utf-8", cancelled=None):
+        # stream piece by piece, each buffer writes its own range
+        encode = codecs.getincrementalencoder(encoding)("surrogateescape").encode
+        def write(out):
+            for node in self.pieces():
+                if cancelled is not None and cancelled():
+                    raise InterruptedError("save cancelled")
+                node.buffer.write_range(out, node.start, node.start + node.length, encoding, encode)
+        atomic_write(path, write)
+
+    def __len__(self):
+        return self.root.total_length if self.root is not None else 0
+
+    def line_count(self) -> int:
+        return (self.root.total_newlines if self.root is not None else 0) + 1
+
+    def line_start(self, line: int) -> int:
+        if line <= 0:
+            return 0
+        node = self.root
+        offset = 0
+        n = line
+        while node is not None:
+            left_length = node.left.total_length if node.left is not None else 0
+            left_newlines = node.left.total_newlines if node.left is not None else 0
+            if n <= left_newlines:
+                node = node.left
+            elif n <= left_newlines + node.newlines:
+                start = node.buffer.nth_line_start(node.start, n - left_newlines)
+                return offset + left_length + start - node.start
+            else:
+                n -= left_newlines + node.newlines
+                offset += left_length + node.length
+                node = node.right
+        return len(self)
+
+    def offset_to_position(self, offset: int):
+        # count newlines before offset while descending
+        node = self.root
+        remaining = offset
+        line = 0
+        while node is not None:
+            left_length = node.left.total_length if node.left is not None else 0
+            if remaining <= left_length:
+                node = node.left
+                continue
+            line += node.left.total_newlines if node.left is not None else 0
+            remaining -= left_length
+            if remaining <= node.length:
+                line += node.buffer.count_newlines(node.start, node.start + remaining)
+                break
+            line += node.newlines
+            remaining -= node.length
+            node = node.right
+        return line, offset - self.line_start(line)
+
+    def get_line(self, line: int) -> str:
+        return self.text(self.line_start(line), self.line_end(line))
+
+    def text(self, start: int = 0, end: int | None = None) -> str:
+        if end is None:
+            end = len(self)
+        if start >= end:
+            return ""
+        chunks = []
+        self._collect(self.root, start, end, chunks)
+        return "".join(chunks)
+
+    def _collect(self, node, start, end, chunks):
+        # append the text of [start, end) relative to this subtree
+        if node is None:
+            return
+        left_length = node.left.total_length if node.left is not None else 0
+        if start < left_length:
+            self._collect(node.left, start, end, chunks)
+        piece_start = left_length
+        piece_end = left_length + node.length
+        if start < piece_end and end > piece_start:
+            lo = max(start, piece_start) - piece_start
+            hi = min(end, piece_end) - piece_start
+            chunks.append(node.buffer.slice(node.start + lo, node.start + hi))
+        if end > piece_end:
+            self._collect(node.right, start - piece_end, end - piece_end, chunks)
+
+    def insert(self, offset: int, text: str):
+        if not text:
+            return
+        left, right = _split(self.root, offset)
+        if left is not None:
+            last = _last(left)
+            buffer = last.buffer
+            if (isinstance(buffer, TextBuffer)
+                    and last.start + last.length == len(buffer)
+                    and len(buffer) + len(text) <= self.coalesce_limit):
+                grown = buffer.extended(text)
+                piece = _leaf(grown, last.start, last.length + len(text))
+                piece.priority = last.priority
+                self.root = _merge(_replace_last(left, piece), right)
+                return
+        self.root = _merge(_merge(left, _leaf(TextBuffer(text), 0, len(text))), right)
+
+    def delete(self, start: int, end: int):
+        if start >= end:
+            return
+        left, rest = _split(self.root, start)
+        _, right = _split(rest, end - start)
+        self.root = _merge(left, right)
+
+    def apply_edits(self, edits: list):
+        if not edits:
+            return
+        # regions as (first edit, last edit) ranges, in document order
+        regions = []
+        first = 0
+        region_start, region_end = edits[0][0], edits[0][1]
+        for index in range(1, len(edits)):
+            start, end, _ = edits[index]
+            if start - region_end > self.region_gap or end - region_start > self.region_limit:
+                regions.append((first, index))
+                first = index
+                region_start = start
+            region_end = end
+        regions.append((first, len(edits)))
+        # back to front so the offsets of the regions still to do stay valid
+        for first, last in reversed(regions):
+            start, end = edits[first][0], edits[last - 1][1]
+            old = self.text(start, end)
+            parts = []
+            append = parts.append
+            position = 0
+            for edit_start, edit_end, text in islice(edits, first, last):
+                append(old[position:edit_start - start])
+                append(text)
+                position = edit_end - start
+            new = "".join(parts)
+            left, rest = _split(self.root, start)
+            _, right = _split(rest, end - start)
+            piece = _leaf(TextBuffer(new), 0, len(new)) if new else None
+            self.root = _merge(_merge(left, piece), right)
@@ -0,0 +1,127 @@
+from __future__ import annotations
+import queue
+import traceback
+from concurrent import futures
+
+
+# background jobs for work that would block the Tk main loop
+#
+# jobs run on a thread pool and must only read data nobody else changes, a storage
+# snapshot() for the document text, results come back through a queue that is polled
+# with after() so callbacks always run on the Tk thread
+#
+# threads and not processes: snapshots share the mapped file and the piece tree,
+# which can't be handed to another process without copying the document
+
+class TaskCancelled(Exception):
+    # raised by jobs that noticed task.cancelled() and stopped early
+    pass
+
+
+PROGRESS = object() # marks partial results in the result queue
+
+
+class Task:
+    __slots__ = ("future", "cancel_requested", "on_done", "on_error", "on_progress", "results")
+
+    def __init__(self, on_done=None, on_error=None, on_progress=None, results=None):
+        self.future = None
+        self.cancel_requested = False
+        self.on_done = on_done
+        self.on_error = on_error
+        self.on_progress = on_progress
+        self.results = results
+
+    def cancel(self):
+        # a job that already started stops at its next cancelled() check,
+        # the callbacks of a cancelled task are never called
+        self.cancel_requested = True
+        if self.future is not None:
+            self.future.cancel()
+
+    def report(self, value):
+        # called by the job, on_progress(value) runs on the Tk thread before on_done
+        self.results.put((self, value, PROGRESS))
+
+    def cancelled(self) -> bool:
+        return self.cancel_requested
+
+    def done(self) -> bool:
+        return self.future is None or self.future.done()
+
+    def wait(self, timeout: float | None = None):
+        if self.future is not None:
+            futures.wait([self.future], timeout)
+
+
+class TaskExecutor:
+    poll_interval = 20 # ms between checks for finished jobs
+
+    def __init__(self, ctx: EditorContext, workers: int = 2):
+        self.ctx = ctx
+        self.pool = futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="editor-task")
+        self.results = queue.SimpleQueue() # (task, result, error) from the workers
+        self.tasks = set() # submitted and not delivered yet
+        self.poll_pending = None # after id of the next poll
+
+    def submit(self, job, *args, on_done=None, on_error=None, on_progress=None) -> Task:
+        # job(task, *args) runs on a worker, on_done(result) / on_error(exception) and
+        # on_progress(value) for every task.report(value) on the Tk thread
+        task = Task(on_done, on_error, on_progress, self.results)
+        task.future = self.pool.submit(self.run, task, job, args)
+        self.tasks.add(task)
+        self.schedule_poll()
+        return task
+
+    def run(self, task: Task, job, args):
+        try:
+            result, error = job(task, *args), None
+        except BaseException as exception:
+            result, error = None, exception
+        self.results.put((task, result, error))
+
+    def schedule_poll(self):
+        # headless users (benchmarks) call poll() or wait() themselves
+        if self.poll_pending is None and self.ctx.editor is not None:
+            self.poll_pending = self.ctx.editor.after(self.poll_interval, self.poll)
+
+    def poll(self):
+        self.poll_pending = None
+        # drop tasks that finished or were cancelled before they started, a finished job
+        # put its result in the queue before its future was done so it is delivered below
+        self.tasks = {task for task in self.tasks if not task.done()}
+        while True:
+            try:
+                task, result, error = self.results.get_nowait()
+            except queue.Empty:
+                break
+            if error is not PROGRESS:
+                self.tasks.discard(task)
+            if task.cancelled() or isinstance(error, TaskCancelled):
+                continue
+            try:
+                if error is PROGRESS:
+                    if task.on_progress is not None:
+                        task.on_progress(result)
+                elif error is None:
+                    if task.on_done is not None:
+                        task.on_done(result)
+                elif task.on_error is not None:
+                    task.on_error(error)
+                else:
+                    raise error
+            except Exception:
+                # one failing callback must not stop the others from being delivered
+                traceback.print_exc()
+        if self.tasks:
+            self.schedule_poll()
+
+    def wait(self, task: Task):
+        # block until task is done and run its callbacks
+        task.wait()
+        self.poll()
+
+    def shutdown(self):
+        for task in list(self.tasks):
+            task.cancel()
+        self.pool.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,6 @@
+import os
+import sys
+
+# the tests import the editor modules from the repository root, the editor layers run
+# headless on the stand-in canvas and font of benchmark.make_context
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,74 @@
+import tkinter as tk
+
+from benchmark import make_context, make_payload
+from clipboard import CHUNK_SIZE, ClipboardContent, ClipboardService
+from storage import PieceTable
+
+
+class StandInRoot:
+    # the clipboard calls ClipboardService makes on a Tk instance, owned by the editor
+    def __init__(self):
+        self.parts = []
+
+    def clipboard_clear(self):
+        self.parts = []
+
+    def clipboard_append(self, text):
+        self.parts.append(text)
+
+    def clipboard_get(self):
+        if not self.parts:
+            raise tk.TclError("CLIPBOARD selection doesn't exist")
+        return "".join(self.parts)
+
+    def selection_own_get(self, selection):
+        return self
+
+
+def test_content_chunks():
+    text = "".join("line %d\n" % index for index in range(500))
+    content = ClipboardContent(PieceTable(text), [(3, 40), (40, 41), (100, 2000)], "--")
+    expected = text[3:40] + "--" + text[40:41] + "--" + text[100:2000]
+    for size in (1, 7, 64, 5000):
+        chunks = list(content.chunks(size))
+        assert "".join(chunks) == expected and len(content) == len(expected)
+        assert all(len(chunk) == size for chunk in chunks[:-1])
+
+
+def test_chunked_paste_is_one_undo_step_and_cancels():
+    source = make_context(make_payload(3 * CHUNK_SIZE))
+    source.document.select_range(10, 3 * CHUNK_SIZE)
+    source.document.copy_text()
+    copied = source.document.storage.text(10, 3 * CHUNK_SIZE)
+    target = make_context("hello\nworld\n")
+    target.clipboard = source.clipboard
+    document = target.document
+    before = document.storage.text()
+    document.select_range(2, 8)
+    transfer = document.paste_text()
+    transfer.run(0)
+    assert 0 < transfer.progress() < 1 and document.paste_text() is None
+    transfer.finish()
+    assert document.storage.text() == before[:2] + copied + before[8:]
+    target.command_manager.undo()
+    assert document.storage.text() == before
+    transfer = document.paste_text()
+    transfer.run(0)
+    transfer.cancel()
+    assert document.storage.text() == before and document.paste_transfer is None
+
+
+def test_cancelled_copy_is_not_pasted():
+    ctx = make_context(make_payload(3 * CHUNK_SIZE))
+    ctx.clipboard = ClipboardService(StandInRoot())
+    document = ctx.document
+    document.select_range(0, 3 * CHUNK_SIZE)
+    transfer = document.copy_text()
+    transfer.run(0)
+    transfer.cancel()
+    assert ctx.clipboard.paste() is None
+    document.select_range(0, 5)
+    transfer = document.copy_text()
+    transfer.finish()
+    assert ctx.clipboard.paste().text() == document.storage.text(0, 5)
+    assert ctx.clipboard.root.clipboard_get() == document.storage.text(0, 5)
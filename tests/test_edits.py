@@ -0,0 +1,49 @@
+from benchmark import make_context
+
+
+def test_typing_at_several_cursors():
+    ctx = make_context("one\ntwo\nthree\n")
+    document = ctx.document
+    for line in range(3):
+        document.add_cursor(document.storage.line_start(line))
+    for char in "- ":
+        document.insert_str(char)
+    assert document.storage.text() == "- one\n- two\n- three\n"
+    assert len(ctx.command_manager.undo_stack) == 1 # typing merged into one step
+    document.delete(2)
+    assert document.storage.text() == "one\ntwo\nthree\n"
+    ctx.command_manager.undo()
+    ctx.command_manager.undo()
+    assert document.storage.text() == "one\ntwo\nthree\n"
+
+
+def test_block_selection_edit():
+    ctx = make_context("abcdef\nab\nabcdef\n")
+    document = ctx.document
+    storage = document.storage
+    document.select_block(storage.position_to_offset(0, 1), storage.position_to_offset(2, 4))
+    assert len(document.selections) == 3
+    document.insert_str("X")
+    assert storage.text() == "aXef\naX\naXef\n"
+    ctx.command_manager.undo()
+    assert storage.text() == "abcdef\nab\nabcdef\n"
+
+
+def test_cursors_merge_when_they_meet():
+    ctx = make_context("abcd\n")
+    document = ctx.document
+    document.move_cursor_to(2)
+    document.add_cursor(3)
+    document.delete(2)
+    assert document.storage.text() == "d\n"
+    assert len(document.selections) == 1
+
+
+def test_paste_one_line_per_cursor():
+    ctx = make_context("a\nb\n")
+    document = ctx.document
+    document.move_cursor_to(1)
+    document.add_cursor(3)
+    ctx.clipboard.copy("1\n2")
+    document.paste_text()
+    assert document.storage.text() == "a1\nb2\n"
@@ -0,0 +1,135 @@
+import os
+
+import pytest
+
+from benchmark import make_context, make_payload
+from clipboard import CHUNK_SIZE
+from journal import EditJournal
+from tasks import TaskExecutor
+
+
+def journal_session(path, executor=None):
+    # an editor on path with its journal attached, like a buffer the window activates
+    ctx = make_context()
+    ctx.executor = executor
+    ctx.journal = EditJournal(ctx)
+    ctx.command_manager.add_observer(ctx.journal.on_command)
+    ctx.document.open_file(str(path))
+    ctx.journal.attach(str(path))
+    return ctx
+
+
+def test_replay_keeps_typed_newline_apart_from_enter(tmp_path):
+    path = tmp_path / "text.txt"
+    path.write_text("hello")
+    ctx = journal_session(path)
+    document = ctx.document
+    document.move_cursor_to(5)
+    ctx.clipboard.copy("\n")
+    document.paste_text() # a plain insert, typing right after it merges
+    document.insert_str("x")
+    document.newline() # Enter, its own undo step
+    document.insert_str("y")
+    ctx.command_manager.undo()
+    live_text = document.storage.text()
+    ctx.journal.suspend() # written out, the undos below are not journaled
+
+    replayed = journal_session(path)
+    assert replayed.document.storage.text() == live_text
+    ctx.command_manager.undo()
+    replayed.command_manager.undo()
+    assert replayed.document.storage.text() == document.storage.text()
+    ctx.command_manager.undo()
+    replayed.command_manager.undo()
+    assert replayed.document.storage.text() == document.storage.text() == "hello\n"
+    replayed.journal.close()
+
+
+@pytest.mark.parametrize("background", [False, True])
+def test_replay_after_compaction(tmp_path, background):
+    # snapshots written by the journal's writer thread, or by a TaskExecutor job
+    path = tmp_path / "text.txt"
+    path.write_text("one\ntwo\nthree\n" * 100)
+    ctx = journal_session(path, TaskExecutor(make_context()) if background else None)
+    ctx.journal.compact_every = 7
+    document = ctx.document
+    for index in range(60):
+        document.move_cursor_to(index * 5)
+        document.insert_str("typed")
+        if index % 3 == 0:
+            document.newline()
+        if index % 4 == 0:
+            document.delete(2)
+        if index % 9 == 0:
+            ctx.command_manager.undo()
+    live_text = document.storage.text()
+    ctx.journal.suspend() # written out, the undos below are not journaled
+    assert os.path.exists(ctx.journal.snapshot_path)
+    if ctx.executor is not None:
+        ctx.executor.shutdown()
+
+    replayed = journal_session(path)
+    assert replayed.document.storage.text() == live_text
+    while ctx.command_manager.undo_stack:
+        ctx.command_manager.undo()
+        replayed.command_manager.undo()
+        assert replayed.document.storage.text() == document.storage.text()
+    replayed.journal.close()
+
+
+def test_replay_multi_cursor_and_replace_all(tmp_path):
+    path = tmp_path / "text.txt"
+    path.write_text("one two\ntwo one\n" * 50)
+    ctx = journal_session(path)
+    document = ctx.document
+    for line in range(0, 100, 3):
+        document.add_cursor(document.storage.line_start(line))
+    for char in "# ":
+        document.insert_str(char)
+    document.keep_primary_cursor()
+    document.replace_all("2", "two")
+    document.move_cursor_to(7)
+    document.newline()
+    ctx.command_manager.undo()
+    live_text = document.storage.text()
+    ctx.journal.suspend()
+
+    replayed = journal_session(path)
+    assert replayed.document.storage.text() == live_text
+    while ctx.command_manager.undo_stack:
+        ctx.command_manager.undo()
+        replayed.command_manager.undo()
+        assert replayed.document.storage.text() == document.storage.text()
+    replayed.command_manager.redo()
+    ctx.command_manager.redo()
+    assert replayed.document.storage.text() == document.storage.text()
+    replayed.journal.close()
+
+
+@pytest.mark.parametrize("cancel", [False, True])
+def test_save_during_chunked_paste(tmp_path, cancel):
+    # the snapshot of a save that finishes mid-paste waits for the paste's undo step
+    path = tmp_path / "text.txt"
+    path.write_text("one\ntwo\n")
+    ctx = journal_session(path)
+    document = ctx.document
+    document.move_cursor_to(4)
+    ctx.clipboard.copy(make_payload(3 * CHUNK_SIZE))
+    transfer = document.paste_text()
+    transfer.step()
+    transfer.step()
+    ctx.journal.saved(str(path))
+    if cancel:
+        transfer.cancel()
+    else:
+        transfer.finish()
+    live_text = document.storage.text()
+    ctx.journal.suspend()
+
+    replayed = journal_session(path)
+    assert replayed.document.storage.text() == live_text
+    if not cancel:
+        ctx.command_manager.undo()
+        replayed.command_manager.undo()
+        assert replayed.document.storage.text() == document.storage.text() == "one\ntwo\n"
+    replayed.journal.close()
@@ -0,0 +1,60 @@
+import gc
+import os
+
+from benchmark import make_context
+
+
+def open_fds():
+    return len(os.listdir("/proc/self/fd"))
+
+
+def test_save_round_trip(tmp_path):
+    path = tmp_path / "text.txt"
+    path.write_text("first line\nsecond line\n")
+    ctx = make_context()
+    document = ctx.document
+    document.open_file(str(path))
+    document.move_cursor_to(5)
+    document.insert_str(" inserted")
+    document.move_cursor_to(len(document.storage))
+    document.insert_str("last line é")
+    text = document.storage.text()
+    document.save()
+    assert path.read_text(encoding="utf-8") == text
+    assert document.storage.text() == text
+    target = tmp_path / "copy.txt"
+    document.save(str(target))
+    assert target.read_text(encoding="utf-8") == text and document.file_path == str(target)
+
+
+def test_save_closes_replaced_file(tmp_path):
+    path = tmp_path / "text.txt"
+    path.write_text("line\n" * 1000)
+    ctx = make_context()
+    document = ctx.document
+    document.open_file(str(path))
+    gc.collect()
+    before = open_fds()
+    for _ in range(20):
+        document.insert_str("x")
+        document.save()
+    gc.collect()
+    assert open_fds() == before
+
+
+def test_copy_outlives_save_and_close(tmp_path):
+    path = tmp_path / "text.txt"
+    path.write_text("alpha\nbeta\ngamma\n")
+    ctx = make_context()
+    document = ctx.document
+    document.open_file(str(path))
+    document.select_range(6, 10)
+    document.copy_text() # spans of a snapshot of the mapped file
+    source = document.storage.source
+    document.save()
+    ctx.buffers.close(ctx.buffers.active)
+    assert not source.file.closed # the copy still reads it
+    assert ctx.clipboard.paste().text() == "beta"
+    ctx.clipboard.copy("other")
+    gc.collect()
+    assert source.file.closed
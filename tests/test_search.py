@@ -0,0 +1,54 @@
+import random
+import re
+
+import pytest
+
+from benchmark import make_context
+from search import MatchIndex
+
+
+def expected_matches(text, pattern, regex=False):
+    compiled = re.compile(pattern if regex else re.escape(pattern), re.MULTILINE)
+    return [match.span() for match in compiled.finditer(text) if match.end() > match.start()]
+
+
+def test_match_index_replace():
+    index = MatchIndex()
+    index.block_size = 4
+    index.add_run([(start, start + 2) for start in range(0, 100, 5)])
+    # [12, 30) becomes 8 characters shorter, one match is found in the new text
+    index.replace(12, 30, -8, [(14, 16)])
+    moved = [(start, end) for start, end in ((start, start + 2) for start in range(0, 100, 5)) if end <= 12]
+    moved += [(14, 16)]
+    moved += [(start - 8, end - 8) for start, end in ((start, start + 2) for start in range(0, 100, 5)) if start >= 30]
+    assert list(index) == moved and len(index) == len(moved)
+
+
+@pytest.mark.parametrize("pattern, regex", [("needle", False), (r"ne+dle\b", True), (r"^\w+", True)])
+def test_index_follows_edits(pattern, regex):
+    rng = random.Random(5)
+    words = ["needle", "hay", "neeedle", "stack", "\n", "nee", "dle", " "]
+    ctx = make_context("".join(rng.choice(words) for _ in range(3000)))
+    document = ctx.document
+    search = document.find(pattern, regex=regex)
+    assert list(search.index) == expected_matches(document.storage.text(), pattern, regex)
+    for _ in range(200):
+        document.move_cursor_to(rng.randrange(len(document.storage) + 1))
+        action = rng.random()
+        if action < 0.5:
+            document.insert_str(rng.choice(words))
+        elif action < 0.8:
+            document.delete(rng.randrange(1, 8))
+        else:
+            ctx.command_manager.undo()
+        assert list(search.index) == expected_matches(document.storage.text(), pattern, regex)
+
+
+def test_replace_all_is_one_undo_step():
+    ctx = make_context("a needle, two needles\nneedle\n")
+    document = ctx.document
+    before = document.storage.text()
+    assert document.replace_all("pin", "needle") == 3
+    assert document.storage.text() == before.replace("needle", "pin")
+    ctx.command_manager.undo()
+    assert document.storage.text() == before
@@ -0,0 +1,87 @@
+import random
+
+import pytest
+
+from storage import MappedBuffer, PieceTable
+
+
+def check(table, text):
+    # the table reads like the plain string it models
+    assert len(table) == len(text)
+    assert table.text() == text
+    lines = text.split("\n")
+    assert table.line_count() == len(lines)
+    offset = 0
+    for line, content in enumerate(lines):
+        assert table.line_start(line) == offset
+        assert table.get_line(line) == content
+        assert table.offset_to_position(offset + len(content)) == (line, len(content))
+        offset += len(content) + 1
+
+
+def random_edits(table, text, rng, count):
+    alphabet = "ab\ncdé\n"
+    for _ in range(count):
+        start = rng.randrange(len(text) + 1)
+        if text and rng.random() < 0.4:
+            end = min(len(text), start + rng.randrange(1, 30))
+            table.delete(start, end)
+            text = text[:start] + text[end:]
+        else:
+            inserted = "".join(rng.choice(alphabet) for _ in range(rng.randrange(1, 20)))
+            table.insert(start, inserted)
+            text = text[:start] + inserted + text[start:]
+    return text
+
+
+def test_insert_delete():
+    rng = random.Random(1)
+    text = "first line\nsecond line\n"
+    table = PieceTable(text)
+    for _ in range(20):
+        text = random_edits(table, text, rng, 25)
+        check(table, text)
+
+
+def test_typing_coalesces_into_one_buffer():
+    table = PieceTable("x\n")
+    text = "x\n"
+    for index in range(500):
+        char = "\n" if index % 7 == 0 else "y"
+        table.insert(len(text) - 1, char)
+        text = text[:-1] + char + text[-1:]
+    check(table, text)
+    assert len(list(table.pieces())) < 10
+
+
+def test_apply_edits():
+    table = PieceTable("one two three two one\n" * 3)
+    text = table.text()
+    edits = [(start, start + 3, "2") for start in range(len(text)) if text.startswith("two", start)]
+    table.apply_edits(edits)
+    check(table, text.replace("two", "2"))
+
+
+def test_snapshot_does_not_see_later_edits():
+    rng = random.Random(2)
+    text = "alpha\nbeta\ngamma\n" * 20
+    table = PieceTable(text)
+    snapshot = table.snapshot()
+    edited = random_edits(table, text, rng, 200)
+    check(snapshot, text)
+    check(table, edited)
+
+
+@pytest.mark.parametrize("content", ["ascii line\n" * 3000, "wide é 計算 line\n" * 3000, ""])
+def test_mapped_file(tmp_path, monkeypatch, content):
+    # a mapped file of many blocks, edited like any other storage and written back
+    monkeypatch.setattr(MappedBuffer, "block_size", 1024)
+    path = tmp_path / "text.txt"
+    path.write_text(content, encoding="utf-8")
+    table = PieceTable.from_file(str(path), background=False)
+    check(table, content)
+    text = random_edits(table, content, random.Random(3), 100)
+    check(table, text)
+    table.write_file(str(tmp_path / "saved.txt"))
+    assert (tmp_path / "saved.txt").read_text(encoding="utf-8") == text
+    table.close()